@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import timeit
+
+from benchmarks.bench_ebook_obj import make_cache_rows
+from ogreclient.utils import codec
+
+
+def measure(count, repeat=3):
+    '''
+    Time encoding and decoding the data blobs of a library with each codec
+    '''
+    objs = [json.loads(row[2]) for _, row in make_cache_rows(count)]
+
+    results = []
+
+    for c in (codec.JsonCodec(), codec.MarshalCodec()):
+        payloads = [codec.encode(obj, codec=c) for obj in objs]
+
+        encode = min(timeit.repeat(lambda: [codec.encode(obj, codec=c) for obj in objs], number=1, repeat=repeat))
+        decode = min(timeit.repeat(lambda: [codec.decode(data) for data in payloads], number=1, repeat=repeat))
+
+        results.append((c.name, count, count / encode, count / decode, sum(len(p) for p in payloads) // count))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cache payload codec throughput benchmark')
+    parser.add_argument('--count', type=int, default=100000, help='Number of ebooks in the library')
+    args = parser.parse_args()
+
+    print('{: <10}{: >10}{: >14}{: >14}{: >12}'.format('codec', 'books', 'encode/s', 'decode/s', 'bytes'))
+    for name, count, encode, decode, size in measure(args.count):
+        print('{: <10}{: >10}{: >14.0f}{: >14.0f}{: >12}'.format(name, count, encode, decode, size))
+
+
+if __name__ == '__main__':
+    main()
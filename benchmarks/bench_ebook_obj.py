@@ -0,0 +1,142 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import sys
+
+from ogreclient.core.ebook_obj import EbookObject
+
+
+class LegacyEbookObject:
+    '''
+    Replica of the pre-__slots__ EbookObject, used as a baseline for comparison
+    '''
+    def __init__(self, filepath, file_hash=None, ebook_id=None, size=None, authortitle=None,
+                 fmt=None, drmfree=False, skip=False, source=None):
+        self.path = filepath
+        self.file_hash = file_hash
+        self.ebook_id = ebook_id
+        self.size = size
+        self.authortitle = authortitle
+        self.format = fmt
+        self.drmfree = drmfree
+        self.skip = skip
+        self.meta = {'source': source}
+        self.in_cache = False
+
+    @staticmethod
+    def deserialize(path, cached_obj):
+        data = json.loads(cached_obj[2])
+        ebook_obj = LegacyEbookObject(
+            filepath=path,
+            file_hash=cached_obj[0],
+            ebook_id=cached_obj[1],
+            authortitle=data['authortitle'],
+            fmt=data['format'],
+            size=data['size'],
+            drmfree=bool(cached_obj[3]),
+            skip=bool(cached_obj[4]),
+        )
+        ebook_obj.in_cache = True
+        ebook_obj.meta = data['meta']
+        return ebook_obj
+
+
+def make_cache_rows(count):
+    '''
+    Generate rows in the shape returned by Cache.get_ebook()
+    '''
+    formats = ('epub', 'mobi', 'azw3', 'pdf')
+    sources = ('Ebook Home', 'Amazon Kindle')
+
+    for i in xrange(count):
+        fmt = formats[i % len(formats)]
+        meta = {
+            'source': sources[i % len(sources)],
+            'firstname': 'Firstname{}'.format(i % 997),
+            'lastname': 'Lastname{}'.format(i % 991),
+            'title': 'A Book Title Number {}'.format(i),
+            'publisher': 'Publisher {}'.format(i % 50),
+            'publish_date': '2008-06-26T14:00:00+00:00',
+            'tags': 'Fantasy, Fiction',
+            'uri': 'http://www.gutenberg.org/ebooks/{}'.format(i),
+        }
+        data = {
+            'format': fmt,
+            'size': 100000 + i,
+            'dedrm': False,
+            'meta': meta,
+            'authortitle': '{}\u0006{}\u0007{}'.format(meta['firstname'], meta['lastname'], meta['title']),
+        }
+        path = '/home/user/ebooks/{:03}/{}.{}'.format(i % 100, i, fmt)
+        yield path, ('{:032x}'.format(i), None, json.dumps(data), 0, i % 10 == 0)
+
+
+def deep_sizeof(obj, seen=None):
+    '''
+    Recursively sum sys.getsizeof() across an object graph, counting shared objects once
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for k, v in obj.iteritems():
+            size += deep_sizeof(k, seen) + deep_sizeof(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+
+    if hasattr(type(obj), '__slots__'):
+        for slot in type(obj).__slots__:
+            if hasattr(obj, slot):
+                size += deep_sizeof(getattr(obj, slot), seen)
+
+    return size
+
+
+def measure(count):
+    rows = list(make_cache_rows(count))
+
+    results = []
+
+    for name, cls, decode in (
+            ('legacy', LegacyEbookObject, False),
+            ('slots-lazy', EbookObject, False),
+            ('slots-decoded', EbookObject, True)):
+        objs = [cls.deserialize(path, row) for path, row in rows]
+        if decode:
+            for obj in objs:
+                obj.meta
+
+        seen = set()
+        # exclude the path strings, which are shared with the source rows
+        for path, _ in rows:
+            seen.add(id(path))
+        total = sum(deep_sizeof(obj, seen) for obj in objs)
+
+        results.append((name, count, total, total // count))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EbookObject memory footprint benchmark')
+    parser.add_argument('--count', type=int, default=100000, help='Number of ebooks in the library')
+    args = parser.parse_args()
+
+    print('{: <16}{: >10}{: >16}{: >12}'.format('variant', 'books', 'total bytes', 'per book'))
+    for name, count, total, per_book in measure(args.count):
+        print('{: <16}{: >10}{: >16}{: >12}'.format(name, count, total, per_book))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from ogreclient.utils import compute_md5, devices
+
+
+# posix_fadvise advice to drop a file's pages from the page cache
+POSIX_FADV_DONTNEED = 4
+
+_libc = ctypes.CDLL(ctypes.util.find_library(str('c')), use_errno=True)
+
+
+def generate_scattered_library(basepath, count, min_size, max_size, seed=None):
+    '''
+    Create files across a directory tree in random order, so that the order they
+    are found by os.walk is unrelated to their order on disk, as in a library
+    built up over years
+
+    returns:
+        list of paths, in os.walk order
+    '''
+    rng = random.Random(seed)
+
+    paths = [os.path.join(basepath, '{:02}'.format(i % 37), '{:06}.epub'.format(i)) for i in xrange(count)]
+    rng.shuffle(paths)
+
+    for path in paths:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(rng.randint(min_size, max_size)))
+
+    found = []
+    for root, _, files in os.walk(basepath):
+        found.extend(os.path.join(root, name) for name in files)
+    return found
+
+
+def evict(paths):
+    '''
+    Drop the files from the page cache, so they are read from disk again
+    '''
+    _libc.sync()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            _libc.posix_fadvise(fd, ctypes.c_longlong(0), ctypes.c_longlong(0), POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def measure(paths, repeat=3):
+    '''
+    Time hashing every file from a cold page cache in each read order
+    '''
+    total_bytes = sum(os.path.getsize(p) for p in paths)
+    results = []
+
+    try:
+        for order in devices.READ_ORDERS:
+            devices.configure(read_order=order)
+            best = None
+
+            for _ in range(repeat):
+                evict(paths)
+
+                start = time.time()
+                ordered = devices.locality_order(paths)
+                sort = time.time() - start
+
+                for path in ordered:
+                    compute_md5(path)
+                wall = time.time() - start
+
+                if best is None or wall < best[0]:
+                    best = (wall, sort)
+
+            results.append((order, len(paths), best[0], best[1], total_bytes / best[0] / 1048576))
+    finally:
+        devices.configure()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-cache read throughput by read order')
+    parser.add_argument('--count', type=int, default=2000, help='Number of files in the library')
+    parser.add_argument('--min-size', type=int, default=65536, help='Smallest file in bytes')
+    parser.add_argument('--max-size', type=int, default=524288, help='Largest file in bytes')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each order; the fastest is reported')
+    parser.add_argument(
+        '--workdir', help='Directory for the library, on the disk to measure; defaults to a temp dir')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    try:
+        paths = generate_scattered_library(
+            os.path.join(workdir, 'library'), args.count, args.min_size, args.max_size, seed=args.seed
+        )
+
+        print('{: <12}{: >8}{: >10}{: >10}{: >10}'.format('order', 'files', 'wall', 'sort', 'MB/s'))
+        for order, count, wall, sort, mbps in measure(paths, repeat=args.repeat):
+            print('{: <12}{: >8}{: >9.3f}s{: >9.3f}s{: >10.1f}'.format(order, count, wall, sort, mbps))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
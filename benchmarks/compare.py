@@ -0,0 +1,50 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import sys
+
+
+def load_results(path):
+    with open(path) as f:
+        report = json.load(f)
+    return report, {(r['size'], r['benchmark']): r for r in report['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('baseline', help='JSON results from the reference version')
+    parser.add_argument('current', help='JSON results from the version under test')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='Relative slowdown reported as a regression (default: 0.1)')
+    args = parser.parse_args()
+
+    base_report, base = load_results(args.baseline)
+    curr_report, curr = load_results(args.current)
+
+    print('baseline: ogreclient {} ({})'.format(base_report['ogreclient_version'], base_report['timestamp']))
+    print('current:  ogreclient {} ({})'.format(curr_report['ogreclient_version'], curr_report['timestamp']))
+    print('{: >8}  {: <28}{: >12}{: >12}{: >9}'.format('size', 'benchmark', 'baseline', 'current', 'change'))
+
+    regressions = 0
+
+    for key in sorted(set(base) & set(curr)):
+        old, new = base[key]['wall'], curr[key]['wall']
+        change = (new - old) / old if old else 0
+        flag = ''
+        if change > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print('{: >8}  {: <28}{: >11.3f}s{: >11.3f}s{: >+8.1%}{}'.format(
+            key[0], key[1], old, new, change, flag
+        ))
+
+    # non-zero exit lets CI fail on regressions
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import random
+import stat
+
+
+EBOOK_META_STUB = '''#!/bin/sh
+# fast stand-in for calibre's ebook-meta; metadata is read from the first line of the file
+if [ "$2" = "--tags" ] || [ "$2" = "--identifier" ]; then
+    printf '\\n%s\\n' "$3" >> "$1"
+    exit 0
+fi
+IFS='|' read -r title author tags < "$1"
+echo "Title               : $title"
+echo "Author(s)           : $author"
+echo "Tags                : $tags"
+echo "Languages           : eng"
+echo "Published           : 2008-06-26T14:00:00+00:00"
+echo "Identifiers         : uri:http://example.com/$title"
+'''
+
+
+def write_ebook_meta_stub(directory):
+    '''
+    Write an executable ebook-meta replacement into directory, returning its path
+    '''
+    path = os.path.join(directory, 'ebook-meta')
+    with open(path, 'w') as f:
+        f.write(EBOOK_META_STUB)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def generate_library(basepath, count, formats=('epub', 'mobi', 'azw3', 'pdf'), dup_ratio=0.0,
+                     depth=2, fanout=10, min_size=2048, max_size=16384, seed=None):
+    '''
+    Create a synthetic ebook library on disk
+
+    params:
+        basepath: directory in which to create the library
+        count: total number of files to create
+        formats: file extensions to cycle through
+        dup_ratio: fraction of files which are byte-identical copies of another file
+        depth: number of directory levels below basepath
+        fanout: number of subdirectories at each level
+        min_size/max_size: bounds of the random file size in bytes
+        seed: seed for the random generator, for reproducible libraries
+    returns:
+        list of created file paths
+    '''
+    rand = random.Random(seed)
+    paths = []
+    originals = []
+
+    for i in xrange(count):
+        # build a directory path `depth` levels deep
+        parts = [basepath]
+        for level in range(depth):
+            parts.append('d{}'.format(rand.randrange(fanout)))
+        directory = os.path.join(*parts)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if originals and rand.random() < dup_ratio:
+            # exact duplicate of an existing book, in another place
+            src_path = rand.choice(originals)
+            with open(src_path, 'rb') as f:
+                content = f.read()
+            fmt = os.path.splitext(src_path)[1][1:]
+        else:
+            fmt = formats[i % len(formats)]
+            # first line carries the metadata read by the ebook-meta stub
+            header = 'Book Title {0}|Firstname{1} Lastname{1}|Fiction\n'.format(i, i % 997)
+            body_size = max(rand.randint(min_size, max_size) - len(header), 0)
+            content = header.encode('utf-8') + os.urandom(body_size)
+            src_path = None
+
+        path = os.path.join(directory, 'book-{}.{}'.format(i, fmt))
+        with open(path, 'wb') as f:
+            f.write(content)
+
+        if src_path is None:
+            originals.append(path)
+        paths.append(path)
+
+    return paths
@@ -0,0 +1,264 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import ogreclient
+from ogreclient.config import deserialize_defs
+from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.core.scan import _find_ebooks, _process_ebooks
+from ogreclient.providers import LibProvider
+from ogreclient.utils import compute_md5
+from ogreclient.utils.cache import Cache
+from ogreclient.utils.printer import CliPrinter
+
+from benchmarks.library import generate_library, write_ebook_meta_stub
+from benchmarks.server import DEFINITIONS, FakeOgreServer
+
+
+class Timer(object):
+    '''
+    Context manager recording wall and CPU time of a block
+    '''
+    def __enter__(self):
+        self.wall_start = time.time()
+        self.cpu_start = time.clock()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.time() - self.wall_start
+        self.cpu = time.clock() - self.cpu_start
+
+
+class Suite(object):
+    def __init__(self, size, workdir, args):
+        self.size = size
+        self.workdir = workdir
+        self.args = args
+        self.results = []
+
+    def bench(self, name, func, repeat=1, items=None, nbytes=None):
+        '''
+        Run func `repeat` times, recording the fastest run
+        '''
+        best = None
+        for _ in range(repeat):
+            with Timer() as t:
+                ret = func()
+            if best is None or t.wall < best.wall:
+                best = t
+
+        result = {
+            'size': self.size,
+            'benchmark': name,
+            'repeat': repeat,
+            'wall': round(best.wall, 6),
+            'cpu': round(best.cpu, 6),
+            'items': items,
+            'bytes': nbytes,
+            'items_per_sec': round(items / best.wall, 1) if items and best.wall else None,
+            'mb_per_sec': round(nbytes / best.wall / 1048576, 2) if nbytes and best.wall else None,
+        }
+        self.results.append(result)
+        print('{: >8}  {: <28}{: >10.3f}s{: >10.3f}s  {}'.format(
+            self.size, name, best.wall, best.cpu,
+            '{} items/s'.format(result['items_per_sec']) if result['items_per_sec'] else ''
+        ))
+        return ret
+
+    def run(self):
+        library_path = os.path.join(self.workdir, 'library')
+
+        with Timer() as t:
+            paths = generate_library(
+                library_path, self.size,
+                formats=self.args.formats,
+                dup_ratio=self.args.dup_ratio,
+                depth=self.args.depth,
+                seed=self.args.seed,
+            )
+        print('{: >8}  generated library in {:.1f}s'.format(self.size, t.wall))
+        total_bytes = sum(os.path.getsize(p) for p in paths)
+
+        # point ogreclient at the fast ebook-meta stub
+        EbookObject.calibre_ebook_meta_bin = write_ebook_meta_stub(self.workdir)
+        EbookObject.ebook_home = library_path
+
+        config = {
+            'config_dir': self.workdir,
+            'ebook_home': library_path,
+            'providers': {'home': LibProvider(friendly='Ebook Home', libpath=library_path)},
+            'definitions': deserialize_defs(DEFINITIONS),
+            'verbose': False,
+            'debug': False,
+            'skip_cache': False,
+            'no_drm': True,
+            'use_ssl': False,
+        }
+        config['ebook_cache'] = Cache(config, os.path.join(self.workdir, 'ebook_cache.db'))
+        config['ebook_cache'].verify_cache()
+
+        ebooks = self.bench(
+            'find_ebooks',
+            lambda: _find_ebooks(config['providers'], config['definitions']),
+            repeat=self.args.repeat, items=self.size,
+        )
+
+        self.bench(
+            'compute_md5',
+            lambda: [compute_md5(p) for p in paths],
+            repeat=self.args.repeat, items=self.size, nbytes=total_bytes,
+        )
+
+        process = lambda: _process_ebooks(ebooks, config['ebook_cache'], config['definitions'])
+
+        # first run extracts metadata via the stub and populates the cache
+        self.bench('process_ebooks_cold', process, items=self.size, nbytes=total_bytes)
+        ebooks_by_authortitle, ebooks_by_filehash, _, _ = self.bench(
+            'process_ebooks_warm', process, repeat=self.args.repeat, items=self.size
+        )
+
+        # reorganise the library; moved files are found in the cache by inode
+        moved_path = '{}-moved'.format(library_path)
+        os.rename(library_path, moved_path)
+        moved = [(moved_path + p[len(library_path):], fmt, source) for p, fmt, source in ebooks]
+        self.bench(
+            'process_ebooks_moved',
+            lambda: _process_ebooks(moved, config['ebook_cache'], config['definitions']),
+            items=self.size,
+        )
+        os.rename(moved_path, library_path)
+        process()
+
+        cache = config['ebook_cache']
+        ebook_objs = ebooks_by_filehash.values()
+
+        self.bench(
+            'cache_get_ebook',
+            lambda: [cache.get_ebook(path=p) for p, _, _ in ebooks],
+            repeat=self.args.repeat, items=self.size,
+        )
+        self.bench(
+            'cache_store_ebook',
+            lambda: [cache.store_ebook(e) for e in ebook_objs],
+            repeat=self.args.repeat, items=len(ebook_objs),
+        )
+        self.bench(
+            'cache_update_ebook_property',
+            lambda: [cache.update_ebook_property(e.path, drmfree=True) for e in ebook_objs],
+            repeat=self.args.repeat, items=len(ebook_objs),
+        )
+
+        self.run_network(config, ebooks_by_authortitle, ebooks_by_filehash)
+
+    def run_network(self, config, ebooks_by_authortitle, ebooks_by_filehash):
+        # imported here as ogreclient.main requires the DeDRM tools
+        from ogreclient.main import sync_with_server
+        from ogreclient.core.upload import query_for_uploads, upload_ebooks
+        from ogreclient.utils.connection import OgreConnection
+
+        with FakeOgreServer() as server:
+            config['host'] = server.parsed_url
+
+            connection = OgreConnection(config)
+            connection.login('bench', 'bench')
+
+            self.bench(
+                'sync_with_server',
+                lambda: sync_with_server(config, connection, ebooks_by_authortitle),
+                repeat=self.args.repeat, items=len(ebooks_by_authortitle),
+            )
+
+            to_upload = query_for_uploads(config, connection)[:self.args.max_uploads]
+            upload_bytes = sum(ebooks_by_filehash[h].size for h in to_upload)
+
+            self.bench(
+                'upload_ebooks',
+                lambda: upload_ebooks(config, connection, ebooks_by_filehash, to_upload),
+                items=len(to_upload), nbytes=upload_bytes,
+            )
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='ogreclient synthetic-library benchmarks')
+    parser.add_argument(
+        '--sizes', default='10000',
+        help='Comma-separated library sizes to benchmark (default: 10000)')
+    parser.add_argument(
+        '--formats', default='epub,mobi,azw3,pdf',
+        help='Comma-separated file formats to generate')
+    parser.add_argument(
+        '--dup-ratio', type=float, default=0.05,
+        help='Fraction of files which are exact duplicates')
+    parser.add_argument(
+        '--depth', type=int, default=2,
+        help='Directory depth of the generated library')
+    parser.add_argument(
+        '--repeat', type=int, default=3,
+        help='Number of runs of each repeatable benchmark; the fastest is recorded')
+    parser.add_argument(
+        '--max-uploads', type=int, default=1000,
+        help='Maximum number of books to upload to the fake server')
+    parser.add_argument(
+        '--seed', type=int, default=1,
+        help='Random seed for library generation')
+    parser.add_argument(
+        '--workdir',
+        help='Directory for generated libraries (default: a temp dir, removed afterwards)')
+    parser.add_argument(
+        '--output', '-o',
+        help='Write JSON results to this file')
+
+    args = parser.parse_args()
+    args.sizes = [int(s) for s in args.sizes.split(',')]
+    args.formats = tuple(args.formats.split(','))
+    return args
+
+
+def main():
+    args = parse_command_line()
+
+    # no progress output from ogreclient during benchmarks
+    CliPrinter.init(quiet=True)
+
+    report = {
+        'ogreclient_version': ogreclient.__version__,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'params': {
+            'formats': args.formats,
+            'dup_ratio': args.dup_ratio,
+            'depth': args.depth,
+            'repeat': args.repeat,
+            'max_uploads': args.max_uploads,
+            'seed': args.seed,
+        },
+        'results': [],
+    }
+
+    for size in args.sizes:
+        workdir = tempfile.mkdtemp(dir=args.workdir)
+        try:
+            suite = Suite(size, workdir, args)
+            suite.run()
+            report['results'] += suite.results
+        finally:
+            shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,311 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import BaseHTTPServer
+import cgi
+import collections
+import gzip
+import hashlib
+import io
+import json
+import SocketServer
+import threading
+from urlparse import urlparse
+
+from ogreclient.utils.delta import apply_delta, signature, DEFAULT_BLOCK_SIZE
+
+
+DEFINITIONS = [
+    ['mobi', True, False, True],
+    ['pdf', False, True, True],
+    ['azw3', True, False, False],
+    ['epub', True, False, False],
+]
+
+
+class FakeOgreServer(object):
+    '''
+    Local stand-in for ogreserver, implementing just enough of the API for a sync
+
+    Book state is held in memory; every endpoint hit and byte received is counted
+    in `stats` so benchmarks and tests can make assertions on the traffic.
+    '''
+    def __init__(self, host='127.0.0.1', port=0, definitions=None):
+        self.definitions = definitions or DEFINITIONS
+        self.lock = threading.Lock()
+        self.reset()
+
+        handler = type(str('Handler'), (_RequestHandler,), {'ogre': self})
+        self.httpd = _ThreadedHTTPServer((host, port), handler)
+        self.thread = None
+
+    def reset(self):
+        with self.lock:
+            # file_hash -> ebook_id for every book the server knows about
+            self.ebooks = {}
+            # file_hashes the server wants uploaded
+            self.pending = set()
+            # file_hash -> bytes of each uploaded file
+            self.uploaded = {}
+            # new file_hash -> previous file_hash, from confirm
+            self.bases = {}
+            self.logs = []
+            self.errord = []
+            self.stats = collections.Counter()
+
+    @property
+    def host(self):
+        return '{}:{}'.format(*self.httpd.server_address)
+
+    @property
+    def url(self):
+        return 'http://{}'.format(self.host)
+
+    @property
+    def parsed_url(self):
+        return urlparse(self.url)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+    def handle_post(self, data):
+        to_update = {}
+
+        with self.lock:
+            for authortitle, ebook in data.iteritems():
+                file_hash = ebook['file_hash']
+
+                if ebook.get('ebook_id') is None:
+                    # new book; assign an ebook_id for the client to write into the metadata
+                    ebook_id = hashlib.md5(authortitle.encode('utf-8')).hexdigest()
+                    to_update[file_hash] = {'ebook_id': ebook_id}
+                else:
+                    ebook_id = ebook['ebook_id']
+
+                self.ebooks[file_hash] = ebook_id
+
+                if file_hash not in self.uploaded:
+                    self.pending.add(file_hash)
+
+        return {'messages': [], 'errors': [], 'to_update': to_update}
+
+    def handle_confirm(self, data):
+        with self.lock:
+            if data['file_hash'] not in self.ebooks:
+                return {'result': 'fail'}
+            if data['file_hash'] == data['new_hash']:
+                return {'result': 'same'}
+
+            self.ebooks[data['new_hash']] = self.ebooks.pop(data['file_hash'])
+            self.bases[data['new_hash']] = data['file_hash']
+
+            if data['file_hash'] in self.pending:
+                self.pending.remove(data['file_hash'])
+                self.pending.add(data['new_hash'])
+            elif data['file_hash'] in self.uploaded:
+                # the new version is wanted too; it can be sent as a delta
+                self.pending.add(data['new_hash'])
+
+        return {'result': 'ok'}
+
+    def handle_to_upload(self):
+        with self.lock:
+            return {'result': sorted(self.pending)}
+
+    def handle_upload(self, fields, content):
+        file_hash = hashlib.md5(content).hexdigest()
+
+        with self.lock:
+            if fields.get('file_hash') != file_hash:
+                return 400, {'result': 'fail'}
+
+            self.pending.discard(file_hash)
+            self.uploaded[file_hash] = content
+
+        return 200, {'result': 'ok'}
+
+    def handle_signatures(self, file_hash):
+        with self.lock:
+            base_hash = self.bases.get(file_hash)
+            base = self.uploaded.get(base_hash)
+
+        if base is None:
+            return {'result': 'none'}
+
+        return {
+            'result': 'ok',
+            'base_hash': base_hash,
+            'block_size': DEFAULT_BLOCK_SIZE,
+            'signatures': signature(io.BytesIO(base), DEFAULT_BLOCK_SIZE),
+        }
+
+    def handle_upload_delta(self, fields, delta):
+        with self.lock:
+            base = self.uploaded.get(fields.get('base_hash'))
+
+        if base is None:
+            return 400, {'result': 'fail'}
+
+        out = io.BytesIO()
+        apply_delta(io.BytesIO(base), io.BytesIO(delta), out)
+
+        # the rebuilt file must match the hash the client is uploading
+        return self.handle_upload(fields, out.getvalue())
+
+    def handle_post_logs(self, raw_logs):
+        with self.lock:
+            self.logs.append(raw_logs)
+        return {'result': 'ok'}
+
+    def handle_upload_errord(self, fields, content):
+        with self.lock:
+            self.errord.append((fields.get('filename'), content))
+        return 200, {'result': 'ok'}
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler, object):
+    protocol_version = 'HTTP/1.1'
+    ogre = None
+
+    def log_message(self, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        if self.headers.getheader('transfer-encoding', '').lower() == 'chunked':
+            body = self._read_chunked()
+        else:
+            body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+
+        with self.ogre.lock:
+            self.ogre.stats['bytes_received'] += len(body)
+
+        # compressed request bodies
+        if self.headers.getheader('content-encoding') == 'gzip':
+            with self.ogre.lock:
+                self.ogre.stats['gzip_requests'] += 1
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+
+        return body
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+            if size == 0:
+                # skip any trailers, up to the blank line
+                while self.rfile.readline().strip():
+                    pass
+                break
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+        return b''.join(chunks)
+
+    def _read_multipart(self):
+        body = self._read_body()
+        form = cgi.FieldStorage(
+            fp=io.BytesIO(body),
+            # length of the decoded body, not the body as sent
+            headers={
+                'content-type': self.headers.getheader('content-type'),
+                'content-length': str(len(body)),
+            },
+            environ={
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': self.headers.getheader('content-type'),
+                'CONTENT_LENGTH': str(len(body)),
+            },
+        )
+        fields = {}
+        content = None
+        for key in form.keys():
+            if form[key].filename is not None:
+                content = form[key].value
+            else:
+                fields[key] = form[key].value.decode('utf-8')
+        return fields, content
+
+    def _endpoint(self):
+        path = urlparse(self.path).path
+        if path.startswith('/api/v1/'):
+            path = path[len('/api/v1/'):]
+        endpoint = path.strip('/')
+        with self.ogre.lock:
+            # count parameterised endpoints (signatures/<file_hash>) under one name
+            self.ogre.stats[endpoint.split('/')[0]] += 1
+        return endpoint
+
+    def do_GET(self):
+        endpoint = self._endpoint()
+
+        if endpoint == 'definitions':
+            self._send_json(self.ogre.definitions)
+        elif endpoint == 'to-upload':
+            self._send_json(self.ogre.handle_to_upload())
+        elif endpoint.startswith('signatures/'):
+            self._send_json(self.ogre.handle_signatures(endpoint.split('/', 1)[1]))
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
+    def do_POST(self):
+        endpoint = self._endpoint()
+
+        if endpoint in ('upload', 'upload-delta', 'upload-errord'):
+            fields, content = self._read_multipart()
+            if endpoint == 'upload':
+                status, data = self.ogre.handle_upload(fields, content)
+            elif endpoint == 'upload-delta':
+                status, data = self.ogre.handle_upload_delta(fields, content)
+            else:
+                status, data = self.ogre.handle_upload_errord(fields, content)
+            self._send_json(data, status=status)
+            return
+
+        if endpoint == 'post-logs':
+            # logs are posted as a gzip-compressed text body
+            body = self._read_body()
+            self._send_json(self.ogre.handle_post_logs(body.decode('utf-8')))
+            return
+
+        data = json.loads(self._read_body() or 'null')
+
+        if endpoint == 'login':
+            self._send_json({
+                'meta': {'code': 200},
+                'response': {'user': {'authentication_token': 'fake-session-key'}},
+            })
+        elif endpoint == 'post':
+            self._send_json(self.ogre.handle_post(data))
+        elif endpoint == 'confirm':
+            self._send_json(self.ogre.handle_confirm(data))
+        else:
+            self._send_json({'error': 'not found'}, status=404)
+
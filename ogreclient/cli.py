@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import argparse
+import cProfile
+import functools
 import logging
 import os
 import sys
@@ -9,11 +11,15 @@ import sys
 from ogreclient import __version__, exceptions
 from ogreclient.config import read_config
 from ogreclient.core.ebook_obj import EbookObject
-from ogreclient.main import scan_and_show_stats, sync
+from ogreclient.core.gc import collect_garbage, maybe_collect_garbage
+from ogreclient.core.snapshot import export_cache, import_cache, parse_rebase
+from ogreclient.main import resume_sync, scan_and_show_stats, show_cache_stats, sync, watch
 from ogreclient.prereqs import setup_ogreclient
 from ogreclient.providers import PROVIDERS
 from ogreclient.utils.dedrm import decrypt, DRM
 from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils import devices, throttle
+from ogreclient.utils.profiler import profiler, write_run_report
 
 
 prntr = CliPrinter.get_printer()
@@ -30,7 +36,7 @@ def entrypoint():
         args = parse_command_line(conf)
 
         # global CLI printer
-        CliPrinter.init(log_output=args.debug)
+        CliPrinter.init(log_output=args.debug, log_dir=conf['config_dir'])
 
         if args.debug:
             prntr.level = logging.DEBUG
@@ -120,7 +126,24 @@ def parse_command_line(conf):
     )
     psync.set_defaults(mode='sync')
 
-    for p in (psync, pinit):
+
+    # setup parser for watch command
+    pwatch = subparsers.add_parser('watch',
+        parents=[parent_parser],
+        help='Synchronise, then keep watching for new or changed ebooks',
+    )
+    pwatch.set_defaults(mode='watch')
+    pwatch.add_argument(
+        '--debounce', type=float, default=2.0, metavar='SECONDS',
+        help='Wait for SECONDS of quiet before syncing a batch of changes')
+    pwatch.add_argument(
+        '--poll', action='store_true',
+        help='Poll the filesystem instead of using inotify')
+    pwatch.add_argument(
+        '--poll-interval', type=float, default=10.0, metavar='SECONDS',
+        help='Seconds between filesystem scans when polling')
+
+    for p in (psync, pinit, pwatch):
         p.add_argument(
             '--host',
             help='Override the default server host of oii.ogre.yt')
@@ -133,9 +156,16 @@ def parse_command_line(conf):
             help=('Your O.G.R.E. password. '
                   'You can also set the environment variable $OGRE_PASS'))
 
+    for p in (psync, pwatch):
+        p.add_argument(
+            '--no-drm', action='store_true',
+            help="Disable DRM removal during sync")
+        p.add_argument(
+            '--max-connections', type=int, metavar='N',
+            help='Make up to N concurrent requests to the OGRE server (default 4)')
     psync.add_argument(
-        '--no-drm', action='store_true',
-        help="Disable DRM removal during sync")
+        '--resume', action='store_true',
+        help='Continue an interrupted sync without rescanning')
     psync.add_argument(
         '--dry-run', '-d', action='store_true',
         help="Dry run the sync; don't actually upload anything to the server")
@@ -147,20 +177,65 @@ def parse_command_line(conf):
         help='Scan your computer for ebooks and see some statistics',
     )
     pscan.set_defaults(mode='scan')
+    pscan.add_argument(
+        '--from-cache', action='store_true',
+        help='Show statistics from the cache as of the last scan, without scanning')
 
 
-    # set ogreserver params which apply to sync & scan
-    for p in (psync, pscan):
+    # setup parser for stats command
+    pstats = subparsers.add_parser('stats',
+        parents=[parent_parser],
+        help='Show statistics of your library from the last scan',
+    )
+    pstats.set_defaults(mode='stats')
+
+
+    # set ogreserver params which apply to sync, watch & scan
+    for p in (psync, pwatch, pscan):
         for provider, data in PROVIDERS.iteritems():
             if 'has_{}'.format(provider) in conf:
                 p.add_argument(
                     '--ignore-{}'.format(provider), action='store_true',
                     help='Ignore ebooks in {}'.format(data['friendly']))
 
+        p.add_argument(
+            '--rediscover', action='store_true',
+            help='Search for ebook providers (Kindle etc) again, rather than using the previous results')
         p.add_argument(
             '--ebook-home', '-H',
             help=('The directory where you keep your ebooks. '
                   'You can also set the environment variable $OGRE_HOME'))
+        p.add_argument(
+            '--limit-upload', metavar='RATE',
+            help='Limit upload bandwidth, eg. 512K or 2M per second')
+        p.add_argument(
+            '--limit-read', metavar='RATE',
+            help='Limit disk reads while hashing and copying ebooks, eg. 10M per second')
+        p.add_argument(
+            '--full-speed-hours', metavar='HH:MM-HH:MM',
+            help='Ignore limits during these hours, eg. 23:00-07:00')
+        p.add_argument(
+            '--device-concurrency', metavar='PATH=N,..',
+            help=('Read at most N files at once from the disk holding PATH, eg. /media/usb=1. '
+                  'By default spinning disks are read one file at a time'))
+        p.add_argument(
+            '--read-order', choices=devices.READ_ORDERS,
+            help=('Order to read the files on each disk: as found (default), by inode, '
+                  'or by physical location on disk where supported'))
+
+    for p in (psync, pscan):
+        p.add_argument(
+            '--profile', action='store_true',
+            help='Print a timing summary of each phase once finished')
+        p.add_argument(
+            '--profile-output', metavar='FILE',
+            help='Write cProfile stats to FILE (implies --profile)')
+        p.add_argument(
+            '--report', metavar='FILE',
+            help='Write a machine-readable report of this run to FILE')
+        p.add_argument(
+            '--report-format', choices=('json', 'jsonl'), default='json',
+            help='Overwrite FILE with a JSON document, or append a JSON line per run')
 
 
     # setup parser for dedrm command
@@ -188,17 +263,61 @@ def parse_command_line(conf):
         help='Ebook for which to display info')
 
 
+    # setup parser for cache command
+    pcache = subparsers.add_parser('cache',
+        help='Maintain the local cache',
+    )
+    cache_subparsers = pcache.add_subparsers()
+
+    pcachegc = cache_subparsers.add_parser('gc',
+        parents=[parent_parser],
+        help='Remove missing books from the cache and compact it',
+    )
+    pcachegc.set_defaults(mode='cache', cache_command='gc')
+    pcachegc.add_argument(
+        '--no-vacuum', action='store_true',
+        help="Don't rebuild the cache file after removing books")
+
+    pcacheexport = cache_subparsers.add_parser('export',
+        parents=[parent_parser],
+        help='Write the cache to a file, for import on another machine',
+    )
+    pcacheexport.set_defaults(mode='cache', cache_command='export')
+    pcacheexport.add_argument(
+        'snapshot',
+        help='Path of the gzipped snapshot file to write')
+
+    pcacheimport = cache_subparsers.add_parser('import',
+        parents=[parent_parser],
+        help='Load a cache snapshot written by "ogre cache export"',
+    )
+    pcacheimport.set_defaults(mode='cache', cache_command='import')
+    pcacheimport.add_argument(
+        'snapshot',
+        help='Path of the snapshot file to load')
+    pcacheimport.add_argument(
+        '--rebase', action='append', type=_rebase_arg, metavar='OLD=NEW',
+        help='Rewrite paths starting with OLD to start with NEW; can be passed more than once')
+
+
     args = parser.parse_args()
 
     if not hasattr(args, 'mode'):
         parser.error('You must pass a subcommand to ogre')
 
-    if args.mode == 'sync' and args.verbose and args.quiet:
+    if args.mode in ('sync', 'watch') and args.verbose and args.quiet:
         parser.error('You cannot specify --verbose and --quiet together!')
 
     return args
 
 
+def _rebase_arg(value):
+    try:
+        return parse_rebase(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
 def main(conf, args):
     # setup config for sync
     conf.update({
@@ -207,6 +326,9 @@ def main(conf, args):
         'verbose': True if args.debug is True else args.verbose,
     })
 
+    if args.mode in ('sync', 'watch', 'scan'):
+        setup_throttle(conf, args)
+
     ret = None
 
     if args.mode == 'init':
@@ -226,21 +348,74 @@ def main(conf, args):
         ret = dedrm_single_ebook(conf, args.inputfile, args.output_dir)
 
     elif args.mode == 'scan':
-        # scan for books and display library stats
-        ret = run_scan(conf)
+        if args.from_cache:
+            # display library stats from the cache; the stats are only returned for --report
+            run_profiled(args, show_cache_stats, conf)
+            ret = 0
+        else:
+            # scan for books and display library stats
+            ret = run_profiled(args, run_scan, conf)
+
+    elif args.mode == 'stats':
+        # display library stats from the cache
+        show_cache_stats(conf)
+        ret = 0
 
     elif args.mode == 'sync':
         # run ogreclient
         conf['no_drm'] = args.no_drm
-        ret = run_sync(conf)
+        conf['max_connections'] = args.max_connections
+        if args.resume:
+            ret = run_profiled(args, functools.partial(run_sync, func=resume_sync), conf)
+        else:
+            ret = run_profiled(args, run_sync, conf)
 
         # print lonely output for quiet mode
         if args.quiet:
             prntr.warning("Sync'd {} ebooks".format(ret))
 
+        # periodically drop books which have been deleted
+        maybe_collect_garbage(conf)
+
+    elif args.mode == 'watch':
+        # sync, then sync changed books until interrupted
+        conf.update({
+            'no_drm': args.no_drm,
+            'max_connections': args.max_connections,
+            'watch_debounce': args.debounce,
+            'watch_polling': args.poll,
+            'watch_poll_interval': args.poll_interval,
+        })
+        ret = run_sync(conf, func=watch)
+
+    elif args.mode == 'cache':
+        ret = run_cache_command(conf, args)
+
     return ret
 
 
+def setup_throttle(conf, args):
+    '''
+    Configure bandwidth and per-disk read limits from the CLI, falling back to app.config
+    '''
+    try:
+        throttle.configure(
+            upload_rate=throttle.parse_rate(args.limit_upload or conf.get('upload_limit') or '0'),
+            read_rate=throttle.parse_rate(args.limit_read or conf.get('read_limit') or '0'),
+            full_speed_hours=args.full_speed_hours or conf.get('full_speed_hours'),
+        )
+    except ValueError as e:
+        raise exceptions.ConfigSetupError('Bad bandwidth limit: {}'.format(e), inner_excp=e)
+
+    try:
+        devices.configure(
+            args.device_concurrency or conf.get('device_concurrency'),
+            read_order=args.read_order or conf.get('read_order'),
+        )
+    except ValueError as e:
+        raise exceptions.ConfigSetupError('Bad disk read setting: {}'.format(e), inner_excp=e)
+
+
 def dedrm_single_ebook(conf, inputfile, output_dir):
     filename, ext = os.path.splitext(inputfile)
 
@@ -268,6 +443,36 @@ def display_info(conf, filepath):
     prntr.info('Book meta', extra=ebook_obj.meta)
 
 
+def run_profiled(args, func, conf):
+    if not args.profile and not args.profile_output and not args.report:
+        return func(conf)
+
+    profiler.enable()
+
+    if args.profile_output:
+        # run under cProfile and dump stats for later analysis with pstats
+        prof = cProfile.Profile()
+        ret = prof.runcall(func, conf)
+        prof.dump_stats(args.profile_output)
+    else:
+        ret = func(conf)
+
+    if args.profile or args.profile_output:
+        # print table of phase timings
+        prntr.info(profiler.report(), tabular=True, notime=True)
+
+    if args.profile_output:
+        prntr.info('Profile stats written to {}'.format(args.profile_output))
+
+    if args.report:
+        try:
+            write_run_report(args.report, fmt=args.report_format, mode=args.mode, result=ret)
+        except IOError as e:
+            prntr.error('Failed writing run report', excp=e)
+
+    return ret
+
+
 def run_scan(conf):
     ret = False
 
@@ -275,28 +480,48 @@ def run_scan(conf):
         ret = scan_and_show_stats(conf)
 
     # print messages on error
-    except exceptions.NoEbooksError:
+    except exceptions.NoEbooksError as e:
+        profiler.error(e)
         prntr.error('No ebooks found. Pass --ebook-home or set $OGRE_HOME.')
     except Exception as e:
+        profiler.error(e)
         prntr.error('Something went very wrong.', excp=e)
 
     return ret
 
 
-def run_sync(conf):
+def run_cache_command(conf, args):
+    try:
+        if args.cache_command == 'gc':
+            collect_garbage(conf, vacuum=not args.no_vacuum)
+        elif args.cache_command == 'export':
+            export_cache(conf, args.snapshot)
+        elif args.cache_command == 'import':
+            import_cache(conf, args.snapshot, rebase=args.rebase)
+    except exceptions.OgreException as e:
+        prntr.error('Failed running cache {}'.format(args.cache_command), excp=e)
+        return 1
+    return 0
+
+
+def run_sync(conf, func=sync):
     uploaded_count = 0
 
     try:
-        uploaded_count = sync(conf)
+        uploaded_count = func(conf)
 
     # print messages on error
     except (exceptions.AuthError, exceptions.SyncError, exceptions.UploadError) as e:
+        profiler.error(e)
         prntr.error('Something went wrong.', excp=e)
-    except exceptions.AuthDeniedError:
+    except exceptions.AuthDeniedError as e:
+        profiler.error(e)
         prntr.error('Permission denied. This is a private system.')
-    except exceptions.NoEbooksError:
+    except exceptions.NoEbooksError as e:
+        profiler.error(e)
         prntr.error('No ebooks found. Pass --ebook-home or set $OGRE_HOME.')
     except Exception as e:
+        profiler.error(e)
         prntr.error('Something went very wrong.', excp=e)
 
     return uploaded_count
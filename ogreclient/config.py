@@ -8,7 +8,11 @@ import os
 import platform
 from urlparse import urlunparse
 
-from ogreclient.providers import PROVIDERS, ProviderFactory
+from ogreclient.providers import PROVIDERS
+
+
+# options in the [limits] section of app.config
+LIMIT_OPTIONS = ('upload_limit', 'read_limit', 'full_speed_hours', 'device_concurrency', 'read_order')
 
 
 def _get_config_dir():
@@ -40,18 +44,26 @@ def write_config(conf):
 
     # create sections for each provider
     for provider in PROVIDERS.keys():
-        if provider in conf['providers']:
+        if provider in conf['providers'] or provider in conf.get('discovered', {}):
             cp.add_section(provider)
 
-    # provider specific config
-    if conf['providers']['kindle']:
-        cp.set('kindle', 'libpath', conf['providers']['kindle'].libpath)
+    # provider discovery results, with the fingerprint they are valid for
+    for provider, saved in conf.get('discovered', {}).iteritems():
+        for key, value in saved.iteritems():
+            cp.set(provider, key, value)
 
     # store ebook scan definitions
     if 'definitions' in conf:
         cp.add_section('definitions')
         cp.set('definitions', 'definitions', serialize_defs(conf['definitions']))
 
+    # bandwidth limits for background runs
+    limits = [key for key in LIMIT_OPTIONS if conf.get(key)]
+    if limits:
+        cp.add_section('limits')
+        for key in limits:
+            cp.set('limits', key, conf[key])
+
     with open(os.path.join(conf['config_dir'], 'app.config'), 'wb') as f_config:
         cp.write(f_config)
 
@@ -86,38 +98,44 @@ def read_config():
         # app.config has been created externally by a script
         return conf
 
-    # extract which providers are already known (used for CLI options)
-    for provider in PROVIDERS.keys():
-        if cp.has_section(provider):
-            conf['has_{}'.format(provider)] = True
+    # provider discovery results from the previous run
+    conf['discovered'] = {
+        provider: dict(cp.items(provider)) for provider in PROVIDERS.keys() if cp.has_section(provider)
+    }
 
-    # provider specific config
-    if cp.has_section('kindle'):
-        try:
-            conf['providers']['kindle'] = ProviderFactory.create(
-                'kindle', libpath=cp.get('kindle', 'libpath')
-            )
-        except ConfigParser.NoOptionError:
-            conf['providers']['kindle'] = None
+    # extract which providers are already known (used for CLI options); a provider
+    # which discovery found not installed is saved with an empty libpath
+    for provider, saved in conf['discovered'].iteritems():
+        if saved.get('libpath', True):
+            conf['has_{}'.format(provider)] = True
 
     # load ebook scan definitions
     conf['definitions'] = deserialize_defs(
         json.loads(cp.get('definitions', 'definitions'))
     )
 
+    # optional bandwidth limits, such as "512K"
+    if cp.has_section('limits'):
+        for key in LIMIT_OPTIONS:
+            if cp.has_option('limits', key):
+                conf[key] = cp.get('limits', key)
+
     return conf
 
 
 def serialize_defs(definitions):
     return json.dumps([
-        [k, v.is_valid_format, v.is_non_fiction]
+        [k, v.is_valid_format, v.is_non_fiction, v.is_compressible]
         for k,v in definitions.iteritems()
     ])
 
 def deserialize_defs(data):
     # namedtuple used for definition entries
-    FormatConfig = collections.namedtuple('FormatConfig', ('is_valid_format', 'is_non_fiction'))
+    FormatConfig = collections.namedtuple(
+        'FormatConfig', ('is_valid_format', 'is_non_fiction', 'is_compressible')
+    )
 
+    # is_compressible is not sent by older ogreservers
     return collections.OrderedDict(
-        [(v[0], FormatConfig(v[1], v[2])) for v in data]
+        [(v[0], FormatConfig(v[1], v[2], v[3] if len(v) > 3 else False)) for v in data]
     )
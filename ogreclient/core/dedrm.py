@@ -9,6 +9,7 @@ from ogreclient.core.ebook_obj import EbookObject
 from ogreclient.utils import make_temp_directory
 from ogreclient.utils.dedrm import decrypt, DRM
 from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.profiler import profiler
 
 
 prntr = CliPrinter.get_printer()
@@ -46,6 +47,8 @@ def clean_all_drm(config, ebooks_by_authortitle, ebooks_by_filehash):
                 del(ebooks_by_filehash[ebook_obj.file_hash])
                 ebooks_by_filehash[new_ebook_obj.file_hash] = new_ebook_obj
                 cleaned += 1
+                profiler.count(items=1, nbytes=new_ebook_obj.size)
+                profiler.incr('decrypted')
 
         # record books which failed decryption
         except exceptions.DeDrmMissingError as e:
@@ -1,25 +1,70 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-import json
 import os
-import shutil
 import subprocess
 import sys
 
 from urllib2 import HTTPError, URLError
 
 from ogreclient import exceptions
-from ogreclient.utils import compute_md5, id_generator, make_temp_directory
+from ogreclient.utils import codec, compute_md5, id_generator, make_temp_directory
+from ogreclient.utils.profiler import profiler
+from ogreclient.utils.throttle import copy_file
+
+
+# table of shared strings; builtin intern() does not accept unicode on py2
+_interned = {}
+
+def _intern(value):
+    if value is None:
+        return None
+    return _interned.setdefault(value, value)
+
+
+class _CachedField(object):
+    '''
+    Descriptor for EbookObject fields which are stored in the cache's data blob.
+    The blob is only decoded on first access of a field not already loaded from
+    its own cache column.
+    '''
+    def __init__(self, name):
+        self.slot = '_{}'.format(name)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            # unset slot; the field is only in the data blob
+            obj._decode_cached_data()
+        return getattr(obj, self.slot)
+
+    def __set__(self, obj, value):
+        if obj._cached_data is not None:
+            obj._decode_cached_data()
+        setattr(obj, self.slot, value)
+
+
+class EbookObject(object):
+    __slots__ = (
+        'path', 'file_hash', 'ebook_id', 'drmfree', 'skip', 'in_cache',
+        '_size', '_authortitle', '_format', '_meta', '_cached_data', '_source',
+    )
 
-
-class EbookObject:
     ebook_home = None
     calibre_ebook_meta_bin = None
 
+    size = _CachedField('size')
+    authortitle = _CachedField('authortitle')
+    format = _CachedField('format')
+    meta = _CachedField('meta')
+
 
     def __init__(self, filepath, file_hash=None, ebook_id=None, size=None, authortitle=None,
                  fmt=None, drmfree=False, skip=False, source=None):
+        self._cached_data = None
         self.path = filepath
         self.file_hash = file_hash
         self.ebook_id = ebook_id
@@ -28,10 +73,10 @@ class EbookObject:
         if fmt is None:
             _, ext = os.path.splitext(filepath)
             fmt = ext[1:]
-        self.format = fmt
+        self.format = _intern(fmt)
         self.drmfree = drmfree
         self.skip = skip
-        self.meta = {'source': source}
+        self.meta = {'source': _intern(source)}
         self.in_cache = False
 
     def __unicode__(self):
@@ -62,27 +107,47 @@ class EbookObject:
     def deserialize(path, cached_obj):
         '''
         Deserialize from a cached object into an EbookObject
+
+        The data blob is held undecoded until one of the fields it contains
+        is accessed; books which are only checked for skip or deduplicated by
+        authortitle, format and size are never decoded.
         '''
-        # parse the data object from the cache entry
         # dictionary indexes defined by SQL query in Cache.get_ebook()
-        data = json.loads(cached_obj[2])
-
-        # return an EbookObject
-        ebook_obj = EbookObject(
-            filepath=path,
-            file_hash=cached_obj[0],
-            ebook_id=cached_obj[1],
-            authortitle=data['authortitle'],
-            fmt=data['format'],
-            size=data['size'],
-            drmfree=bool(cached_obj[3]),
-            skip=bool(cached_obj[4]),
-        )
+        ebook_obj = EbookObject.__new__(EbookObject)
+        ebook_obj.path = path
+        ebook_obj.file_hash = cached_obj[0]
+        ebook_obj.ebook_id = cached_obj[1]
+        ebook_obj.drmfree = bool(cached_obj[3])
+        ebook_obj.skip = bool(cached_obj[4])
         ebook_obj.in_cache = True
-        ebook_obj.meta = data['meta']
+        ebook_obj._cached_data = cached_obj[2]
+
+        # fields which also have their own cache columns
+        if len(cached_obj) > 5 and cached_obj[5] is not None:
+            ebook_obj._format = _intern(cached_obj[5])
+            ebook_obj._size = cached_obj[6]
+            ebook_obj._authortitle = cached_obj[7]
+
+        # the source is stored per path, rather than in the blob shared by copies of a book
+        ebook_obj._source = cached_obj[9] if len(cached_obj) > 9 else None
         return ebook_obj
 
 
+    def _decode_cached_data(self):
+        # parse the data object from the cache entry
+        data = codec.decode(self._cached_data)
+        self._cached_data = None
+
+        self._authortitle = data['authortitle']
+        self._format = _intern(data['format'])
+        self._size = data['size']
+        self._meta = data['meta']
+
+        # blobs written before the source moved to its own column still carry it
+        if self._meta is not None and (self._source is not None or 'source' in self._meta):
+            self._meta['source'] = _intern(self._source or self._meta['source'])
+
+
     def serialize(self, for_cache=False):
         '''
         Serialize the EbookObject for sending or caching
@@ -101,6 +166,9 @@ class EbookObject:
             # different serialisation for writing the local ogreclient cache
             del(data['file_hash'])
             data['authortitle'] = self.authortitle
+            if self.meta is not None:
+                # the source is cached per path, as copies of a book may come from different providers
+                data['meta'] = {k: v for k, v in self.meta.iteritems() if k != 'source'}
 
         return data
 
@@ -112,9 +180,17 @@ class EbookObject:
         return self.file_hash, self.size
 
 
-    def get_metadata(self):
-        # extract and parse ebook metadata
-        self.meta.update(self._metadata_extract())
+    def get_metadata(self, meta=None):
+        if meta is None:
+            # extract and parse ebook metadata
+            meta = self._metadata_extract()
+        else:
+            # metadata already read by the provider, eg. from a calibre library
+            meta = dict(meta)
+            self.drmfree = meta.pop('drmfree', self.drmfree)
+            self.ebook_id = meta.get('ebook_id', self.ebook_id)
+
+        self.meta.update(meta)
 
         # delimit fields with non-printable chars
         self.authortitle = '{}\u0006{}\u0007{}'.format(
@@ -130,18 +206,19 @@ class EbookObject:
         if not os.path.exists(self.path):
             raise exceptions.EbookMissingError('File missing: {}'.format(self.path))
 
-        # call ebook-metadata
-        proc = subprocess.Popen(
-            '{} "{}"'.format(
-                EbookObject.calibre_ebook_meta_bin, self.path.replace('"', '\\"')
-            ).encode(fs_encoding),
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
+        with profiler.call('subprocess'):
+            # call ebook-metadata
+            proc = subprocess.Popen(
+                '{} "{}"'.format(
+                    EbookObject.calibre_ebook_meta_bin, self.path.replace('"', '\\"')
+                ).encode(fs_encoding),
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
 
-        # get raw bytes from stdout and stderr
-        out_bytes, err_bytes = proc.communicate()
+            # get raw bytes from stdout and stderr
+            out_bytes, err_bytes = proc.communicate()
 
         if err_bytes.find(bytes('Traceback')) > 0:
             raise exceptions.CorruptEbookError(self, err_bytes)
@@ -272,7 +349,7 @@ class EbookObject:
         with make_temp_directory() as temp_dir:
             # copy the ebook to a temp file
             temp_file_path = '{}{}'.format(os.path.join(temp_dir, id_generator()), fmt)
-            shutil.copy(self.path, temp_file_path)
+            copy_file(self.path, temp_file_path)
 
             try:
                 # write the OGRE id into the ebook's metadata
@@ -298,7 +375,7 @@ class EbookObject:
 
                 if data['result'] == 'ok':
                     # move file back into place
-                    shutil.copy(temp_file_path, self.path)
+                    copy_file(temp_file_path, self.path)
                     self.file_hash = new_hash
                     return new_hash
 
@@ -325,23 +402,25 @@ class EbookObject:
             new_tags = 'ogre_id={}'.format(self.ebook_id)
 
         # write ogre_id to --tags
-        subprocess.check_output(
-            [EbookObject.calibre_ebook_meta_bin, temp_file_path, '--tags', new_tags],
-            stderr=subprocess.STDOUT
-        )
+        with profiler.call('subprocess'):
+            subprocess.check_output(
+                [EbookObject.calibre_ebook_meta_bin, temp_file_path, '--tags', new_tags],
+                stderr=subprocess.STDOUT
+            )
 
 
     def _write_metadata_identifier(self, temp_file_path):
         # write ogre_id to identifier metadata
-        subprocess.check_output(
-            [
-                EbookObject.calibre_ebook_meta_bin,
-                temp_file_path,
-                '--identifier',
-                'ogre_id:{}'.format(self.ebook_id)
-            ],
-            stderr=subprocess.STDOUT
-        )
+        with profiler.call('subprocess'):
+            subprocess.check_output(
+                [
+                    EbookObject.calibre_ebook_meta_bin,
+                    temp_file_path,
+                    '--identifier',
+                    'ogre_id:{}'.format(self.ebook_id)
+                ],
+                stderr=subprocess.STDOUT
+            )
 
 
     def add_dedrm_tag(self):
@@ -361,7 +440,7 @@ class EbookObject:
 
             # copy the ebook to a temp file
             tmp_name = '{}{}'.format(os.path.join(temp_dir, id_generator()), fmt)
-            shutil.copy(self.path, tmp_name)
+            copy_file(self.path, tmp_name)
 
             try:
                 # append DeDRM to the tags list
@@ -371,13 +450,14 @@ class EbookObject:
                     new_tags = 'OGRE-DeDRM'
 
                 # write DeDRM to --tags
-                subprocess.check_output(
-                    [EbookObject.calibre_ebook_meta_bin, tmp_name, '--tags', new_tags],
-                    stderr=subprocess.STDOUT
-                )
+                with profiler.call('subprocess'):
+                    subprocess.check_output(
+                        [EbookObject.calibre_ebook_meta_bin, tmp_name, '--tags', new_tags],
+                        stderr=subprocess.STDOUT
+                    )
 
                 # move file back into place
-                shutil.copy(tmp_name, self.path)
+                copy_file(tmp_name, self.path)
 
                 self.drmfree = True
 
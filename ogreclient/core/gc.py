@@ -0,0 +1,132 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import contextlib
+import datetime
+import os
+
+from ogreclient import exceptions
+from ogreclient.utils import imap_unordered
+from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.profiler import profiler
+
+
+prntr = CliPrinter.get_printer()
+
+# days between automatic collections after a sync
+GC_INTERVAL_DAYS = 7
+
+# days to keep books on a drive which is not mounted
+GC_TOMBSTONE_DAYS = 90
+
+# concurrent stat calls; high, as they mostly wait on the disk or network
+GC_STAT_THREADS = 16
+GC_STAT_BATCH = 256
+
+
+def collect_garbage(config, vacuum=True):
+    """
+    Remove cached books whose files no longer exist, then compact the cache.
+
+    A book on a drive which is not mounted is marked missing rather than removed,
+    and only removed once it has been missing for GC_TOMBSTONE_DAYS.
+
+    params:
+        config: dict
+        vacuum: bool, rebuild the cache file to reclaim space
+    returns:
+        tuple of dicts, cache usage before and after
+    """
+    ebook_cache = config['ebook_cache']
+    now = datetime.datetime.utcnow()
+    expired = (now - datetime.timedelta(days=GC_TOMBSTONE_DAYS)).isoformat()
+
+    before = ebook_cache.get_usage()
+
+    remove, tombstone, restore = [], [], []
+
+    candidates = ebook_cache.get_gc_candidates()
+    batches = [candidates[i:i+GC_STAT_BATCH] for i in range(0, len(candidates), GC_STAT_BATCH)]
+
+    with profiler.phase('gc_stat'):
+        with contextlib.closing(imap_unordered(_check_batch, batches, GC_STAT_THREADS)) as results:
+            for batch in results:
+                for (path, _, missing_since), state in batch:
+                    if state == 'present':
+                        if missing_since is not None:
+                            restore.append(path)
+                    elif state == 'missing':
+                        remove.append(path)
+                    elif missing_since is None:
+                        tombstone.append(path)
+                    elif missing_since < expired:
+                        remove.append(path)
+
+    orphans = ebook_cache.gc_ebooks(remove, tombstone, restore, now.isoformat())
+    profiler.incr('gc_removed', len(remove))
+
+    if vacuum:
+        with profiler.phase('gc_vacuum'):
+            ebook_cache.vacuum()
+
+    ebook_cache.set_last_gc(now.isoformat())
+    after = ebook_cache.get_usage()
+
+    prntr.info('Cleaned up the cache', extra=[
+        'Removed {} missing books and {} unused metadata'.format(len(remove), orphans),
+        '{} books on drives not currently mounted'.format(after['missing']),
+        'Books: {} -> {}'.format(before['ebooks'], after['ebooks']),
+        'Size: {:.1f}MB -> {:.1f}MB'.format(before['size'] / 1048576.0, after['size'] / 1048576.0),
+    ])
+
+    return before, after
+
+
+def maybe_collect_garbage(config):
+    """
+    Collect garbage if it has not been done in the last GC_INTERVAL_DAYS
+    """
+    ebook_cache = config['ebook_cache']
+
+    try:
+        last_gc = ebook_cache.get_last_gc()
+
+        if last_gc is None:
+            # start the interval from the first run
+            ebook_cache.set_last_gc(datetime.datetime.utcnow().isoformat())
+            return
+
+        due = datetime.datetime.utcnow() - datetime.timedelta(days=GC_INTERVAL_DAYS)
+        if last_gc < due.isoformat():
+            collect_garbage(config)
+
+    except exceptions.OgreException as e:
+        prntr.error('Failed cleaning up the cache', excp=e)
+
+
+def _check_batch(batch):
+    return [(item, _check_path(item[0], item[1])) for item in batch]
+
+
+def _check_path(path, dev):
+    """
+    Return 'present' if the file exists, 'missing' if it was removed, or
+    'unmounted' if the device it was on is not currently mounted, or is unknown
+    """
+    if os.path.exists(path):
+        return 'present'
+
+    if dev is None:
+        # cached before devices were recorded, and not scanned since; the drive may
+        # have been unplugged all along, so keep the book as if it were
+        return 'unmounted'
+
+    # find the nearest directory which still exists
+    parent = os.path.dirname(path)
+    while not os.path.exists(parent) and parent != os.path.dirname(parent):
+        parent = os.path.dirname(parent)
+
+    try:
+        return 'missing' if os.stat(parent).st_dev == dev else 'unmounted'
+    except OSError:
+        return 'unmounted'
@@ -1,12 +1,16 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import contextlib
 import os
 
 from ogreclient import exceptions
 from ogreclient.core.ebook_obj import EbookObject
-from ogreclient.providers import LibProvider, PathsProvider
+from ogreclient.providers import LibProvider
+from ogreclient.utils import imap_unordered
+from ogreclient.utils.devices import imap_by_device
 from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.profiler import profiler
 
 
 prntr = CliPrinter.get_printer()
@@ -19,9 +23,16 @@ def scan_for_ebooks(config):
     params:
         config: dict
     """
-    ebooks = _find_ebooks(config['providers'], config['definitions'], config['verbose'])
+    ebooks = _find_ebooks(
+        config['providers'],
+        config['definitions'],
+        config['verbose'],
+        ebook_cache=None if config['skip_cache'] else config['ebook_cache']
+    )
 
     prntr.info('Discovered {} files'.format(len(ebooks)), bold=True)
+    profiler.count(items=len(ebooks))
+    profiler.incr('discovered', len(ebooks))
     if len(ebooks) == 0:
         raise exceptions.NoEbooksError
 
@@ -30,65 +41,248 @@ def scan_for_ebooks(config):
         config['ebook_cache'],
         config['definitions'],
         skip_cache=config['skip_cache'],
-        verbose=config['verbose']
+        verbose=config['verbose'],
+        metadata=_preload_metadata(config['providers'], config['definitions']),
     )
 
 
-def _find_ebooks(providers, definitions, verbose=False):
+def _find_ebooks(providers, definitions, verbose=False, ebook_cache=None):
     """
-    Find ebooks in directories given by providers.
+    Find ebooks from the providers. Providers whose change token matches the
+    previous scan are not enumerated again; the rest are enumerated concurrently.
 
     params:
         providers: dict
         definitions: dict
         verbose: bool
+        ebook_cache: Cache object, or None to enumerate every provider
     returns:
         list of tuple (path, suffix, provider_name)
     """
+    found = {}
+    to_scan = []
+
+    for name, provider in providers.iteritems():
+        if provider is None:
+            continue
+
+        token = provider.change_token()
+        if token is not None:
+            # the stored listing is filtered by format, and ogreserver may add new formats
+            token = '{}:{}'.format(token, ','.join(sorted(definitions)))
+
+        if ebook_cache is not None and token is not None:
+            found[name] = ebook_cache.get_provider_listing(name, token)
+            if found[name] is not None:
+                if verbose:
+                    prntr.info('{} unchanged since last scan'.format(provider.friendly))
+                profiler.incr('providers_unchanged')
+                continue
+
+        if verbose:
+            prntr.info('Scanning {}'.format(provider.friendly))
+
+        to_scan.append((name, provider, token))
+
+    def _enumerate(item):
+        name, provider, token = item
+        return name, token, list(provider.iter_ebooks(definitions))
+
+    with contextlib.closing(imap_unordered(_enumerate, to_scan, max(len(to_scan), 1))) as results:
+        for name, token, ebooks in results:
+            found[name] = ebooks
+            if ebook_cache is not None and token is not None:
+                ebook_cache.store_provider_listing(name, token, ebooks)
+
     ebooks = []
+    seen = set()
+
+    # keep the order stable between runs, as the first of any duplicates wins
+    for name in providers:
+        if providers[name] is None:
+            continue
+
+        for ebook in found[name]:
+            # a calibre library may also be within ebook_home
+            if ebook[0] not in seen:
+                seen.add(ebook[0])
+                ebooks.append(ebook)
+
+    return ebooks
 
-    def _process_filename(filename, provider_name):
-        fn, ext = os.path.splitext(filename)
-        # check file not hidden, is in list of known file suffixes
-        if fn[1:1] != '.' and ext[1:] in definitions.keys():
-            ebooks.append(
-                (os.path.join(root, filename), ext[1:], provider_name)
-            )
 
+def _preload_metadata(providers, definitions):
+    """
+    Collect metadata which providers can supply in bulk, such as from a calibre library.
+
+    returns:
+        dict of path:meta
+    """
+    metadata = {}
     for provider in providers.itervalues():
-        # a LibProvider contains a single directory containing ebooks
-        if isinstance(provider, LibProvider):
-            if verbose:
-                prntr.info('Scanning {} in {}'.format(provider.friendly, provider.libpath))
+        if provider is not None:
+            metadata.update(provider.bulk_metadata(definitions))
+    return metadata
 
-            for root, _, files in os.walk(provider.libpath):
-                for filename in files:
-                    _process_filename(filename, provider.friendly)
 
-        # a PathsProvider contains a list of direct ebook paths
-        elif isinstance(provider, PathsProvider):
-            if verbose:
-                prntr.info('Scanning {}'.format(provider.friendly))
+def _find_changed_ebooks(paths, providers, definitions):
+    """
+    Filter a set of changed paths down to ebooks within the configured providers.
 
-            for path in provider.paths:
-                _process_filename(filename, provider.friendly)
+    params:
+        paths: iterable of paths reported by a watcher
+        providers: dict
+        definitions: dict
+    returns:
+        list of tuple (path, suffix, provider_name)
+    """
+    roots = [
+        (os.path.join(provider.libpath, ''), provider.friendly)
+        for provider in providers.itervalues() if isinstance(provider, LibProvider)
+    ]
+
+    ebooks = []
+
+    for path in sorted(paths):
+        fn, ext = os.path.splitext(os.path.basename(path))
+
+        # check file not hidden, is in list of known file suffixes, still exists
+        if fn[0:1] == '.' or ext[1:] not in definitions.keys() or not os.path.isfile(path):
+            continue
+
+        for root, provider_name in roots:
+            if path.startswith(root):
+                ebooks.append((path, ext[1:], provider_name))
+                break
 
     return ebooks
 
 
-def _process_ebooks(ebooks, ebook_cache, definitions, skip_cache=False, verbose=False):
+def _find_in_cache(ebook_cache, path):
+    """
+    Load an ebook from the cache by path, or by the inode of a renamed or moved file.
+
+    raises:
+        MissingFromCacheError if the file is new or has changed
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        raise exceptions.MissingFromCacheError
+
+    try:
+        ebook_obj = ebook_cache.get_ebook(path=path, st=st)
+        profiler.incr('cache_hits')
+
+    except exceptions.MissingFromCacheError:
+        # a moved file costs a stat, rather than a hash and metadata extraction
+        ebook_obj = ebook_cache.find_moved_ebook(path, st)
+        profiler.incr('cache_moved')
+
+    return ebook_obj
+
+
+def _read_ebook(ebook_cache, item, skip_cache=False, meta=None):
+    """
+    Load an ebook from the cache, or hash it and extract its metadata.
+    Called concurrently, by a pool of readers per device.
+
+    returns:
+        tuple of (EbookObject, CorruptEbookError or None, bytes read)
+    """
+    try:
+        # optionally skip the cache
+        if skip_cache is True:
+            raise exceptions.MissingFromCacheError
+
+        return _find_in_cache(ebook_cache, item[0]), None, 0
+
+    except exceptions.MissingFromCacheError:
+        profiler.incr('cache_misses')
+
+    # init the EbookObject
+    ebook_obj = EbookObject(
+        filepath=item[0],
+        fmt=item[1],
+        source=item[2],
+    )
+    # calculate MD5 of ebook
+    ebook_obj.compute_md5()
+    profiler.count(nbytes=ebook_obj.size)
+    profiler.incr('hashed')
+    profiler.incr('bytes_hashed', ebook_obj.size)
+
+    try:
+        if skip_cache is True:
+            raise exceptions.MissingFromCacheError
+
+        # the same book may have been seen before at another path, eg. copied
+        # from another filesystem
+        ebook_obj = ebook_cache.get_ebook_by_content(item[0], ebook_obj.file_hash, source=item[2])
+        profiler.incr('cache_content_hits')
+        return ebook_obj, None, ebook_obj.size
+
+    except exceptions.MissingFromCacheError:
+        try:
+            # extract ebook metadata and build key; books are stored in a dict
+            # with 'authortitle' as the key in a naive attempt at de-duplication
+            ebook_obj.get_metadata(meta)
+
+        except exceptions.CorruptEbookError as e:
+            return ebook_obj, e, ebook_obj.size
+
+    return ebook_obj, None, ebook_obj.size
+
+
+def _report_progress(results, total, verbose=False):
+    """
+    Print progress as books are read; which is not the order they are deduplicated
+    in, when read concurrently or in disk order
+    """
+    bytes_read = 0
+    for i, (indexed, (ebook_obj, error, nbytes)) in enumerate(results, 1):
+        bytes_read += nbytes
+        if verbose:
+            prntr.info('Meta data scanning {}'.format(ebook_obj.path))
+        else:
+            prntr.progressf(num_blocks=i, total_size=total, nbytes=bytes_read)
+        yield indexed, (ebook_obj, error)
+
+
+def _in_order(results):
+    """
+    Reorder (index, result) pairs from concurrent readers into index order, so
+    that the first of any duplicate books found is always the same
+    """
+    pending = {}
+    i = 0
+    for (index, _), result in results:
+        pending[index] = result
+        while i in pending:
+            yield pending.pop(i)
+            i += 1
+
+
+def _process_ebooks(ebooks, ebook_cache, definitions, skip_cache=False, verbose=False, metadata=None):
     """
     Process found ebook tuples into EbookObjects, using application cache.
     Extract metadata and calculate MD5 checksums.
 
+    Books are read concurrently, by a pool of readers for each device sized by
+    ogreclient.utils.devices and in its read order, then deduplicated in the
+    order they were found.
+
     params:
         ebooks: list of tuple from `_find_ebooks`
         ebook_cache: Cache object
         definitions: dict
         skip_cache: bool
         verbose: bool
+        metadata: dict of path:meta from `_preload_metadata`
     """
-    i = 0
+    if metadata is None:
+        metadata = {}
+
     skipped = 0
 
     prntr.info('Scanning ebook meta data..')
@@ -96,99 +290,76 @@ def _process_ebooks(ebooks, ebook_cache, definitions, skip_cache=False, verbose=
     ebooks_by_filehash = {}
     errord_list = []
 
-    for item in ebooks:
-        if verbose:
-            prntr.info('Meta data scanning {}'.format(item[0]))
+    def _read(indexed):
+        item = indexed[1]
+        return _read_ebook(ebook_cache, item, skip_cache=skip_cache, meta=metadata.get(item[0]))
 
-        try:
-            # optionally skip the cache
-            if skip_cache is True:
-                raise exceptions.MissingFromCacheError
-
-            # get ebook from the cache
-            ebook_obj = ebook_cache.get_ebook(path=item[0])
-
-        except exceptions.MissingFromCacheError:
-            # init the EbookObject
-            ebook_obj = EbookObject(
-                filepath=item[0],
-                fmt=item[1],
-                source=item[2],
-            )
-            # calculate MD5 of ebook
-            ebook_obj.compute_md5()
+    results = imap_by_device(_read, list(enumerate(ebooks)), path=lambda indexed: indexed[1][0])
 
-            try:
-                # extract ebook metadata and build key; books are stored in a dict
-                # with 'authortitle' as the key in a naive attempt at de-duplication
-                ebook_obj.get_metadata()
-
-            except exceptions.CorruptEbookError as e:
+    with contextlib.closing(results):
+        for ebook_obj, error in _in_order(_report_progress(results, len(ebooks), verbose)):
+            if error is not None:
                 # record books which failed during scan
-                errord_list.append(e)
+                errord_list.append(error)
 
                 # add book to the cache as a skip
                 ebook_obj.skip = True
                 ebook_cache.store_ebook(ebook_obj)
 
-        # skip previously scanned books which are marked skip (DRM'd or duplicates)
-        if ebook_obj.skip:
-            skipped += 1
-            i += 1
-            prntr.progressf(num_blocks=i, total_size=len(ebooks))
-            continue
-
-        # check for identical filehash (exact duplicate) or duplicated authortitle/format
-        if ebook_obj.file_hash in ebooks_by_filehash.keys():
-            # warn user on error stack
-            errord_list.append(
-                exceptions.ExactDuplicateEbookError(
-                    ebook_obj, ebooks_by_authortitle[ebook_obj.authortitle].path
+            # skip previously scanned books which are marked skip (DRM'd or duplicates)
+            if ebook_obj.skip:
+                skipped += 1
+                continue
+
+            # check for identical filehash (exact duplicate) or duplicated authortitle/format
+            if ebook_obj.file_hash in ebooks_by_filehash.keys():
+                # warn user on error stack
+                errord_list.append(
+                    exceptions.ExactDuplicateEbookError(
+                        ebook_obj, ebooks_by_authortitle[ebook_obj.authortitle].path
+                    )
                 )
-            )
-        elif ebook_obj.authortitle in ebooks_by_authortitle.keys() and ebooks_by_authortitle[ebook_obj.authortitle].format == ebook_obj.format:
-            # warn user on error stack
-            errord_list.append(
-                exceptions.AuthortitleDuplicateEbookError(
-                    ebook_obj, ebooks_by_authortitle[ebook_obj.authortitle].path
+            elif ebook_obj.authortitle in ebooks_by_authortitle.keys() and ebooks_by_authortitle[ebook_obj.authortitle].format == ebook_obj.format:
+                # warn user on error stack
+                errord_list.append(
+                    exceptions.AuthortitleDuplicateEbookError(
+                        ebook_obj, ebooks_by_authortitle[ebook_obj.authortitle].path
+                    )
                 )
-            )
-        else:
-            # new ebook, or different format of duplicate ebook found
-            write = False
-
-            if ebook_obj.authortitle in ebooks_by_authortitle.keys():
-                # compare the rank of the format already found against this one
-                existing_rank = definitions.keys().index(ebooks_by_authortitle[ebook_obj.authortitle].format)
-                new_rank = definitions.keys().index(ebook_obj.format)
-
-                # lower is better
-                if new_rank < existing_rank:
-                    write = True
             else:
-                # new book found
-                write = True
+                # new ebook, or different format of duplicate ebook found
+                write = False
+
+                if ebook_obj.authortitle in ebooks_by_authortitle.keys():
+                    # compare the rank of the format already found against this one
+                    existing_rank = definitions.keys().index(ebooks_by_authortitle[ebook_obj.authortitle].format)
+                    new_rank = definitions.keys().index(ebook_obj.format)
+
+                    # lower is better
+                    if new_rank < existing_rank:
+                        write = True
+                else:
+                    # new book found
+                    write = True
 
-            if write:
-                # output dictionary for sending to ogreserver
-                ebooks_by_authortitle[ebook_obj.authortitle] = ebook_obj
+                if write:
+                    # output dictionary for sending to ogreserver
+                    ebooks_by_authortitle[ebook_obj.authortitle] = ebook_obj
 
-                # track all unique file hashes found
-                ebooks_by_filehash[ebook_obj.file_hash] = ebook_obj
-            else:
-                ebook_obj.skip = True
+                    # track all unique file hashes found
+                    ebooks_by_filehash[ebook_obj.file_hash] = ebook_obj
+                else:
+                    ebook_obj.skip = True
 
-        try:
-            # add book to the cache
-            ebook_cache.store_ebook(ebook_obj)
+            try:
+                # add book to the cache
+                ebook_cache.store_ebook(ebook_obj)
 
-        except exceptions.EbookIdDuplicateEbookError as e:
-            # handle duplicate books with same ebook_id in metadata
-            errord_list.append(e)
+            except exceptions.EbookIdDuplicateEbookError as e:
+                # handle duplicate books with same ebook_id in metadata
+                errord_list.append(e)
 
-        i += 1
-        if verbose is False:
-            prntr.progressf(num_blocks=i, total_size=len(ebooks))
+    profiler.incr('skipped', skipped)
 
     if len(ebooks_by_authortitle) == 0:
         return {}, {}, errord_list, skipped
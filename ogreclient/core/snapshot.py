@@ -0,0 +1,177 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import contextlib
+import gzip
+import json
+import os
+
+from ogreclient import exceptions
+from ogreclient.utils import imap_unordered
+from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.profiler import profiler
+
+
+prntr = CliPrinter.get_printer()
+
+# version of the snapshot file format
+SNAPSHOT_VERSION = 1
+
+# seconds by which a copied file's mtime may differ; copies lose sub-second
+# precision, and FAT stores mtimes to two seconds
+SNAPSHOT_MTIME_SLACK = 2
+
+SNAPSHOT_STAT_THREADS = 16
+SNAPSHOT_STAT_BATCH = 256
+
+
+def export_cache(config, filepath):
+    '''
+    Write the cache to a gzipped JSON lines file, which can be imported on another
+    machine or after the library has moved
+
+    The first line is a header, followed by a line per metadata ("content") row,
+    then a line per path ("ebook") row.
+
+    returns:
+        number of books exported
+    '''
+    contents, ebooks = config['ebook_cache'].get_snapshot_rows()
+
+    try:
+        with contextlib.closing(gzip.open(filepath, 'wb')) as f:
+            f.write(_dumps({'ogre_cache_snapshot': SNAPSHOT_VERSION}))
+            for row in contents:
+                row['type'] = 'content'
+                f.write(_dumps(row))
+            for row in ebooks:
+                row['type'] = 'ebook'
+                f.write(_dumps(row))
+
+    except IOError as e:
+        raise SnapshotError('Failed writing {}'.format(filepath), inner_excp=e)
+
+    prntr.info('Exported {} books to {}'.format(len(ebooks), filepath))
+    return len(ebooks)
+
+
+def import_cache(config, filepath, rebase=None):
+    '''
+    Load a snapshot written by export_cache() into the cache
+
+    Each book is checked against the file at its (rebased) path. Books whose file
+    has the same size and mtime, to within a couple of seconds, are cache hits on
+    the next scan. When only the mtime differs, as after a plain copy, the book is
+    hashed again on the next scan and its metadata is found by content, without
+    being extracted again. Missing or resized files are not imported.
+
+    params:
+        config: dict
+        filepath: str
+        rebase: list of (old, new) path prefixes
+    returns:
+        number of books imported
+    '''
+    contents, ebooks = _read_snapshot(filepath)
+
+    for row in ebooks:
+        row['path'] = rebase_path(row['path'], rebase or [])
+
+    batches = [ebooks[i:i+SNAPSHOT_STAT_BATCH] for i in range(0, len(ebooks), SNAPSHOT_STAT_BATCH)]
+
+    imported, rehash, skipped = [], 0, 0
+
+    with profiler.phase('snapshot_stat'):
+        with contextlib.closing(imap_unordered(_stat_batch, batches, SNAPSHOT_STAT_THREADS)) as results:
+            for batch in results:
+                for row, st in batch:
+                    if st is None or st.st_size != row['size']:
+                        skipped += 1
+                        continue
+
+                    row['dev'], row['inode'] = st.st_dev, st.st_ino
+                    if row['mtime'] is not None and abs(st.st_mtime - row['mtime']) <= SNAPSHOT_MTIME_SLACK:
+                        row['mtime'] = st.st_mtime
+                    else:
+                        # no mtime forces a rehash on the next scan
+                        row['mtime'] = None
+                        rehash += 1
+                    imported.append(row)
+
+    # only metadata for the imported books
+    hashes = {row['file_hash'] for row in imported}
+    contents = [row for row in contents if row['file_hash'] in hashes]
+
+    config['ebook_cache'].import_snapshot_rows(contents, imported)
+
+    prntr.info('Imported {} books from {}'.format(len(imported), filepath), extra=[
+        '{} books will be hashed again on the next scan'.format(rehash),
+        '{} books were missing or changed, and were not imported'.format(skipped),
+    ])
+    return len(imported)
+
+
+def rebase_path(path, rebase):
+    '''
+    Replace the first matching (old, new) prefix of path
+    '''
+    for old, new in rebase:
+        prefix = old.rstrip(os.sep) + os.sep
+        if path == old.rstrip(os.sep):
+            return new
+        if path.startswith(prefix):
+            return os.path.join(new, path[len(prefix):])
+    return path
+
+
+def parse_rebase(value):
+    '''
+    Parse an OLD=NEW argument into a tuple
+    '''
+    old, sep, new = value.partition('=')
+    if not sep or not old or not new:
+        raise ValueError('Expected OLD=NEW, got {}'.format(value))
+    return old, new
+
+
+def _read_snapshot(filepath):
+    contents, ebooks = [], []
+
+    try:
+        with contextlib.closing(gzip.open(filepath, 'rb')) as f:
+            header = json.loads(f.readline() or 'null')
+            if not isinstance(header, dict) or 'ogre_cache_snapshot' not in header:
+                raise SnapshotError('{} is not an ogre cache snapshot'.format(filepath))
+            if header['ogre_cache_snapshot'] > SNAPSHOT_VERSION:
+                raise SnapshotError('{} was written by a newer ogreclient'.format(filepath))
+
+            for line in f:
+                row = json.loads(line)
+                kind = row.pop('type')
+                if kind == 'content':
+                    contents.append(row)
+                elif kind == 'ebook':
+                    ebooks.append(row)
+
+    except (IOError, ValueError, KeyError) as e:
+        raise SnapshotError('Failed reading {}'.format(filepath), inner_excp=e)
+
+    return contents, ebooks
+
+
+def _stat_batch(batch):
+    results = []
+    for row in batch:
+        try:
+            results.append((row, os.stat(row['path'])))
+        except OSError:
+            results.append((row, None))
+    return results
+
+
+def _dumps(obj):
+    return json.dumps(obj, separators=(',', ':')) + b'\n'
+
+
+class SnapshotError(exceptions.OgreException):
+    pass
@@ -1,18 +1,36 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import contextlib
+import os
+import zlib
+
 from ogreclient import exceptions
-from ogreclient.utils import retry
+from ogreclient.utils import devices, make_temp_directory, retry
+from ogreclient.utils.delta import compute_delta
 from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.profiler import profiler
+from ogreclient.utils.throttle import read_limiter, ThrottledFile
 
 
 prntr = CliPrinter.get_printer()
 
+# deltas with more literal data than this fraction of the file are not worth sending
+DELTA_MAX_LITERAL_RATIO = 0.5
+# larger files are always uploaded whole; computing a delta is CPU bound, and
+# holds up the other upload threads
+DELTA_MAX_SIZE = 8388608
+# bytes sampled from the start of a file when deciding whether to compress its upload
+COMPRESS_SAMPLE_SIZE = 262144
+# uploads are compressed only when the sample shrinks below this fraction of its size
+COMPRESS_MAX_RATIO = 0.9
+
 
 def query_for_uploads(config, connection):
     try:
         # query ogreserver for books to upload
         data = connection.request('to-upload')
+        profiler.count(items=len(data['result']))
         return data['result']
 
     except exceptions.RequestError as e:
@@ -25,6 +43,14 @@ def upload_ebooks(config, connection, ebooks_by_filehash, ebooks_to_upload):
 
     @retry(times=3)
     def upload_single_book(connection, ebook_obj):
+        try:
+            # send only the changes against a previous version on ogreserver, if possible
+            if upload_delta(connection, ebook_obj):
+                return
+
+        except exceptions.RequestError as e:
+            prntr.debug('Delta upload failed for {}: {}'.format(ebook_obj.path, e))
+
         try:
             connection.upload(
                 'upload',
@@ -34,6 +60,7 @@ def upload_ebooks(config, connection, ebooks_by_filehash, ebooks_to_upload):
                     'file_hash': ebook_obj.file_hash,
                     'format': ebook_obj.format,
                 },
+                compress=is_worth_compressing(config, ebook_obj),
             )
 
         except exceptions.RequestError as e:
@@ -47,30 +74,42 @@ def upload_ebooks(config, connection, ebooks_by_filehash, ebooks_to_upload):
     prntr.info('Uploading {} file{}. Go make a brew.'.format(len(ebooks_to_upload), plural), bold=True)
 
     success, i = 0, 0
+    bytes_sent = 0
     failed_uploads = []
 
-    # upload each requested by the server
-    for file_hash in ebooks_to_upload:
-        ebook_obj = ebooks_by_filehash[file_hash]
-
-        # TODO progress bar the uploads
-        # https://gitlab.com/sigmavirus24/toolbelt/blob/master/examples/monitor/progress_bar.py
-
+    def _upload(ebook_obj):
         # failed uploads are retried three times; total fail will raise the last exception
         try:
             upload_single_book(connection, ebook_obj)
-
+            return ebook_obj, None
         except exceptions.UploadError as e:
-            # record failures for later
-            failed_uploads.append(e)
-        else:
-            if config['verbose'] is True:
-                prntr.info('Uploaded {}'.format(ebook_obj.shortpath))
-            success += 1
-
-        if config['verbose'] is False:
-            i += 1
-            prntr.progressf(num_blocks=i, total_size=len(ebooks_to_upload))
+            return ebook_obj, e
+
+    # upload each requested by the server, several at once, in the configured read order
+    ebook_objs = devices.locality_order(
+        [ebooks_by_filehash[file_hash] for file_hash in ebooks_to_upload], path=lambda ebook_obj: ebook_obj.path
+    )
+
+    results = connection.imap_unordered(_upload, ebook_objs)
+
+    with contextlib.closing(results):
+        for ebook_obj, err in results:
+            if err is not None:
+                # record failures for later
+                failed_uploads.append(err)
+                profiler.error(err)
+            else:
+                if config['verbose'] is True:
+                    prntr.info('Uploaded {}'.format(ebook_obj.shortpath))
+                success += 1
+                config['ebook_cache'].mark_journal_done('to_upload', ebook_obj.file_hash)
+                profiler.count(items=1, nbytes=ebook_obj.size)
+                profiler.incr('uploaded')
+                bytes_sent += ebook_obj.size or 0
+
+            if config['verbose'] is False:
+                i += 1
+                prntr.progressf(num_blocks=i, total_size=len(ebooks_to_upload), nbytes=bytes_sent)
 
     # only print completion message after all retries
     if success > 0:
@@ -87,3 +126,77 @@ def upload_ebooks(config, connection, ebooks_by_filehash, ebooks_to_upload):
         prntr.info('Please run another sync', success=True)
 
     return success
+
+
+def is_worth_compressing(config, ebook_obj):
+    '''
+    Compress uploads of formats flagged compressible by ogreserver, when a quick
+    compression of the start of the file shows it will shrink
+    '''
+    definition = config['definitions'].get(ebook_obj.format)
+    if definition is None or not definition.is_compressible:
+        return False
+
+    with devices.reading(ebook_obj.path), open(ebook_obj.path, 'rb') as f:
+        sample = ThrottledFile(f, read_limiter).read(COMPRESS_SAMPLE_SIZE)
+
+    if not sample:
+        return False
+
+    return len(zlib.compress(sample, 1)) < len(sample) * COMPRESS_MAX_RATIO
+
+
+def upload_delta(connection, ebook_obj):
+    '''
+    Upload an rsync-style delta against the version of this ebook which ogreserver
+    already has, ie. before a metadata-only change such as writing the OGRE_ID
+
+    returns:
+        True if the delta was uploaded, False if a full upload is needed
+    '''
+    if not connection.delta_supported or (ebook_obj.size or 0) > DELTA_MAX_SIZE:
+        return False
+
+    try:
+        # block signatures of the previous version, if ogreserver has it
+        data = connection.request('signatures/{}'.format(ebook_obj.file_hash))
+
+    except exceptions.RequestError:
+        # older ogreserver; don't try again during this run
+        connection.delta_supported = False
+        return False
+
+    if data['result'] != 'ok':
+        return False
+
+    with make_temp_directory() as tmpdir:
+        delta_path = os.path.join(tmpdir, 'delta')
+
+        with devices.reading(ebook_obj.path), open(ebook_obj.path, 'rb') as f, open(delta_path, 'wb') as out:
+            size = os.fstat(f.fileno()).st_size
+
+            # stops early once the delta is not worth sending
+            literal_bytes = compute_delta(
+                ThrottledFile(f, read_limiter), data['signatures'], data['block_size'], out,
+                max_literal=size * DELTA_MAX_LITERAL_RATIO,
+            )
+
+        if literal_bytes is None:
+            return False
+
+        connection.upload(
+            'upload-delta',
+            ebook_obj,
+            data={
+                'ebook_id': ebook_obj.ebook_id,
+                'file_hash': ebook_obj.file_hash,
+                'base_hash': data['base_hash'],
+                'format': ebook_obj.format,
+            },
+            filepath=delta_path,
+        )
+
+        profiler.incr('delta_uploads')
+        profiler.incr('delta_bytes_saved', size - os.path.getsize(delta_path))
+
+    return True
@@ -0,0 +1,239 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import platform
+import select
+import struct
+import time
+
+from ogreclient.utils.printer import CliPrinter
+
+
+prntr = CliPrinter.get_printer()
+
+# inotify event masks, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT_HEADER = struct.Struct(str('iIII'))
+
+
+class WatcherBase(object):
+    '''
+    Watches a set of directory trees for changed files
+
+    Subclasses implement poll(timeout), which waits up to `timeout` seconds (or
+    indefinitely if None) and returns a set of changed file paths and a flag
+    indicating that events were lost and a full rescan is needed.
+    '''
+    def __init__(self, paths):
+        self.paths = [p for p in paths if p and os.path.isdir(p)]
+
+    def close(self):
+        pass
+
+    def wait(self, debounce=2.0, max_wait=30.0, timeout=None):
+        '''
+        Block until changes arrive, then gather further changes until none have
+        arrived for `debounce` seconds (or `max_wait` seconds have passed)
+
+        returns:
+            tuple (set of changed paths, rescan_needed)
+        '''
+        changed, rescan = self.poll(timeout)
+        if not changed and not rescan:
+            return changed, rescan
+
+        started = time.time()
+
+        while time.time() - started < max_wait:
+            more, more_rescan = self.poll(debounce)
+            if not more and not more_rescan:
+                break
+            changed |= more
+            rescan = rescan or more_rescan
+
+        return changed, rescan
+
+
+class PollingWatcher(WatcherBase):
+    '''
+    Portable watcher which compares stat() snapshots of each tree
+    '''
+    def __init__(self, paths, interval=10.0):
+        super(PollingWatcher, self).__init__(paths)
+        self.interval = interval
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for path in self.paths:
+            for root, _, files in os.walk(path):
+                for filename in files:
+                    filepath = os.path.join(root, filename)
+                    try:
+                        st = os.stat(filepath)
+                    except OSError:
+                        continue
+                    snapshot[filepath] = (st.st_mtime, st.st_size)
+        return snapshot
+
+    def poll(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            snapshot = self._snapshot()
+
+            # new, modified and deleted files
+            changed = {
+                p for p, st in snapshot.iteritems() if self.snapshot.get(p) != st
+            } | (set(self.snapshot) - set(snapshot))
+
+            self.snapshot = snapshot
+
+            if changed:
+                return changed, False
+
+            if deadline is not None and time.time() >= deadline:
+                return set(), False
+
+            sleep = self.interval
+            if deadline is not None:
+                sleep = min(sleep, max(deadline - time.time(), 0))
+            time.sleep(sleep)
+
+
+class InotifyWatcher(WatcherBase):
+    '''
+    Linux watcher using inotify via ctypes; watches are added for every subdirectory
+    '''
+    def __init__(self, paths):
+        super(InotifyWatcher, self).__init__(paths)
+
+        self.libc = _load_libc()
+        if self.libc is None:
+            raise WatcherUnavailableError('inotify is not available')
+
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise WatcherUnavailableError('inotify_init failed: {}'.format(os.strerror(ctypes.get_errno())))
+
+        # watch descriptor -> directory path
+        self.watches = {}
+
+        for path in self.paths:
+            self._add_tree(path)
+
+    def _add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                prntr.error('inotify watch limit reached; increase fs.inotify.max_user_watches')
+            return
+        self.watches[wd] = path
+
+    def _add_tree(self, path):
+        '''
+        Watch a directory tree, returning files which already exist within it
+        '''
+        existing = set()
+        for root, dirs, files in os.walk(path):
+            self._add_watch(root)
+            for filename in files:
+                existing.add(os.path.join(root, filename))
+        return existing
+
+    def poll(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set(), False
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return set(), False
+            raise
+
+        changed = set()
+        rescan = False
+        offset = 0
+
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_len = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset+name_len].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                rescan = True
+                continue
+
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = os.path.join(directory, name)
+
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # watch new directories, and pick up files created before the watch existed
+                    changed |= self._add_tree(path)
+                continue
+
+            changed.add(path)
+
+        return changed, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _load_libc():
+    if platform.system() != 'Linux':
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library(str('c')) or str('libc.so.6'), use_errno=True)
+    except OSError:
+        return None
+
+    if not hasattr(libc, 'inotify_init') or not hasattr(libc, 'inotify_add_watch'):
+        return None
+
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+def create_watcher(paths, use_polling=False, poll_interval=10.0):
+    '''
+    Return an inotify watcher where available, otherwise a polling watcher
+    '''
+    if not use_polling:
+        try:
+            return InotifyWatcher(paths)
+        except WatcherUnavailableError as e:
+            prntr.debug(e)
+
+    return PollingWatcher(paths, interval=poll_interval)
+
+
+class WatcherUnavailableError(Exception):
+    pass
@@ -113,6 +113,9 @@ class KindleProviderError(ProviderBaseError):
 class ADEProviderError(ProviderBaseError):
     pass
 
+class CalibreProviderError(ProviderBaseError):
+    pass
+
 class ProviderUnavailableBaseWarning(OgreWarning):
     pass
 
@@ -122,14 +125,18 @@ class KindleUnavailableWarning(ProviderUnavailableBaseWarning):
 class ADEUnavailableWarning(ProviderUnavailableBaseWarning):
     pass
 
+class CalibreUnavailableWarning(ProviderUnavailableBaseWarning):
+    pass
+
 class EbookHomeUnavailableWarning(ProviderUnavailableBaseWarning):
     pass
 
 
 class DuplicateEbookBaseError(OgreWarning):
     def __init__(self, kind, ebook_obj, path2):
+        self.ebook_obj = ebook_obj
         super(DuplicateEbookBaseError, self).__init__(
-            "Duplicate ebook found ({}) '{}':\n  {}\n  {}".format(kind, ebook_obj.path, path2)
+            "Duplicate ebook found ({}):\n  {}\n  {}".format(kind, ebook_obj.path, path2)
         )
 
 class ExactDuplicateEbookError(DuplicateEbookBaseError):
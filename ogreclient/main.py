@@ -1,57 +1,110 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import collections
+import contextlib
 import os
+from multiprocessing.pool import ThreadPool
 
 from ogreclient import exceptions
 from ogreclient.core.dedrm import clean_all_drm
-from ogreclient.core.scan import scan_for_ebooks
+from ogreclient.core.scan import scan_for_ebooks, _find_changed_ebooks, _process_ebooks, _preload_metadata
 from ogreclient.core.upload import query_for_uploads, upload_ebooks
+from ogreclient.core.watch import create_watcher
+from ogreclient.providers import LibProvider
+from ogreclient.utils import make_temp_directory
 from ogreclient.utils.connection import OgreConnection
 from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.profiler import profiler
 
 
 prntr = CliPrinter.get_printer()
 
+# number of concurrent uploads of failed books in debug mode
+ERRORD_UPLOAD_WORKERS = 4
+# failed books larger than this are not uploaded for debug
+ERRORD_UPLOAD_MAX_SIZE = 20971520
+# seconds of quiet before a batch of filesystem changes is processed in watch mode
+WATCH_DEBOUNCE = 2.0
+# upper bound on seconds spent gathering a single batch of changes
+WATCH_MAX_BATCH_WAIT = 30.0
+
 
 def sync(config):
     # authenticate user and generate session API key
     connection = OgreConnection(config)
-    connection.login(config['username'], config['password'])
+    with profiler.phase('login'):
+        connection.login(config['username'], config['password'])
 
     # let the user know something is happening
     prntr.info('Scanning for ebooks..', nonl=True, bold=True)
 
     # 1) find ebooks in config['ebook_home'] on local machine
-    ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped = scan_for_ebooks(config)
+    with profiler.phase('scan'):
+        ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped = scan_for_ebooks(config)
 
     if scan_errord:
         prntr.info('Errors occurred during scan:')
         for e in scan_errord:
             prntr.error(e.ebook_obj.path, excp=e)
+            profiler.error(e)
 
     try:
-        # 2) remove DRM
-        decrypt_errord = clean_all_drm(config, ebooks_by_authortitle, ebooks_by_filehash)
+        return sync_ebooks(
+            config, connection, ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped
+        )
 
     except exceptions.AbortSyncDueToBadKey:
-        if 'has_restarted_once' in config:
-            prntr.info('Invalid Kindle error. Continuing without Kindle decryption')
-        else:
-            config['has_restarted_once'] = True
+        _remove_bad_kindle_key(config)
+        return sync(config)
+
+
+def _remove_bad_kindle_key(config):
+    config['has_restarted_once'] = True
+
+    # delete existing key, so the sync can be restarted
+    os.remove(os.path.join(config['config_dir'], 'kindlekey.k4i'))
+
+    prntr.info('Invalid Kindle key detected. Restarting sync.', bold=True)
+
+
+def _sync_batch(config, connection, ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped):
+    '''
+    Sync a batch of books in watch mode, retrying once with a stale Kindle key removed
+    '''
+    try:
+        return sync_ebooks(config, connection, ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped)
+
+    except exceptions.AbortSyncDueToBadKey:
+        _remove_bad_kindle_key(config)
+        return sync_ebooks(config, connection, ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped)
+
+
+def sync_ebooks(config, connection, ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped):
+    """
+    Remove DRM, sync with ogreserver and upload the requested books.
+
+    ebooks_by_authortitle holds the books to sync; ebooks_by_filehash may hold
+    further books which are available for upload if ogreserver requests them.
+    """
+    try:
+        # 2) remove DRM
+        with profiler.phase('dedrm'):
+            decrypt_errord = clean_all_drm(config, ebooks_by_authortitle, ebooks_by_filehash)
 
-            # delete existing key and restart the sync
-            os.remove(os.path.join(config['config_dir'], 'kindlekey.k4i'))
+    except exceptions.AbortSyncDueToBadKey:
+        if 'has_restarted_once' not in config:
+            raise
 
-            prntr.info('Invalid Kindle key detected. Restarting sync.', bold=True)
-            sync(config)
-            return
+        prntr.info('Invalid Kindle error. Continuing without Kindle decryption')
+        decrypt_errord = []
 
     if decrypt_errord:
         prntr.info('Errors occurred during decryption:')
         for e in decrypt_errord:
             # display an error message
             prntr.error(e.ebook_obj.path, excp=e)
+            profiler.error(e)
             # remove the book from the sync data
             del(ebooks_by_filehash[e.ebook_obj.file_hash])
             del(ebooks_by_authortitle[e.ebook_obj.authortitle])
@@ -62,19 +115,24 @@ def sync(config):
         ', {} skipped'.format(skipped) if skipped > 0 else ''
     ), bold=True)
 
-    # 3) send dict of ebooks / md5s to ogreserver
-    response = sync_with_server(config, connection, ebooks_by_authortitle)
+    # a new sync replaces any interrupted one
+    ebook_cache = config['ebook_cache']
+    ebook_cache.clear_journal()
 
-    prntr.info('Come on sucker, lick my battery', bold=True)
+    # 3) send dict of ebooks / md5s to ogreserver
+    with profiler.phase('sync'):
+        response = sync_with_server(config, connection, ebooks_by_authortitle)
 
-    # 4) set ogre_id in metadata of each sync'd ebook
-    update_local_metadata(config, connection, ebooks_by_filehash, response['to_update'])
+    # journal the books which need OGRE_ID written, so an interrupted sync can resume
+    ebook_cache.store_journal('to_update', [
+        (file_hash, {'path': ebooks_by_filehash[file_hash].path, 'ebook_id': item['ebook_id']})
+        for file_hash, item in response['to_update'].iteritems()
+    ])
 
-    # 5) query the set of books to upload
-    ebooks_to_upload = query_for_uploads(config, connection)
+    prntr.info('Come on sucker, lick my battery', bold=True)
 
-    # 6) upload the ebooks requested by ogreserver
-    uploaded_count = upload_ebooks(config, connection, ebooks_by_filehash, ebooks_to_upload)
+    # 4-6) write OGRE_IDs, query for and upload requested books
+    uploaded_count = _update_and_upload(config, connection, ebooks_by_filehash, response['to_update'])
 
     # 7) display/send errors
     all_errord = [err for err in scan_errord+decrypt_errord if isinstance(err, exceptions.OgreException)]
@@ -84,13 +142,219 @@ def sync(config):
             prntr.error('Finished with errors. Re-run with --debug to send logs to OGRE')
         else:
             # send a log of all events, and upload bad books
-            send_logs(connection, all_errord)
+            with profiler.phase('send_logs'):
+                send_logs(config, connection, all_errord)
+
+    return uploaded_count
+
+
+def watch(config, watcher=None, max_batches=None):
+    """
+    Sync once, then watch the provider directories and incrementally sync changed books.
+
+    The ogreserver session, the cache and the in-memory library are kept for the
+    lifetime of the process, so each batch only processes the files which changed.
+    """
+    # authenticate user and generate session API key
+    connection = OgreConnection(config)
+    with profiler.phase('login'):
+        connection.login(config['username'], config['password'])
+
+    # start watching before the initial scan, so no changes are missed during the sync
+    if watcher is None:
+        watcher = create_watcher(
+            [p.libpath for p in config['providers'].itervalues() if isinstance(p, LibProvider)],
+            use_polling=config.get('watch_polling', False),
+            poll_interval=config.get('watch_poll_interval', 10.0),
+        )
+
+    prntr.info('Scanning for ebooks..', nonl=True, bold=True)
+
+    try:
+        with profiler.phase('scan'):
+            library_by_authortitle, library_by_filehash, scan_errord, skipped = scan_for_ebooks(config)
+
+        for e in scan_errord:
+            prntr.error(e.ebook_obj.path, excp=e)
+
+        _sync_batch(config, connection, library_by_authortitle, library_by_filehash, scan_errord, skipped)
+
+    except exceptions.NoEbooksError:
+        # nothing to sync yet; new books will arrive via the watcher
+        library_by_authortitle, library_by_filehash = {}, {}
+
+    # (mtime, size) of each file as last processed; used to ignore the events
+    # generated by our own writes, such as adding OGRE_ID into the metadata
+    known = {}
+
+    def _remember(paths):
+        for path in paths:
+            known[path] = _stat_key(path)
+
+    _remember(e.path for e in library_by_filehash.itervalues())
+
+    prntr.info('Watching {} directories for changes..'.format(len(watcher.paths)), bold=True)
+
+    batches = 0
+
+    try:
+        while max_batches is None or batches < max_batches:
+            changed, rescan = watcher.wait(
+                debounce=config.get('watch_debounce', WATCH_DEBOUNCE), max_wait=WATCH_MAX_BATCH_WAIT
+            )
+
+            if rescan:
+                # events were lost; fall back to a full (cached) scan
+                prntr.info('Filesystem events were lost, rescanning')
+                batches += 1
+
+                try:
+                    with profiler.phase('scan'):
+                        ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped = scan_for_ebooks(config)
+                except exceptions.NoEbooksError:
+                    # the library is still empty
+                    ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped = {}, {}, [], 0
+
+                library_by_filehash.update(ebooks_by_filehash)
+
+            else:
+                ebooks = _find_changed_ebooks(
+                    [p for p in changed if _stat_key(p) != known.get(p)],
+                    config['providers'],
+                    config['definitions'],
+                )
+                if not ebooks:
+                    continue
+
+                batches += 1
+                prntr.info('Detected {} changed ebooks'.format(len(ebooks)), bold=True)
+
+                # changed files are always re-read, bypassing stale cache entries
+                with profiler.phase('scan'):
+                    ebooks_by_authortitle, ebooks_by_filehash, scan_errord, skipped = _process_ebooks(
+                        ebooks,
+                        config['ebook_cache'],
+                        config['definitions'],
+                        skip_cache=True,
+                        verbose=config['verbose'],
+                        metadata=_preload_metadata(config['providers'], config['definitions']),
+                    )
+                library_by_filehash.update(ebooks_by_filehash)
+
+            for e in scan_errord:
+                prntr.error(e.ebook_obj.path, excp=e)
+
+            if ebooks_by_authortitle:
+                # sync only the changed books; any known book can be uploaded on request
+                _sync_batch(
+                    config, connection, ebooks_by_authortitle, library_by_filehash, scan_errord, skipped
+                )
+                library_by_authortitle.update(ebooks_by_authortitle)
+
+            _remember(changed)
+            _remember(e.path for e in ebooks_by_authortitle.itervalues())
+
+    finally:
+        watcher.close()
+
+    return batches
+
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+
+
+def _update_and_upload(config, connection, ebooks_by_filehash, ebooks_to_update, ebooks_to_upload=None):
+    ebook_cache = config['ebook_cache']
+
+    # 4) set ogre_id in metadata of each sync'd ebook
+    with profiler.phase('update_metadata'):
+        update_local_metadata(config, connection, ebooks_by_filehash, ebooks_to_update)
+
+    if ebooks_to_upload is None:
+        # 5) query the set of books to upload
+        with profiler.phase('query_uploads'):
+            ebooks_to_upload = query_for_uploads(config, connection)
+
+        ebook_cache.store_journal('to_upload', [(file_hash, None) for file_hash in ebooks_to_upload])
+
+    # load any requested books not already in memory from the cache; this
+    # is the case when resuming, since the library is not rescanned
+    missing = [file_hash for file_hash in ebooks_to_upload if file_hash not in ebooks_by_filehash]
+    if missing:
+        ebooks_by_filehash.update(ebook_cache.get_ebooks_by_file_hash(missing))
+        ebooks_to_upload = [file_hash for file_hash in ebooks_to_upload if file_hash in ebooks_by_filehash]
+
+    # 6) upload the ebooks requested by ogreserver
+    with profiler.phase('upload'):
+        uploaded_count = upload_ebooks(config, connection, ebooks_by_filehash, ebooks_to_upload)
+
+    # sync is complete
+    ebook_cache.clear_journal()
 
     return uploaded_count
 
 
+def resume_sync(config):
+    """
+    Continue an interrupted sync from the journal in the cache, skipping the
+    scan and the steps which already completed.
+    """
+    ebook_cache = config['ebook_cache']
+
+    to_update = ebook_cache.get_journal('to_update')
+    if to_update is None:
+        prntr.info('No interrupted sync found, starting a full sync')
+        return sync(config)
+
+    to_upload = ebook_cache.get_journal('to_upload')
+
+    # authenticate user and generate session API key
+    connection = OgreConnection(config)
+    with profiler.phase('login'):
+        connection.login(config['username'], config['password'])
+
+    prntr.info('Resuming interrupted sync', bold=True)
+
+    ebooks_to_update = {}
+    ebooks_by_filehash = {}
+
+    # load the books still awaiting an OGRE_ID from the cache
+    for file_hash, data, done in to_update:
+        if done:
+            continue
+        try:
+            ebook_obj = ebook_cache.get_ebook(data['path'])
+        except exceptions.MissingFromCacheError:
+            continue
+
+        # skip books changed since the interrupted sync, or updated just before it stopped
+        if ebook_obj.file_hash != file_hash:
+            continue
+
+        if ebook_obj.compute_md5()[0] != file_hash:
+            # OGRE_ID was written and confirmed, but the sync stopped before journaling it
+            ebook_cache.update_ebook_property(
+                ebook_obj.path, file_hash=ebook_obj.file_hash, ebook_id=data['ebook_id']
+            )
+            continue
+
+        ebooks_by_filehash[file_hash] = ebook_obj
+        ebooks_to_update[file_hash] = {'ebook_id': data['ebook_id']}
+
+    if to_upload is not None:
+        to_upload = [file_hash for file_hash, _, done in to_upload if not done]
+
+    return _update_and_upload(config, connection, ebooks_by_filehash, ebooks_to_update, to_upload)
+
+
 def scan_and_show_stats(config):
-    ebooks_by_authortitle, ebooks_by_filehash, errord_list, _ = scan_for_ebooks(config)
+    with profiler.phase('scan'):
+        ebooks_by_authortitle, ebooks_by_filehash, errord_list, _ = scan_for_ebooks(config)
 
     counts = {}
     errors = {}
@@ -126,6 +390,29 @@ def scan_and_show_stats(config):
     prntr.info(output, tabular=True, notime=True)
 
 
+def show_cache_stats(config):
+    '''
+    Display library stats from the cache, as of the last scan; no ebooks are read
+    '''
+    with profiler.phase('stats'):
+        stats = config['ebook_cache'].get_stats()
+
+    # add header to output table
+    output = [('format', 'count', 'size')]
+    output += [(fmt, count, '{:.1f}MB'.format((size or 0) / 1048576.0)) for fmt, count, size, _ in stats['formats']]
+    # add a separator row and the counts of problem books
+    output.append(('-', '-', '-'))
+    output += [
+        (key, stats[key], '')
+        for key in ('duplicate', 'corrupt', 'skipped', 'drmfree', 'missing') if stats[key]
+    ]
+
+    # print table
+    prntr.info(output, tabular=True, notime=True)
+
+    return stats
+
+
 def sync_with_server(config, connection, ebooks_by_authortitle):
     # serialize ebooks to dictionary for sending to ogreserver
     ebooks_for_sync = {}
@@ -134,6 +421,8 @@ def sync_with_server(config, connection, ebooks_by_authortitle):
         if config['definitions'][ebook_obj.format][0] is True:
             ebooks_for_sync[authortitle] = ebook_obj.serialize()
 
+    profiler.count(items=len(ebooks_for_sync))
+
     try:
         # post json dict of ebook data
         data = connection.request('post', data=ebooks_for_sync)
@@ -157,19 +446,36 @@ def sync_with_server(config, connection, ebooks_by_authortitle):
 def update_local_metadata(config, connection, ebooks_by_filehash, ebooks_to_update):
     success, failed = 0, 0
 
-    # update any books with ogre_id supplied from ogreserver
-    for file_hash, item in ebooks_to_update.iteritems():
-        ebook_obj = ebooks_by_filehash[file_hash]
-
+    def _update(args):
+        file_hash, ebook_obj, ebook_id = args
         try:
             # update the metadata on the ebook, and communicate that to ogreserver
-            new_file_hash = ebook_obj.add_ogre_id_tag(item['ebook_id'], connection)
+            return file_hash, ebook_obj, ebook_obj.add_ogre_id_tag(ebook_id, connection), None
+
+        except (exceptions.FailedWritingMetaDataError, exceptions.FailedConfirmError) as e:
+            return file_hash, ebook_obj, None, e
+
+    # update any books with ogre_id supplied from ogreserver; the metadata writes
+    # and confirm calls for several books run at once
+    results = connection.imap_unordered(_update, [
+        (file_hash, ebooks_by_filehash[file_hash], item['ebook_id'])
+        for file_hash, item in ebooks_to_update.iteritems()
+    ])
+
+    with contextlib.closing(results):
+        for file_hash, ebook_obj, new_file_hash, err in results:
+            if err is not None:
+                prntr.error('Failed saving OGRE_ID in {}'.format(ebook_obj.shortpath), excp=err)
+                profiler.error(err)
+                failed += 1
+                continue
 
             # update the global dict with the new file_hash
             del(ebooks_by_filehash[file_hash])
             ebooks_by_filehash[new_file_hash] = ebook_obj
 
             success += 1
+            profiler.count(items=1)
             if config['verbose']:
                 prntr.info('Wrote OGRE_ID to {}'.format(ebook_obj.shortpath))
 
@@ -177,12 +483,9 @@ def update_local_metadata(config, connection, ebooks_by_filehash, ebooks_to_upda
             config['ebook_cache'].update_ebook_property(
                 ebook_obj.path,
                 file_hash=new_file_hash,
-                ebook_id=item['ebook_id']
+                ebook_id=ebook_obj.ebook_id
             )
-
-        except (exceptions.FailedWritingMetaDataError, exceptions.FailedConfirmError) as e:
-            prntr.error('Failed saving OGRE_ID in {}'.format(ebook_obj.shortpath), excp=e)
-            failed += 1
+            config['ebook_cache'].mark_journal_done('to_update', file_hash)
 
     if config['verbose'] and success > 0:
         prntr.info('Updated {} ebooks'.format(success), success=True)
@@ -190,13 +493,21 @@ def update_local_metadata(config, connection, ebooks_by_filehash, ebooks_to_upda
         prntr.error('Failed updating {} ebooks'.format(failed))
 
 
-def send_logs(connection, errord_list):
+def send_logs(config, connection, errord_list):
     try:
-        # concat all stored log data
-        log_data = '\n'.join(prntr.logs).encode('utf-8')
-
-        # post all logs to ogreserver
-        data = connection.request('post-logs', data={'raw_logs':log_data})
+        with make_temp_directory() as tmpdir:
+            # compress the stored log data to disk
+            logs_path = os.path.join(tmpdir, 'logs.gz')
+            with open(logs_path, 'wb') as f:
+                prntr.logs.write_gzip(f)
+
+            # stream compressed logs to ogreserver
+            with open(logs_path, 'rb') as f:
+                data = connection.post_file(
+                    'post-logs', f,
+                    content_type='text/plain; charset=utf-8',
+                    content_encoding='gzip',
+                )
 
         if data['result'] != 'ok':
             raise exceptions.FailedDebugLogsError('Failed storing the logs, please report this.')
@@ -205,20 +516,72 @@ def send_logs(connection, errord_list):
 
         # upload all books which failed
         if errord_list:
-            prntr.info('Uploaded failed books to OGRE for debug..')
-            i = 0
-
-            for e in errord_list:
-                connection.upload(
-                    'upload-errord',
-                    e.ebook_obj,
-                    data={
-                        'filename': os.path.basename(e.ebook_obj.path.encode('utf-8'))
-                    },
-                )
-
-                i += 1
-                prntr.progressf(num_blocks=i, total_size=len(errord_list))
+            upload_errord_books(config, connection, errord_list)
 
     except exceptions.RequestError as e:
         raise exceptions.FailedDebugLogsError(inner_excp=e)
+
+
+def upload_errord_books(config, connection, errord_list):
+    ebook_cache = config['ebook_cache']
+
+    # a book can fail more than once; upload each file only once
+    ebooks_by_filehash = collections.OrderedDict()
+
+    for e in errord_list:
+        ebook_obj = getattr(e, 'ebook_obj', None)
+        if ebook_obj is None or not os.path.exists(ebook_obj.path):
+            continue
+
+        if ebook_obj.file_hash is None:
+            ebook_obj.compute_md5()
+
+        if ebook_obj.size > ERRORD_UPLOAD_MAX_SIZE:
+            prntr.info('Not uploading {} for debug; file too large'.format(ebook_obj.path))
+            continue
+
+        ebooks_by_filehash.setdefault(ebook_obj.file_hash, ebook_obj)
+
+    # skip books already sent to ogreserver during a previous debug run
+    for file_hash in ebook_cache.get_errord_uploaded(ebooks_by_filehash.keys()):
+        del(ebooks_by_filehash[file_hash])
+
+    if not ebooks_by_filehash:
+        return
+
+    prntr.info('Uploading {} failed books to OGRE for debug..'.format(len(ebooks_by_filehash)))
+
+    def _upload(ebook_obj):
+        try:
+            connection.upload(
+                'upload-errord',
+                ebook_obj,
+                data={
+                    'filename': os.path.basename(ebook_obj.path.encode('utf-8'))
+                },
+            )
+            return ebook_obj, None
+
+        except exceptions.RequestError as e:
+            return ebook_obj, e
+
+    failed = []
+    pool = ThreadPool(ERRORD_UPLOAD_WORKERS)
+
+    try:
+        for i, (ebook_obj, err) in enumerate(pool.imap_unordered(_upload, ebooks_by_filehash.values()), 1):
+            if err is None:
+                # record in the ledger so the book isn't sent again
+                ebook_cache.store_errord_uploaded(ebook_obj.file_hash)
+            else:
+                failed.append(err)
+
+            prntr.progressf(num_blocks=i, total_size=len(ebooks_by_filehash))
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        raise exceptions.FailedDebugLogsError(
+            'Failed uploading {} books for debug'.format(len(failed)), inner_excp=failed[0]
+        )
@@ -25,29 +25,30 @@ prntr = CliPrinter.get_printer()
 
 
 def setup_ogreclient(args, conf):
+    # stats from the cache need only the cache
+    if args.mode == 'stats' or vars(args).get('from_cache'):
+        init_cache(conf)
+        return conf
+
     check_calibre_exists(conf)
 
     # not all commands need ogreserver
     if hasattr(args, 'host'):
         setup_ogreserver_connection_and_get_definitions(args, conf)
 
+    # setup the sqlite cache; providers may use it during discovery
+    init_cache(conf)
+
     # all commands execpt dedrm need providers
-    if args.mode in ('init', 'sync', 'stats', 'scan'):
+    if args.mode in ('init', 'sync', 'scan', 'watch'):
         setup_providers(args, conf)
 
     # write out this config for next run
     write_config(conf)
 
-    # setup the sqlite cache
-    init_cache(conf)
-
     # check dedrm is working
     dedrm_check(args, conf)
 
-    if args.mode == 'stats' and 'username' not in conf:
-        # supply a default username during stats queries
-        conf['username'] = 'oc'
-
     # return config object
     return conf
 
@@ -166,7 +167,9 @@ def setup_providers(args, conf):
             conf['ignore_providers'].append(provider)
 
     # scan for ebook-provider directories; modifies config in-place
-    find_ebook_providers(conf, ignore=conf['ignore_providers'])
+    find_ebook_providers(
+        conf, ignore=conf['ignore_providers'], rediscover=vars(args).get('rediscover', False)
+    )
 
     # hard error if no ebook provider dirs found
     if ebook_home_found is False and not conf['providers']:
@@ -1,25 +1,38 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import hashlib
+import json
 import os
 import platform
 import plistlib
 import shutil
+import sqlite3
 import subprocess
 import urllib
 import urlparse
 
-from xml.dom import minidom
+from xml.etree import cElementTree as ElementTree
 
 from ogreclient.exceptions import (ProviderBaseError, KindleProviderError, ADEProviderError,
-                                   ProviderUnavailableBaseWarning, KindleUnavailableWarning,
-                                   ADEUnavailableWarning, EbookHomeUnavailableWarning)
+                                   CalibreProviderError, ProviderUnavailableBaseWarning,
+                                   KindleUnavailableWarning, ADEUnavailableWarning,
+                                   CalibreUnavailableWarning, EbookHomeUnavailableWarning)
+from ogreclient.core.ebook_obj import EbookObject
 from ogreclient.utils import make_temp_directory
 from ogreclient.utils.printer import CliPrinter
 
 
 prntr = CliPrinter.get_printer()
 
+KINDLE_INFO_PLIST = '/Applications/Kindle.app/Contents/Info.plist'
+
+# Kindle for Mac prefs, which record the Kindle content directory
+KINDLE_PREFS_PLISTS = [
+    '~/Library/Containers/com.amazon.Kindle/Data/Library/Preferences/com.amazon.Kindle.plist',
+    '~/Library/Preferences/com.amazon.Kindle.plist',
+]
+
 
 class ProviderFactory:
     @classmethod
@@ -36,6 +49,31 @@ class ProviderBase(object):
     def __init__(self, friendly=None, config=None):
         self.friendly = friendly
 
+    def iter_ebooks(self, definitions):
+        '''
+        Yield tuple (path, suffix, source) for each ebook from this provider
+        '''
+        return iter(())
+
+    def change_token(self):
+        '''
+        Return a cheap string which changes whenever the set of ebooks from this
+        provider may have changed; None means the provider must always be scanned
+        '''
+        return None
+
+    def bulk_metadata(self, definitions):
+        '''
+        Return a dict of path:meta for ebooks whose metadata the provider can
+        supply itself, saving a call to ebook-meta for each
+        '''
+        return {}
+
+    def _is_ebook(self, filename, definitions):
+        fn, ext = os.path.splitext(os.path.basename(filename))
+        # check file not hidden, is in list of known file suffixes
+        return fn[0:1] != '.' and ext[1:] in definitions
+
 
 class LibProvider(ProviderBase):
     '''
@@ -43,6 +81,9 @@ class LibProvider(ProviderBase):
 
     Class can be instantiated from config module, which means libpath will be supplied
     to the constructor and scan can be skipped
+
+    There is no change_token(); checking the mtime of every directory costs as
+    much as walking the tree, so the tree is walked on every scan
     '''
     libpath = None
 
@@ -54,6 +95,12 @@ class LibProvider(ProviderBase):
             self.libpath = libpath
             self.needs_scan = False
 
+    def iter_ebooks(self, definitions):
+        for root, _, files in os.walk(self.libpath):
+            for filename in files:
+                if self._is_ebook(filename, definitions):
+                    yield (os.path.join(root, filename), os.path.splitext(filename)[1][1:], self.friendly)
+
 class EbookHomeProvider(LibProvider):
     '''
     A specialised LibsProvider just for $OGRE_HOME
@@ -61,12 +108,162 @@ class EbookHomeProvider(LibProvider):
     def __init__(self, friendly=None, config=None):
         super(EbookHomeProvider, self).__init__(friendly, libpath=config['ebook_home'])
 
+class CalibreProvider(LibProvider):
+    '''
+    A calibre library; the ebooks and their metadata are read from calibre's
+    metadata.db, rather than from the files themselves
+    '''
+    def iter_ebooks(self, definitions):
+        try:
+            library = self._read_library(definitions)
+        except CalibreProviderError as e:
+            # treat the library as a plain directory of ebooks
+            prntr.error('Failed reading {}'.format(self.friendly), excp=e)
+            for ebook in super(CalibreProvider, self).iter_ebooks(definitions):
+                yield ebook
+            return
+
+        for path, fmt, _ in library:
+            yield (path, fmt, self.friendly)
+
+    # (change_token, formats) and the library last read from metadata.db
+    _library = None
+
+    def change_token(self):
+        # calibre writes to its database on every change to the library
+        try:
+            st = os.stat(os.path.join(self.libpath, 'metadata.db'))
+        except OSError:
+            # no database; the library is walked as a plain directory
+            return None
+        return '{!r}:{}'.format(st.st_mtime, st.st_size)
+
+    def bulk_metadata(self, definitions):
+        try:
+            return {path: meta for path, _, meta in self._read_library(definitions)}
+        except CalibreProviderError as e:
+            prntr.error('Failed reading {}'.format(self.friendly), excp=e)
+            return {}
+
+    def _read_library(self, definitions):
+        '''
+        Read every ebook file in the library, with its metadata, in a handful of queries;
+        the result is reused until metadata.db changes
+
+        returns:
+            list of tuple (path, suffix, meta)
+        '''
+        token = self.change_token()
+        if token is None:
+            raise CalibreProviderError('metadata.db not found in {}'.format(self.libpath))
+
+        key = (token, tuple(definitions))
+        if self._library is None or self._library[0] != key:
+            self._library = (key, self._query_library(definitions))
+
+        return self._library[1]
+
+    def _query_library(self, definitions):
+        try:
+            conn = sqlite3.connect(os.path.join(self.libpath, 'metadata.db'))
+            try:
+                c = conn.cursor()
+                books = {
+                    book_id: {'title': title, 'author_sort': author_sort, 'path': path, 'pubdate': pubdate}
+                    for book_id, title, author_sort, path, pubdate in c.execute(
+                        'SELECT id, title, author_sort, path, pubdate FROM books'
+                    )
+                }
+                for book_id, name in c.execute(
+                        'SELECT l.book, a.name FROM books_authors_link l '
+                        'JOIN authors a ON a.id = l.author ORDER BY l.id'):
+                    books[book_id].setdefault('authors', []).append(name)
+                for book_id, name in c.execute(
+                        'SELECT l.book, t.name FROM books_tags_link l '
+                        'JOIN tags t ON t.id = l.tag ORDER BY l.id'):
+                    books[book_id].setdefault('tags', []).append(name)
+                for book_id, name in c.execute(
+                        'SELECT l.book, p.name FROM books_publishers_link l '
+                        'JOIN publishers p ON p.id = l.publisher'):
+                    books[book_id]['publisher'] = name
+                for book_id, typ, val in c.execute('SELECT book, type, val FROM identifiers'):
+                    books[book_id].setdefault('identifiers', {})[typ] = val
+                files = c.execute('SELECT book, format, name FROM data').fetchall()
+            finally:
+                conn.close()
+
+        except (sqlite3.Error, KeyError) as e:
+            raise CalibreProviderError(inner_excp=e)
+
+        library = []
+
+        for book_id, fmt, name in files:
+            fmt = fmt.lower()
+            if fmt not in definitions:
+                continue
+
+            book = books[book_id]
+            path = os.path.join(self.libpath, *book['path'].split('/'))
+            library.append(
+                (os.path.join(path, '{}.{}'.format(name, fmt)), fmt, self._build_meta(book))
+            )
+
+        return library
+
+    @staticmethod
+    def _build_meta(book):
+        '''
+        Build an EbookObject.meta dict from a calibre book record, as
+        EbookObject._metadata_extract does from the output of ebook-meta
+        '''
+        meta = {'title': book['title']}
+
+        # ebook-meta parses the author sort, eg. "Austen, Jane"
+        author = book['author_sort'] or ' & '.join(book.get('authors', []))
+        meta['firstname'], meta['lastname'] = EbookObject._parse_author(author or 'Unknown')
+
+        if 'publisher' in book:
+            meta['publisher'] = book['publisher']
+
+        # calibre's placeholder for an unknown date is in the year 101
+        if book['pubdate'] and not book['pubdate'].startswith('0101'):
+            meta['publish_date'] = book['pubdate'].replace(' ', 'T')
+
+        tags = []
+        for tag in book.get('tags', []):
+            if 'OGRE-DeDRM' in tag:
+                meta['drmfree'] = True
+            elif tag.startswith('ogre_id='):
+                meta['ebook_id'] = tag[8:].strip()
+            else:
+                tags.append(tag)
+        if tags:
+            meta['tags'] = ', '.join(tags)
+
+        for typ, val in book.get('identifiers', {}).iteritems():
+            if typ in ('isbn', 'asin', 'mobi-asin', 'uri', 'epubbud'):
+                meta[typ] = val
+            elif typ == 'ogre_id':
+                meta['ebook_id'] = val
+
+        # clean up mixed ASIN tags
+        if 'mobi-asin' in meta and meta.get('asin', meta['mobi-asin']) == meta['mobi-asin']:
+            meta['asin'] = meta.pop('mobi-asin')
+
+        return meta
+
+
 class PathsProvider(ProviderBase):
     '''
     A PathsProvider contains a list of direct ebook paths
     '''
     paths = None
 
+    def iter_ebooks(self, definitions):
+        for path, _ in self.paths or []:
+            if self._is_ebook(path, definitions):
+                yield (path, os.path.splitext(path)[1][1:], self.friendly)
+
 
 PROVIDERS = {
     'home': {
@@ -81,15 +278,25 @@ PROVIDERS = {
         'friendly': 'Adobe Digital Editions',
         'class': PathsProvider,
     },
+    'calibre': {
+        'friendly': 'Calibre Library',
+        'class': CalibreProvider,
+    },
 }
 
 
-def find_ebook_providers(conf, ignore=None):
+def find_ebook_providers(conf, ignore=None, rediscover=False):
     '''
     Locate any ebook providers on the client machine (ie. Kindle, ADE)
+
+    The result of discovery is stored in conf['discovered'] along with a fingerprint
+    of the files it was derived from. While the fingerprint is unchanged, the
+    saved result is reused rather than running the platform handler again.
     '''
     if 'providers' not in conf:
         conf['providers'] = {}
+    if 'discovered' not in conf:
+        conf['discovered'] = {}
 
     for provider_name in PROVIDERS.keys():
         # ignore certain providers as determined by --ignore-* params
@@ -99,6 +306,20 @@ def find_ebook_providers(conf, ignore=None):
                 conf['providers'][provider_name] = None
             continue
 
+        fingerprint = provider_fingerprint(provider_name)
+        saved = conf['discovered'].get(provider_name)
+
+        if rediscover is False and fingerprint is not None and saved and saved.get('fingerprint') == fingerprint:
+            # nothing discovery depends on has changed since the last run
+            if saved.get('libpath') and os.path.exists(saved['libpath']):
+                provider = ProviderFactory.create(provider_name, libpath=saved['libpath'], config=conf)
+                provider.version = saved.get('version') or None
+                conf['providers'][provider_name] = provider
+                prntr.info('Found {} directory'.format(provider.friendly))
+            else:
+                conf['providers'][provider_name] = None
+            continue
+
         # initialise any providers which werent loaded from config
         if not conf['providers'].get(provider_name):
             conf['providers'][provider_name] = ProviderFactory.create(provider_name, config=conf)
@@ -113,7 +334,7 @@ def find_ebook_providers(conf, ignore=None):
             func_name = '_handle_{}_{}'.format(provider_name, platform.system())
             if func_name in globals() and hasattr(globals()[func_name], '__call__'):
                 try:
-                    globals()[func_name](provider)
+                    globals()[func_name](provider, conf)
                     found = True
 
                 except ProviderUnavailableBaseWarning as e:
@@ -132,17 +353,58 @@ def find_ebook_providers(conf, ignore=None):
             # provider is unavailable; remove it from the config
             conf['providers'][provider_name] = None
 
+        if fingerprint is not None:
+            # save the result, including a provider which was not found
+            conf['discovered'][provider_name] = {
+                'fingerprint': fingerprint,
+                'libpath': (found and getattr(provider, 'libpath', None)) or '',
+                'version': (found and provider.version) or '',
+            }
+
+
+def provider_fingerprint(provider_name):
+    '''
+    Fingerprint the files which a provider's discovery handler reads on this platform
+
+    returns:
+        hex digest, or None if the provider must always be discovered
+    '''
+    func_name = '_sources_{}_{}'.format(provider_name, platform.system())
+    if func_name not in globals():
+        return None
+
+    fingerprint = hashlib.md5()
+    for path in globals()[func_name]():
+        try:
+            st = os.stat(path)
+            fingerprint.update('{}\0{!r}\0{}\0'.format(path, st.st_mtime, st.st_size).encode('utf8'))
+        except OSError:
+            fingerprint.update('{}\0missing\0'.format(path).encode('utf8'))
+    return fingerprint.hexdigest()
+
+
+def _sources_kindle_Darwin():
+    return [KINDLE_INFO_PLIST] + [os.path.expanduser(p) for p in KINDLE_PREFS_PLISTS]
+
+
+def _sources_calibre_Darwin():
+    return [os.path.join(_calibre_config_dir_Darwin(), 'global.py.json')]
+
+
+def _sources_calibre_Linux():
+    return [os.path.join(_calibre_config_dir_Linux(), 'global.py.json')]
 
-def _handle_home_Darwin(provider):
+
+def _handle_home_Darwin(provider, conf):
     # if OGRE_HOME is not set, just skip
     if not provider.libpath:
         raise EbookHomeUnavailableWarning
 
 
-def _handle_kindle_Darwin(provider):
+def _handle_kindle_Darwin(provider, conf):
     try:
         # extract Kindle version
-        provider.version = plistlib.readPlist('/Applications/Kindle.app/Contents/Info.plist')['CFBundleShortVersionString']
+        provider.version = plistlib.readPlist(KINDLE_INFO_PLIST)['CFBundleShortVersionString']
     except (IOError, KeyError) as e:
         raise KindleUnavailableWarning('Kindle for Mac not installed')
 
@@ -150,10 +412,7 @@ def _handle_kindle_Darwin(provider):
         raise KindleUnavailableWarning('You need to install version 1.17.1 or lower to use OGRE')
 
     # search for Kindle prefs on OSX
-    plists = [
-        os.path.expanduser('~/Library/Containers/com.amazon.Kindle/Data/Library/Preferences/com.amazon.Kindle.plist'),
-        os.path.expanduser('~/Library/Preferences/com.amazon.Kindle.plist'),
-    ]
+    plists = [os.path.expanduser(p) for p in KINDLE_PREFS_PLISTS]
 
     inner_excp = None
 
@@ -190,7 +449,44 @@ def _handle_kindle_Darwin(provider):
         )
 
 
-def _handle_ade_Darwin(provider):
+def _calibre_config_dir_Darwin():
+    return os.path.expanduser('~/Library/Preferences/calibre')
+
+
+def _calibre_config_dir_Linux():
+    return os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'calibre')
+
+
+def _handle_calibre_Darwin(provider, conf):
+    _find_calibre_library(provider, _calibre_config_dir_Darwin())
+
+
+def _handle_calibre_Linux(provider, conf):
+    _find_calibre_library(provider, _calibre_config_dir_Linux())
+
+
+def _find_calibre_library(provider, calibre_config_dir):
+    candidates = []
+
+    try:
+        # calibre records the library last opened in its global prefs
+        with open(os.path.join(calibre_config_dir, 'global.py.json')) as f:
+            candidates.append(json.load(f).get('library_path'))
+    except (IOError, ValueError):
+        pass
+
+    # default location when calibre is first run
+    candidates.append(os.path.expanduser('~/Calibre Library'))
+
+    for libpath in candidates:
+        if libpath and os.path.exists(os.path.join(libpath, 'metadata.db')):
+            provider.libpath = libpath
+            return
+
+    raise CalibreUnavailableWarning('Calibre library not found')
+
+
+def _handle_ade_Darwin(provider, conf):
     # search for ADE on OSX
     manifest_path = os.path.expanduser('~/Documents/Digital Editions')
 
@@ -199,31 +495,76 @@ def _handle_ade_Darwin(provider):
         raise ADEUnavailableWarning('Adobe Digital Editions not installed')
 
     try:
-        def parse_manifest(path):
-            # parse XML plist file
-            with open(path, 'r') as f:
-                data = f.read()
-
-            # minidom is rubbish; but there's no nextSibling in ElementTree
-            dom = minidom.parseString(data)
-            el = next(iter(dom.getElementsByTagName('dp:content')), None)
-
-            if el is not None:
-                p = urlparse.urlparse(el.getAttribute('href'))
-                return urllib.unquote(
-                    os.path.abspath(os.path.join(p.netloc, p.path))
+        provider.paths = scan_ade_manifests(manifest_path, conf.get('ebook_cache'))
+
+    except Exception as e:
+        raise ADEProviderError(inner_excp=e)
+
+
+def scan_ade_manifests(manifest_dir, ebook_cache=None):
+    '''
+    Find the ebooks referenced by the ADE manifests in a directory. Manifests are
+    only parsed when their mtime differs from the one recorded in the cache.
+
+    returns:
+        list of tuple (path, suffix)
+    '''
+    known = ebook_cache.get_ade_manifests() if ebook_cache is not None else {}
+    changed = []
+    seen = set()
+    paths = []
+
+    for root, _, files in os.walk(manifest_dir):
+        for filename in files:
+            if not filename.endswith('.xml'):
+                continue
+
+            manifest = os.path.join(root, filename)
+            mtime = os.stat(manifest).st_mtime
+            seen.add(manifest)
+
+            if manifest in known and known[manifest][0] == mtime:
+                path = known[manifest][1]
+            else:
+                path = parse_ade_manifest(manifest)
+                changed.append((manifest, mtime, path))
+
+            if path is not None and os.path.exists(path):
+                paths.append(
+                    (path, os.path.splitext(path)[1][1:])
                 )
 
-        provider.paths = []
+    if ebook_cache is not None and (changed or set(known) - seen):
+        ebook_cache.update_ade_manifests(changed, set(known) - seen)
 
-        for root, _, files in os.walk(manifest_path):
-            for filename in files:
-                if filename.endswith('.xml'):
-                    path = parse_manifest(os.path.join(root, filename))
-                    if path is not None and os.path.exists(path):
-                        provider.paths.append(
-                            (path, os.path.splitext(path)[1][1:])
-                        )
+    return paths
 
-    except Exception as e:
-        raise ADEProviderError(inner_excp=e)
+
+def parse_ade_manifest(manifest):
+    '''
+    Return the ebook path from the href of the first dp:content element in an ADE
+    manifest. The XML is streamed, and parsing stops at that element.
+    '''
+    # map of namespace prefix to URI, as declared so far in the document
+    namespaces = {}
+
+    with open(manifest, 'rb') as f:
+        try:
+            for event, item in ElementTree.iterparse(f, events=(str('start-ns'), str('start'))):
+                if event == 'start-ns':
+                    namespaces[item[0]] = item[1]
+
+                elif 'dp' in namespaces and item.tag == '{{{}}}content'.format(namespaces['dp']):
+                    href = item.get('href')
+                    if not href:
+                        return None
+
+                    p = urlparse.urlparse(href)
+                    return urllib.unquote(
+                        os.path.abspath(os.path.join(p.netloc, p.path))
+                    )
+
+        except ElementTree.ParseError as e:
+            prntr.debug('Failed parsing ADE manifest {}: {}'.format(manifest, e))
+
+    return None
@@ -4,14 +4,17 @@ import base64
 import contextlib
 import functools
 import hashlib
+import multiprocessing
 import random
 import shutil
 import string
 import sys
 import tempfile
+from multiprocessing.pool import ThreadPool
 
 from ogreclient import exceptions
 from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.throttle import read_limiter
 
 
 prntr = CliPrinter.get_printer()
@@ -43,6 +46,8 @@ def compute_md5(filepath, buf_size=524288):
         fp.seek(0)
         s = fp.read(buf_size)
         while s:
+            # optionally limit disk bandwidth used while hashing
+            read_limiter.consume(len(s))
             m.update(s)
             s = fp.read(buf_size)
 
@@ -71,6 +76,35 @@ def make_temp_directory():
         shutil.rmtree(temp_dir)
 
 
+def imap_unordered(func, items, processes):
+    '''
+    Call func on each item in a pool of threads, yielding results as they complete.
+    func should return errors rather than raise them.
+
+    Wrap the iteration in contextlib.closing, so outstanding calls are abandoned
+    if the caller stops early.
+    '''
+    pool = ThreadPool(processes)
+    try:
+        results = pool.imap_unordered(func, items)
+        while True:
+            try:
+                # wait with a timeout, else Ctrl-C is not delivered on py2
+                yield results.next(timeout=0.5)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+
+        pool.close()
+    except BaseException:
+        # abandon queued calls on error or Ctrl-C
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for x in range(size))
 
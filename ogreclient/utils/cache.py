@@ -1,15 +1,110 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import datetime
 import json
 import os
 import sqlite3
 
 from ogreclient import exceptions
 from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.utils import codec
 from ogreclient.utils.printer import CliPrinter
-
-__CACHEVERSION__ = 1
+from ogreclient.utils.profiler import profiler
+
+__CACHEVERSION__ = 10
+
+# SQL statements which upgrade the cache to each version from the one before
+MIGRATIONS = {
+    2: [
+        # ledger of failed books already uploaded during a debug run
+        '''CREATE TABLE errord_uploads (
+              file_hash TEXT PRIMARY KEY,
+              uploaded_at TEXT
+        )''',
+    ],
+    3: [
+        # write-ahead journal of the current sync, for resuming an interrupted run
+        '''CREATE TABLE sync_journal (
+              kind TEXT,
+              key TEXT,
+              data TEXT NULL,
+              done INT DEFAULT 0,
+              PRIMARY KEY (kind, key)
+        )''',
+    ],
+    4: [
+        # ebook path referenced by each ADE manifest, keyed on the manifest's mtime
+        '''CREATE TABLE ade_manifests (
+              path TEXT PRIMARY KEY,
+              mtime REAL,
+              book_path TEXT NULL
+        )''',
+    ],
+    5: [
+        # ebooks last enumerated from each provider, valid while its change token matches
+        '''CREATE TABLE provider_listings (
+              name TEXT PRIMARY KEY,
+              token TEXT,
+              ebooks TEXT
+        )''',
+    ],
+    6: [
+        # ebook metadata keyed by content, so it survives renames and moves
+        '''CREATE TABLE contents (
+              file_hash TEXT PRIMARY KEY,
+              data TEXT
+        )''',
+        '''INSERT OR IGNORE INTO contents
+              SELECT file_hash, data FROM ebooks WHERE file_hash IS NOT NULL AND data IS NOT NULL''',
+        'UPDATE ebooks SET data = NULL WHERE file_hash IS NOT NULL',
+        # identity of the file at each path, for detecting renames and changes
+        'ALTER TABLE ebooks ADD COLUMN dev INT',
+        'ALTER TABLE ebooks ADD COLUMN inode INT',
+        'ALTER TABLE ebooks ADD COLUMN size INT',
+        'ALTER TABLE ebooks ADD COLUMN mtime REAL',
+        'CREATE INDEX ebooks_inode ON ebooks (inode)',
+        'CREATE INDEX ebooks_file_hash ON ebooks (file_hash)',
+    ],
+    7: [
+        # the main metadata fields as columns, queryable without decoding the JSON blob
+        'ALTER TABLE contents ADD COLUMN format TEXT',
+        'ALTER TABLE contents ADD COLUMN size INT',
+        'ALTER TABLE contents ADD COLUMN authortitle TEXT',
+        'ALTER TABLE contents ADD COLUMN title TEXT',
+        'ALTER TABLE contents ADD COLUMN firstname TEXT',
+        'ALTER TABLE contents ADD COLUMN lastname TEXT',
+        'ALTER TABLE contents ADD COLUMN meta_version INT DEFAULT 0',
+        lambda c: _backfill_meta_columns(c),
+        'CREATE INDEX contents_authortitle ON contents (authortitle)',
+        'CREATE INDEX ebooks_ebook_id ON ebooks (ebook_id)',
+    ],
+    8: [
+        # books on a drive which is not mounted are kept for a while, rather than removed
+        'ALTER TABLE ebooks ADD COLUMN missing_since TEXT',
+        'ALTER TABLE meta ADD COLUMN last_gc TEXT',
+    ],
+    9: [
+        # metadata is stored in a binary encoding, rather than JSON
+        lambda c: _reencode_contents(c),
+    ],
+    10: [
+        # the provider which found a book belongs to its path, not to its content
+        'ALTER TABLE ebooks ADD COLUMN source TEXT',
+        lambda c: _move_source_to_ebooks(c),
+    ],
+}
+
+# version of the metadata extracted from ebooks; cached books with older metadata
+# are scanned again. Increment when EbookObject.get_metadata() changes its output.
+META_VERSION = 1
+
+# columns for EbookObject.deserialize, with the metadata from the contents table
+_EBOOK_COLUMNS = (
+    'e.file_hash, e.ebook_id, COALESCE(c.data, e.data), e.drmfree, e.skip, '
+    'c.format, c.size, c.authortitle, c.meta_version, e.source'
+)
+_EBOOK_JOIN = 'ebooks e LEFT JOIN contents c ON c.file_hash = e.file_hash'
 
 
 prntr = CliPrinter.get_printer()
@@ -44,6 +139,10 @@ class Cache:
             finally:
                 if conn is not None:
                     conn.close()
+
+            if must_init_cache:
+                # remove the broken cache before recreating
+                os.remove(self.ebook_cache_path)
         else:
             # first create of cache db
             must_init_cache = True
@@ -56,7 +155,25 @@ class Cache:
 
 
     def cache_migrate(self, from_version, to_version):
-        pass
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+
+            # apply each version's migration in turn; steps are SQL, or functions
+            # which take a cursor
+            for version in range(from_version + 1, to_version + 1):
+                for sql in MIGRATIONS[version]:
+                    if callable(sql):
+                        sql(c)
+                    else:
+                        c.execute(sql)
+                c.execute('UPDATE meta SET version = ?', (version,))
+                conn.commit()
+
+        except Exception as e:
+            raise CacheInitError(inner_excp=e)
+        finally:
+            conn.close()
 
 
     def init_cache(self):
@@ -75,19 +192,34 @@ class Cache:
             )
             c.execute('CREATE TABLE meta (version INT PRIMARY KEY)')
             conn.commit()
-            c.execute('INSERT INTO meta VALUES (?)', (__CACHEVERSION__,))
+            c.execute('INSERT INTO meta VALUES (?)', (1,))
             conn.commit()
         except Exception as e:
             raise CacheInitError(inner_excp=e)
         finally:
             conn.close()
 
+        # the base schema is version 1; migrate up to current
+        self.cache_migrate(1, __CACHEVERSION__)
+
 
-    def get_ebook(self, path, file_hash=None):
+    @profiler.timed('sqlite')
+    def get_ebook(self, path, file_hash=None, st=None):
+        '''
+        Load an ebook from the cache by path
+
+        params:
+            file_hash: verify the cached book has this hash, else remove it
+            st: os.stat of the file; the cached book is ignored if the file's
+                size or mtime has changed since it was stored
+        '''
         conn = sqlite3.connect(self.ebook_cache_path)
         try:
             c = conn.cursor()
-            c.execute('SELECT file_hash, ebook_id, data, drmfree, skip FROM ebooks WHERE path = ?', (path,))
+            c.execute(
+                'SELECT {}, e.size, e.mtime FROM {} WHERE e.path = ?'.format(_EBOOK_COLUMNS, _EBOOK_JOIN),
+                (path,)
+            )
             obj = c.fetchone()
             if obj is not None:
                 # verify file_hash matches between cache and filesystem
@@ -95,6 +227,13 @@ class Cache:
                     c.execute('DELETE FROM ebooks WHERE path = ?', (path,))
                     conn.commit()
                     raise exceptions.MissingFromCacheError
+
+                # file modified since it was cached
+                if st is not None and obj[10] is not None and (obj[10], obj[11]) != (st.st_size, st.st_mtime):
+                    raise exceptions.MissingFromCacheError
+
+                if _is_stale(obj):
+                    raise exceptions.MissingFromCacheError
             else:
                 raise exceptions.MissingFromCacheError
 
@@ -108,48 +247,138 @@ class Cache:
         return EbookObject.deserialize(path, obj)
 
 
+    @profiler.timed('sqlite')
+    def find_moved_ebook(self, path, st):
+        '''
+        Find a cached book with the same inode, size and mtime as the file at path,
+        which was renamed, moved or hard linked. The cache entry is moved to path.
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                'SELECT e.path, {} FROM {} '
+                'WHERE e.inode = ? AND e.dev = ? AND e.size = ? AND e.mtime = ? AND e.path != ?'.format(
+                    _EBOOK_COLUMNS, _EBOOK_JOIN
+                ),
+                (st.st_ino, st.st_dev, st.st_size, st.st_mtime, path)
+            )
+            obj = c.fetchone()
+            if obj is None or _is_stale(obj[1:]):
+                raise exceptions.MissingFromCacheError
+
+            c.execute('DELETE FROM ebooks WHERE path = ?', (path,))
+
+            if os.path.exists(obj[0]):
+                # a hard link; both paths remain
+                c.execute(
+                    'INSERT INTO ebooks (path, file_hash, ebook_id, drmfree, skip, dev, inode, size, mtime, source) '
+                    'SELECT ?, file_hash, ebook_id, drmfree, skip, dev, inode, size, mtime, source '
+                    'FROM ebooks WHERE path = ?', (path, obj[0])
+                )
+            else:
+                c.execute('UPDATE ebooks SET path = ? WHERE path = ?', (path, obj[0]))
+            conn.commit()
+
+        except exceptions.MissingFromCacheError as e:
+            raise e
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+        return EbookObject.deserialize(path, obj[1:])
+
+
+    @profiler.timed('sqlite')
+    def get_ebook_by_content(self, path, file_hash, source=None):
+        '''
+        Load the metadata of a book already seen at another path, by its file_hash,
+        with the source of the new path
+
+        Content whose metadata could not be extracted is not returned, so a copy of
+        a corrupt book fails again. Whether the copy is a duplicate to skip is
+        decided afresh during the scan.
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                'SELECT c.file_hash, e.ebook_id, c.data, COALESCE(e.drmfree, 0), 0, '
+                'c.format, c.size, c.authortitle, c.meta_version, ? FROM contents c '
+                'LEFT JOIN ebooks e ON e.file_hash = c.file_hash '
+                'WHERE c.file_hash = ? AND c.authortitle IS NOT NULL LIMIT 1',
+                (source, file_hash)
+            )
+            obj = c.fetchone()
+            if obj is None or _is_stale(obj):
+                raise exceptions.MissingFromCacheError
+
+        except exceptions.MissingFromCacheError as e:
+            raise e
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+        return EbookObject.deserialize(path, obj)
+
+
+    @profiler.timed('sqlite')
     def store_ebook(self, ebook_obj):
         # serialize the ebook object for storage
-        data = ebook_obj.serialize(for_cache=True)
+        data = _encode_data(ebook_obj.serialize(for_cache=True))
+
+        dev, inode, size, mtime = _stat_columns(ebook_obj.path)
 
         conn = sqlite3.connect(self.ebook_cache_path)
         try:
             c = conn.cursor()
-            c.execute('SELECT drmfree FROM ebooks WHERE path = ?', (ebook_obj.path,))
-            obj = c.fetchone()
-            # update if exists, otherwise insert
-            if obj is not None:
-                values = ''
-                params = []
 
-                # build update parameter list
-                values += 'file_hash = ?, '
-                params.append(ebook_obj.file_hash)
-                values += 'ebook_id = ?, '
-                params.append(ebook_obj.ebook_id)
-                values += 'data = ?, '
-                params.append(json.dumps(data))
-                values += 'drmfree = ?, '
-                params.append(int(ebook_obj.drmfree))
-                values += 'skip = ?'
-                params.append(int(ebook_obj.skip))
+            values = (
+                ebook_obj.file_hash,
+                ebook_obj.ebook_id,
+                int(ebook_obj.drmfree),
+                int(ebook_obj.skip),
+                dev, inode, size, mtime,
+                (ebook_obj.meta or {}).get('source'),
+            )
 
-                # where path
-                params.append(ebook_obj.path)
+            # metadata is stored against the book's content
+            c.execute('SELECT data, meta_version FROM contents WHERE file_hash = ?', (ebook_obj.file_hash,))
+            obj = c.fetchone()
+            if obj is None:
+                c.execute(
+                    'INSERT INTO contents (file_hash, data, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                        _META_COLUMNS
+                    ), (ebook_obj.file_hash, data) + _meta_columns(ebook_obj)
+                )
+            elif tuple(obj) != (data, META_VERSION):
+                c.execute(
+                    'UPDATE contents SET data = ?, {} WHERE file_hash = ?'.format(
+                        ', '.join('{} = ?'.format(col) for col in _META_COLUMNS.split(', '))
+                    ), (data,) + _meta_columns(ebook_obj) + (ebook_obj.file_hash,)
+                )
 
+            c.execute(
+                'SELECT file_hash, ebook_id, drmfree, skip, dev, inode, size, mtime, source FROM ebooks '
+                'WHERE path = ?',
+                (ebook_obj.path,)
+            )
+            obj = c.fetchone()
+            # update if changed, otherwise insert; most books are stored unchanged on each scan,
+            # and skipping those avoids rewriting their index entries
+            if obj is not None and tuple(obj) != values:
                 c.execute(
-                    'UPDATE ebooks SET {} WHERE path = ?'.format(values), params
+                    'UPDATE ebooks SET file_hash = ?, ebook_id = ?, data = NULL, drmfree = ?, skip = ?, '
+                    'dev = ?, inode = ?, size = ?, mtime = ?, source = ? WHERE path = ?',
+                    values + (ebook_obj.path,)
                 )
-            else:
-                params = (
-                    ebook_obj.path,
-                    ebook_obj.file_hash,
-                    ebook_obj.ebook_id,
-                    json.dumps(data),
-                    int(ebook_obj.drmfree),
-                    int(ebook_obj.skip)
+            elif obj is None:
+                c.execute(
+                    'INSERT INTO ebooks (path, file_hash, ebook_id, drmfree, skip, dev, inode, size, mtime, source) '
+                    'VALUES (?,?,?,?,?,?,?,?,?,?)', (ebook_obj.path,) + values
                 )
-                c.execute('INSERT INTO ebooks VALUES (?,?,?,?,?,?)', params)
 
             # write the cache DB
             conn.commit()
@@ -169,11 +398,12 @@ class Cache:
             conn.close()
 
 
+    @profiler.timed('sqlite')
     def update_ebook_property(self, path, file_hash=None, ebook_id=None, drmfree=None, skip=None):
         conn = sqlite3.connect(self.ebook_cache_path)
         try:
             c = conn.cursor()
-            c.execute('SELECT drmfree FROM ebooks WHERE path = ?', (path,))
+            c.execute('SELECT drmfree, file_hash FROM ebooks WHERE path = ?', (path,))
             obj = c.fetchone()
             if obj is None:
                 raise exceptions.MissingFromCacheError
@@ -186,6 +416,15 @@ class Cache:
                     values += 'file_hash = ?, '
                     params.append(file_hash)
 
+                    # the file was rewritten; its metadata carries over to the new content
+                    c.execute(
+                        'INSERT OR REPLACE INTO contents (file_hash, data, {0}) '
+                        'SELECT ?, data, {0} FROM contents WHERE file_hash = ?'.format(_META_COLUMNS),
+                        (file_hash, obj[1])
+                    )
+                    values += 'dev = ?, inode = ?, size = ?, mtime = ?, '
+                    params.extend(_stat_columns(path))
+
                 if ebook_id is not None:
                     values += 'ebook_id = ?, '
                     params.append(ebook_id)
@@ -214,6 +453,556 @@ class Cache:
             conn.close()
 
 
+    @profiler.timed('sqlite')
+    def get_errord_uploaded(self, file_hashes):
+        '''
+        Return the subset of file_hashes already uploaded during a debug run
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            found = set()
+
+            # query in batches to stay under sqlite's variable limit
+            file_hashes = list(file_hashes)
+            for i in range(0, len(file_hashes), 500):
+                batch = file_hashes[i:i+500]
+                c.execute(
+                    'SELECT file_hash FROM errord_uploads WHERE file_hash IN ({})'.format(
+                        ','.join('?' * len(batch))
+                    ), batch
+                )
+                found.update(row[0] for row in c.fetchall())
+
+            return found
+
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def store_errord_uploaded(self, file_hash):
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                'INSERT OR REPLACE INTO errord_uploads VALUES (?, ?)',
+                (file_hash, datetime.datetime.utcnow().isoformat())
+            )
+            conn.commit()
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def get_ebooks_by_file_hash(self, file_hashes):
+        '''
+        Return a dict of file_hash:EbookObject for the file_hashes found in the cache
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            ebooks = {}
+
+            # query in batches to stay under sqlite's variable limit
+            file_hashes = list(file_hashes)
+            for i in range(0, len(file_hashes), 500):
+                batch = file_hashes[i:i+500]
+                c.execute(
+                    'SELECT e.path, {} FROM {} WHERE e.file_hash IN ({})'.format(
+                        _EBOOK_COLUMNS, _EBOOK_JOIN, ','.join('?' * len(batch))
+                    ), batch
+                )
+                for row in c.fetchall():
+                    ebooks[row[1]] = EbookObject.deserialize(row[0], row[1:])
+
+            return ebooks
+
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def store_journal(self, kind, entries):
+        '''
+        Record a step of the sync in the journal, with its list of (key, data) work items.
+        The step and all its items are written in a single transaction.
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM sync_journal WHERE kind = ?', (kind,))
+            # an empty key marks the step itself as recorded
+            c.execute('INSERT INTO sync_journal VALUES (?, ?, NULL, 1)', (kind, ''))
+            c.executemany(
+                'INSERT INTO sync_journal VALUES (?, ?, ?, 0)',
+                ((kind, key, json.dumps(data) if data is not None else None) for key, data in entries)
+            )
+            conn.commit()
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def mark_journal_done(self, kind, key):
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute('UPDATE sync_journal SET done = 1 WHERE kind = ? AND key = ?', (kind, key))
+            conn.commit()
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def get_journal(self, kind):
+        '''
+        Return the list of (key, data, done) items recorded for a sync step,
+        or None if the step was not reached
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute('SELECT key, data, done FROM sync_journal WHERE kind = ? ORDER BY rowid', (kind,))
+            rows = c.fetchall()
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+        if not rows:
+            return None
+
+        return [
+            (key, json.loads(data) if data is not None else None, bool(done))
+            for key, data, done in rows if key != ''
+        ]
+
+
+    @profiler.timed('sqlite')
+    def clear_journal(self):
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM sync_journal')
+            conn.commit()
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def get_ade_manifests(self):
+        '''
+        Return a dict of manifest path:(mtime, book_path) for all known ADE manifests
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute('SELECT path, mtime, book_path FROM ade_manifests')
+            return {row[0]: (row[1], row[2]) for row in c.fetchall()}
+
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def update_ade_manifests(self, changed, removed):
+        '''
+        Store (path, mtime, book_path) for changed manifests, and forget removed ones
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.executemany('INSERT OR REPLACE INTO ade_manifests VALUES (?, ?, ?)', changed)
+            c.executemany('DELETE FROM ade_manifests WHERE path = ?', ((path,) for path in removed))
+            conn.commit()
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def get_provider_listing(self, name, token):
+        '''
+        Return the ebooks last found by a provider, or None if its change token differs
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute('SELECT ebooks FROM provider_listings WHERE name = ? AND token = ?', (name, token))
+            row = c.fetchone()
+            if row is None:
+                return None
+            return [tuple(item) for item in json.loads(row[0])]
+
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def store_provider_listing(self, name, token, ebooks):
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute(
+                'INSERT OR REPLACE INTO provider_listings VALUES (?, ?, ?)',
+                (name, token, json.dumps(ebooks))
+            )
+            conn.commit()
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def get_gc_candidates(self):
+        '''
+        Return a list of (path, dev, missing_since) for every cached book
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.execute('SELECT path, dev, missing_since FROM ebooks')
+            return c.fetchall()
+
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def gc_ebooks(self, remove, tombstone, restore, now):
+        '''
+        Remove the books at some paths, mark books at others as missing since now, and
+        clear the mark from books which have reappeared. Metadata no longer referenced
+        by any path is removed.
+
+        returns:
+            number of metadata rows removed
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            c.executemany('DELETE FROM ebooks WHERE path = ?', ((path,) for path in remove))
+            c.executemany(
+                'UPDATE ebooks SET missing_since = ? WHERE path = ?', ((now, path) for path in tombstone)
+            )
+            c.executemany(
+                'UPDATE ebooks SET missing_since = NULL WHERE path = ?', ((path,) for path in restore)
+            )
+            c.execute(
+                'DELETE FROM contents WHERE file_hash NOT IN '
+                '(SELECT file_hash FROM ebooks WHERE file_hash IS NOT NULL)'
+            )
+            orphans = c.rowcount
+            conn.commit()
+            return orphans
+
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    def vacuum(self):
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            # rebuild the database file, returning free pages to the filesystem
+            conn.execute('VACUUM')
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    def get_usage(self):
+        '''
+        Return the size of the cache file, and the number of books and metadata rows
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            return {
+                'size': os.path.getsize(self.ebook_cache_path),
+                'ebooks': c.execute('SELECT COUNT(*) FROM ebooks').fetchone()[0],
+                'missing': c.execute('SELECT COUNT(missing_since) FROM ebooks').fetchone()[0],
+                'contents': c.execute('SELECT COUNT(*) FROM contents').fetchone()[0],
+            }
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def get_stats(self):
+        '''
+        Summarise the library as of the last scan, without reading any ebooks
+
+        returns:
+            dict of formats (list of (format, books, bytes)), and counts of duplicate,
+            corrupt, skipped, drmfree and missing books
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+
+            # books kept after deduplication, counting copies of the same file once
+            c.execute(
+                'SELECT format, COUNT(*), SUM(size), SUM(drmfree) FROM ('
+                '  SELECT DISTINCT e.file_hash, c.format, c.size, e.drmfree FROM {} '
+                '  WHERE e.skip = 0 AND e.missing_since IS NULL AND c.authortitle IS NOT NULL'
+                ') GROUP BY format ORDER BY COUNT(*) DESC'.format(_EBOOK_JOIN)
+            )
+            formats = c.fetchall()
+
+            # extra copies of the same file, and the same book in the same format
+            exact = c.execute(
+                'SELECT COUNT(*) - COUNT(DISTINCT file_hash) FROM ebooks '
+                'WHERE file_hash IS NOT NULL AND missing_since IS NULL'
+            ).fetchone()[0]
+            authortitle = c.execute(
+                'SELECT COALESCE(SUM(books - 1), 0) FROM ('
+                '  SELECT COUNT(DISTINCT e.file_hash) AS books FROM {} '
+                '  WHERE e.missing_since IS NULL AND c.authortitle IS NOT NULL '
+                '  GROUP BY c.authortitle, c.format'
+                ') WHERE books > 1'.format(_EBOOK_JOIN)
+            ).fetchone()[0]
+
+            # books which failed metadata extraction have no authortitle
+            corrupt, skipped, missing = c.execute(
+                'SELECT '
+                '  COALESCE(SUM(e.missing_since IS NULL AND e.skip = 1 AND c.authortitle IS NULL), 0), '
+                '  COALESCE(SUM(e.missing_since IS NULL AND e.skip = 1), 0), '
+                '  COUNT(e.missing_since) '
+                'FROM {}'.format(_EBOOK_JOIN)
+            ).fetchone()
+
+            return {
+                'formats': formats,
+                'duplicate': exact + authortitle,
+                'corrupt': corrupt,
+                'skipped': skipped,
+                'drmfree': sum(row[3] or 0 for row in formats),
+                'missing': missing,
+            }
+
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    def get_last_gc(self):
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            return conn.execute('SELECT last_gc FROM meta').fetchone()[0]
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    def set_last_gc(self, when):
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            conn.execute('UPDATE meta SET last_gc = ?', (when,))
+            conn.commit()
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def get_snapshot_rows(self):
+        '''
+        Return the contents and ebooks rows to export, with decoded data blobs.
+        Device and inode numbers are local to this machine, and are not exported.
+
+        returns:
+            tuple of lists of dicts
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            contents = [
+                dict(zip(('file_hash', 'data', 'meta_version'), (row[0], codec.decode(row[1]), row[2])))
+                for row in c.execute(
+                    'SELECT file_hash, data, meta_version FROM contents WHERE data IS NOT NULL'
+                )
+            ]
+            ebooks = [
+                dict(zip(_SNAPSHOT_EBOOK_COLUMNS, row))
+                for row in c.execute(
+                    'SELECT {} FROM ebooks WHERE missing_since IS NULL'.format(', '.join(_SNAPSHOT_EBOOK_COLUMNS))
+                )
+            ]
+            return contents, ebooks
+
+        except Exception as e:
+            raise CacheReadError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+    @profiler.timed('sqlite')
+    def import_snapshot_rows(self, contents, ebooks):
+        '''
+        Load rows as returned by get_snapshot_rows(), replacing any cached books
+        at the same paths or with the same ebook_ids. Each ebooks row may also
+        carry its file's dev and inode.
+        '''
+        conn = sqlite3.connect(self.ebook_cache_path)
+        try:
+            c = conn.cursor()
+            for row in contents:
+                data = row['data']
+                meta = data.get('meta') or {}
+                c.execute(
+                    'INSERT OR REPLACE INTO contents (file_hash, data, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'.format(
+                        _META_COLUMNS
+                    ), (
+                        row['file_hash'], _encode_data(data), data.get('format'), data.get('size'),
+                        data.get('authortitle'), meta.get('title'), meta.get('firstname'), meta.get('lastname'),
+                        row['meta_version'],
+                    )
+                )
+
+            columns = _SNAPSHOT_EBOOK_COLUMNS + ('dev', 'inode')
+            c.executemany(
+                'INSERT OR REPLACE INTO ebooks ({}) VALUES ({})'.format(
+                    ', '.join(columns), ', '.join('?' for _ in columns)
+                ),
+                (tuple(row.get(col) for col in columns) for row in ebooks)
+            )
+            conn.commit()
+
+        except Exception as e:
+            raise CacheWriteError(inner_excp=e)
+        finally:
+            conn.close()
+
+
+_SNAPSHOT_EBOOK_COLUMNS = ('path', 'file_hash', 'ebook_id', 'drmfree', 'skip', 'size', 'mtime', 'source')
+
+
+_META_COLUMNS = 'format, size, authortitle, title, firstname, lastname, meta_version'
+
+
+def _meta_columns(ebook_obj):
+    '''
+    Return the values of the contents table's metadata columns for an EbookObject
+    '''
+    meta = ebook_obj.meta or {}
+    return (
+        ebook_obj.format,
+        ebook_obj.size,
+        ebook_obj.authortitle,
+        meta.get('title'),
+        meta.get('firstname'),
+        meta.get('lastname'),
+        META_VERSION,
+    )
+
+
+def _is_stale(row):
+    # row of _EBOOK_COLUMNS; metadata from an older version of ogreclient is scanned again
+    return (row[8] or 0) < META_VERSION
+
+
+def _backfill_meta_columns(c):
+    '''
+    Migration step which fills the metadata columns from each row's JSON blob
+    '''
+    rows = c.execute('SELECT file_hash, data FROM contents').fetchall()
+    for file_hash, data in rows:
+        try:
+            data = codec.decode(data)
+            meta = data.get('meta') or {}
+            values = (
+                data['format'], data['size'], data['authortitle'],
+                meta.get('title'), meta.get('firstname'), meta.get('lastname'),
+            )
+        except (TypeError, ValueError, KeyError):
+            # unreadable rows are left at meta_version 0, and scanned again
+            continue
+
+        c.execute(
+            'UPDATE contents SET format = ?, size = ?, authortitle = ?, title = ?, firstname = ?, '
+            'lastname = ?, meta_version = 1 WHERE file_hash = ?', values + (file_hash,)
+        )
+
+
+def _reencode_contents(c):
+    '''
+    Migration step which rewrites each row's JSON blob with the default codec
+    '''
+    rows = c.execute('SELECT file_hash, data FROM contents WHERE data IS NOT NULL').fetchall()
+    for file_hash, data in rows:
+        if codec.is_binary(data):
+            continue
+        try:
+            data = _encode_data(codec.decode(data))
+        except ValueError:
+            # unreadable rows are rewritten when the book is next scanned
+            continue
+        c.execute('UPDATE contents SET data = ? WHERE file_hash = ?', (data, file_hash))
+
+
+def _move_source_to_ebooks(c):
+    '''
+    Migration step which moves the source from each row's data blob to the
+    ebooks stored with that content
+    '''
+    rows = c.execute('SELECT file_hash, data FROM contents WHERE data IS NOT NULL').fetchall()
+    for file_hash, data in rows:
+        try:
+            data = codec.decode(data)
+            source = data['meta'].pop('source', None)
+        except (TypeError, ValueError, KeyError, AttributeError):
+            # unreadable rows are rewritten when the book is next scanned
+            continue
+        c.execute('UPDATE ebooks SET source = ? WHERE file_hash = ?', (source, file_hash))
+        c.execute('UPDATE contents SET data = ? WHERE file_hash = ?', (_encode_data(data), file_hash))
+
+
+def _encode_data(obj):
+    data = codec.encode(obj)
+    # binary payloads are stored as BLOBs
+    return sqlite3.Binary(data) if codec.is_binary(data) else data
+
+
+def _stat_columns(path):
+    '''
+    Return (dev, inode, size, mtime) of a file, or Nones if it is missing
+    '''
+    try:
+        st = os.stat(path)
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime
+    except OSError:
+        return None, None, None, None
+
+
 class CacheInitError(exceptions.OgreException):
     pass
 
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import marshal
+
+
+# binary payloads start with a NUL, which cannot begin a JSON document, then
+# one byte identifying the codec
+_MAGIC = b'\x00'
+
+
+class JsonCodec(object):
+    '''
+    Plain JSON text, as written by ogreclient before binary payloads
+    '''
+    name = 'json'
+    tag = None
+
+    def encode(self, obj):
+        return json.dumps(obj)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MarshalCodec(object):
+    '''
+    marshal, pinned to format version 2 so that payloads stay readable across
+    Python 2.x releases
+    '''
+    name = 'marshal'
+    tag = b'm'
+    version = 2
+
+    def encode(self, obj):
+        return _MAGIC + self.tag + marshal.dumps(obj, self.version)
+
+    def decode(self, data):
+        return marshal.loads(data[2:])
+
+
+_json = JsonCodec()
+
+# codecs which can decode a binary payload, by tag byte
+CODECS = {}
+
+# codec for newly written payloads
+DEFAULT_CODEC = None
+
+
+def register(codec, default=False):
+    '''
+    Add a binary codec; payloads already written with its tag become readable
+    '''
+    global DEFAULT_CODEC
+    CODECS[codec.tag] = codec
+    if default:
+        DEFAULT_CODEC = codec
+
+
+register(MarshalCodec(), default=True)
+
+
+def encode(obj, codec=None):
+    '''
+    Encode an object of JSON types as a payload
+
+    returns:
+        bytes for a binary codec, or a JSON string
+    '''
+    return (codec or DEFAULT_CODEC or _json).encode(obj)
+
+
+def decode(data):
+    '''
+    Decode a payload written by encode(), or a JSON string
+    '''
+    if is_binary(data):
+        data = bytes(data)
+        try:
+            codec = CODECS[data[1:2]]
+        except KeyError:
+            raise CodecError('Unknown codec tag: {!r}'.format(data[1:2]))
+        return codec.decode(data)
+
+    return _json.decode(data)
+
+
+def is_binary(data):
+    # sqlite returns BLOBs as buffer, and TEXT as unicode
+    return isinstance(data, (bytes, buffer)) and data[0:1] == _MAGIC
+
+
+class CodecError(ValueError):
+    pass
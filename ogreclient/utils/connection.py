@@ -1,7 +1,15 @@
 from __future__ import unicode_literals
 
+import io
+import os
+import uuid
+import zlib
+
 from ogreclient import exceptions
+from ogreclient.utils import imap_unordered
 from ogreclient.utils.printer import CliPrinter
+from ogreclient.utils.profiler import profiler
+from ogreclient.utils.throttle import upload_limiter, ThrottledFile
 
 import requests
 from requests.exceptions import ConnectionError, Timeout
@@ -9,6 +17,9 @@ from requests.exceptions import ConnectionError, Timeout
 
 prntr = CliPrinter.get_printer()
 
+# default number of concurrent requests to ogreserver
+MAX_CONNECTIONS = 4
+
 
 class OgreConnection(object):
     session_key = None
@@ -19,6 +30,17 @@ class OgreConnection(object):
         self.debug = debug
         self.ignore_ssl_errors = conf.get('ignore_ssl_errors', False)
 
+        # reuse HTTP connections to ogreserver across requests; the pool is sized
+        # for the concurrent calls made via imap_unordered
+        self.max_connections = conf.get('max_connections') or MAX_CONNECTIONS
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # cleared if ogreserver does not support delta uploads
+        self.delta_supported = True
+
         # hide SSL warnings barfed from urllib3
         if self.ignore_ssl_errors:
             requests.packages.urllib3.disable_warnings()
@@ -28,15 +50,16 @@ class OgreConnection(object):
             url = '{}://{}/login'.format(self.protocol, self.host)
             prntr.debug(url)
             # authenticate the user
-            resp = requests.post(
-                url,
-                json={
-                    'email': username,
-                    'password': password
-                },
-                verify=not self.ignore_ssl_errors,
-                timeout=5
-            )
+            with profiler.call('http'):
+                resp = self.session.post(
+                    url,
+                    json={
+                        'email': username,
+                        'password': password
+                    },
+                    verify=not self.ignore_ssl_errors,
+                    timeout=5
+                )
             # 502 in prod means Flask app is down
             if resp.status_code == 502:
                 raise exceptions.OgreserverDownError
@@ -56,6 +79,16 @@ class OgreConnection(object):
 
         return True
 
+    def imap_unordered(self, func, items):
+        '''
+        Call func on each item concurrently, up to max_connections at once, yielding
+        results as they complete. func should return errors rather than raise them.
+
+        Wrap the iteration in contextlib.closing, so outstanding calls are abandoned
+        if the caller stops early.
+        '''
+        return imap_unordered(func, items, self.max_connections)
+
     def _init_request(self, endpoint):
         # build correct URL to ogreserver
         url = '{}://{}/api/v1/{}'.format(self.protocol, self.host, endpoint)
@@ -69,9 +102,10 @@ class OgreConnection(object):
 
         try:
             # start request with streamed response
-            resp = requests.get(
-                url, headers=headers, stream=True, verify=not self.ignore_ssl_errors, timeout=5
-            )
+            with profiler.call('http'):
+                resp = self.session.get(
+                    url, headers=headers, stream=True, verify=not self.ignore_ssl_errors, timeout=5
+                )
 
         except (Timeout, ConnectionError) as e:
             raise exceptions.OgreserverDownError(inner_excp=e)
@@ -82,20 +116,60 @@ class OgreConnection(object):
 
         return resp, resp.headers.get('Content-length')
 
-    def upload(self, endpoint, ebook_obj, data=None):
+    def upload(self, endpoint, ebook_obj, data=None, filepath=None, compress=False):
         # setup URL and request headers
         url, headers = self._init_request(endpoint)
 
-        # create file part of multipart POST
-        files = {
-            'ebook': (ebook_obj.safe_name, open(ebook_obj.path, 'rb'))
-        }
+        try:
+            # filepath can supply a different file to upload for this ebook, such as a delta
+            with open(filepath or ebook_obj.path, 'rb') as f:
+                if compress:
+                    # gzip the body on the fly; sent chunked as the final size is unknown
+                    body = MultipartBody(data, 'ebook', ebook_obj.safe_name, f)
+                    payload = GzipStream(body, upload_limiter)
+                    headers['Content-Encoding'] = 'gzip'
+                else:
+                    # stream the multipart POST from disk, limited by the upload rate
+                    body = MultipartBody(data, 'ebook', ebook_obj.safe_name, ThrottledFile(f, upload_limiter))
+                    payload = body
+
+                headers['Content-Type'] = body.content_type
+
+                # upload some files and data as multipart
+                with profiler.call('http', nbytes=body.len):
+                    resp = self.session.post(
+                        url, headers=headers, data=payload, verify=not self.ignore_ssl_errors, timeout=5
+                    )
+
+                if compress:
+                    profiler.incr('compressed_bytes_saved', body.len - payload.sent)
+
+        except (Timeout, ConnectionError) as e:
+            raise exceptions.OgreserverDownError(inner_excp=e)
+
+        # error handle this bitch
+        if resp.status_code != 200:
+            raise exceptions.RequestError(resp.status_code)
+
+        # JSON response as usual
+        return resp.json()
+
+    def post_file(self, endpoint, fileobj, content_type='application/octet-stream', content_encoding=None):
+        # setup URL and request headers
+        url, headers = self._init_request(endpoint)
+        headers['Content-Type'] = content_type
+        if content_encoding is not None:
+            headers['Content-Encoding'] = content_encoding
+
+        # size of the body, from the current position to the end of the file
+        nbytes = os.fstat(fileobj.fileno()).st_size - fileobj.tell()
 
         try:
-            # upload some files and data as multipart
-            resp = requests.post(
-                url, headers=headers, data=data, files=files, verify=not self.ignore_ssl_errors, timeout=5
-            )
+            # file body is streamed by requests, never read fully into memory
+            with profiler.call('http', nbytes=nbytes):
+                resp = self.session.post(
+                    url, headers=headers, data=fileobj, verify=not self.ignore_ssl_errors, timeout=5
+                )
 
         except (Timeout, ConnectionError) as e:
             raise exceptions.OgreserverDownError(inner_excp=e)
@@ -112,16 +186,17 @@ class OgreConnection(object):
         url, headers = self._init_request(endpoint)
 
         try:
-            if data is not None:
-                # POST with JSON body
-                resp = requests.post(
-                    url, headers=headers, json=data, verify=not self.ignore_ssl_errors, timeout=5
-                )
-            else:
-                # GET
-                resp = requests.get(
-                    url, headers=headers, verify=not self.ignore_ssl_errors, timeout=5
-                )
+            with profiler.call('http'):
+                if data is not None:
+                    # POST with JSON body
+                    resp = self.session.post(
+                        url, headers=headers, json=data, verify=not self.ignore_ssl_errors, timeout=5
+                    )
+                else:
+                    # GET
+                    resp = self.session.get(
+                        url, headers=headers, verify=not self.ignore_ssl_errors, timeout=5
+                    )
 
         except (Timeout, ConnectionError) as e:
             raise exceptions.OgreserverDownError(inner_excp=e)
@@ -130,5 +205,86 @@ class OgreConnection(object):
         if resp.status_code != 200:
             raise exceptions.RequestError(resp.status_code)
 
+        # attribute the size of the request body to the current phase
+        profiler.count(nbytes=len(resp.request.body or b''))
+
         # replies are always JSON
         return resp.json()
+
+
+class MultipartBody(object):
+    '''
+    File-like multipart/form-data body, which reads the file part on demand
+    rather than building the whole request in memory
+    '''
+    def __init__(self, fields, name, filename, fileobj):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+
+        head = b''
+        for key, value in (fields or {}).iteritems():
+            # None values are dropped, as requests does
+            if value is None:
+                continue
+            head += self._part_header('form-data; name="{}"'.format(key))
+            head += value.encode('utf-8') if isinstance(value, unicode) else bytes(value)
+            head += b'\r\n'
+
+        if isinstance(filename, bytes):
+            filename = filename.decode('utf-8')
+        head += self._part_header('form-data; name="{}"; filename="{}"'.format(name, filename))
+        tail = '\r\n--{}--\r\n'.format(self.boundary).encode('utf-8')
+
+        # requests uses len to set Content-Length
+        self.len = len(head) + os.fstat(fileobj.fileno()).st_size - fileobj.tell() + len(tail)
+        self._parts = [io.BytesIO(head), fileobj, io.BytesIO(tail)]
+
+    def _part_header(self, disposition):
+        return '--{}\r\nContent-Disposition: {}\r\n\r\n'.format(self.boundary, disposition).encode('utf-8')
+
+    def read(self, size=-1):
+        chunks = []
+
+        while self._parts and size != 0:
+            data = self._parts[0].read(size)
+            if not data:
+                self._parts.pop(0)
+                continue
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+
+        return b''.join(chunks)
+
+
+class GzipStream(object):
+    '''
+    Iterable which gzips a file-like object chunk by chunk, limiting the
+    compressed output by a TokenBucket
+    '''
+    def __init__(self, fileobj, bucket, chunk_size=65536, level=6):
+        self.fileobj = fileobj
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        self.level = level
+        # compressed bytes produced
+        self.sent = 0
+
+    def __iter__(self):
+        # wbits of 16+MAX_WBITS writes a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+        while True:
+            chunk = self.fileobj.read(self.chunk_size)
+            if not chunk:
+                break
+            data = compressor.compress(chunk)
+            if data:
+                yield self._consume(data)
+
+        yield self._consume(compressor.flush())
+
+    def _consume(self, data):
+        self.bucket.consume(len(data))
+        self.sent += len(data)
+        return data
@@ -0,0 +1,183 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import struct
+import zlib
+
+
+# size of the blocks of the base file which can be referenced by a delta
+DEFAULT_BLOCK_SIZE = 4096
+
+DELTA_MAGIC = b'OGREDELTA1'
+
+# bytes read from the new version of a file at a time
+DELTA_READ_SIZE = 65536
+
+# modulus of the adler-32 weak checksum
+_ADLER_MOD = 65521
+
+_HEADER = struct.Struct(str('>I'))
+_COPY = struct.Struct(str('>cII'))
+_LITERAL = struct.Struct(str('>cI'))
+
+
+def signature(fileobj, block_size=DEFAULT_BLOCK_SIZE):
+    '''
+    Compute rsync-style block signatures of a file
+
+    returns:
+        list of [weak adler-32, strong md5 hex] for each block
+    '''
+    signatures = []
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            break
+        signatures.append([zlib.adler32(block) & 0xffffffff, hashlib.md5(block).hexdigest()])
+    return signatures
+
+
+def compute_delta(fileobj, signatures, block_size, out, max_literal=None):
+    '''
+    Write a delta to `out` which rebuilds the contents of `fileobj` from the file
+    described by `signatures`
+
+    Blocks of the base file are matched at any offset with a rolling weak
+    checksum, confirmed by the strong hash; everything else is sent as literal data.
+    The file is read in chunks, so memory use does not grow with its size.
+
+    params:
+        fileobj: file object to read the new version from
+        signatures: list returned by signature()
+        block_size: int
+        out: file object to write the delta to
+        max_literal: give up once the delta needs more literal bytes than this
+    returns:
+        number of literal bytes in the delta, or None if max_literal was exceeded
+    '''
+    # weak checksum -> list of (strong, block index); only full blocks can be matched
+    table = {}
+    for i, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, []).append((strong, i))
+
+    out.write(DELTA_MAGIC)
+    out.write(_HEADER.pack(block_size))
+
+    # pending run of consecutive copied blocks
+    copy_run = [None, 0]
+    literal_bytes = [0]
+
+    def _flush_copy():
+        if copy_run[1]:
+            out.write(_COPY.pack(b'C', copy_run[0], copy_run[1]))
+            copy_run[:] = [None, 0]
+
+    def _emit_literal(data, start, end):
+        if end > start:
+            _flush_copy()
+            out.write(_LITERAL.pack(b'L', end - start))
+            out.write(data[start:end])
+            literal_bytes[0] += end - start
+
+    def _emit_copy(index):
+        if copy_run[1] and copy_run[0] + copy_run[1] == index:
+            copy_run[1] += 1
+        else:
+            _flush_copy()
+            copy_run[:] = [index, 1]
+
+    # the unprocessed part of the file; data for slicing and hashing, buf for
+    # reading single bytes as ints
+    data, buf = b'', bytearray()
+    pos, literal_start, eof = 0, 0, False
+    # rolling checksum of the window at pos; None when it must be computed afresh
+    a = b = None
+
+    while True:
+        if not eof and pos + block_size >= len(data):
+            # write out the pending literal, and read the next chunk after the window
+            _emit_literal(data, literal_start, pos)
+            data = data[pos:]
+            while not eof and block_size >= len(data):
+                chunk = fileobj.read(max(DELTA_READ_SIZE, block_size))
+                eof = not chunk
+                data += chunk
+            buf = bytearray(data)
+            pos, literal_start = 0, 0
+
+        if pos + block_size > len(data):
+            break
+
+        if a is None:
+            weak = zlib.adler32(data[pos:pos+block_size]) & 0xffffffff
+            a, b = weak & 0xffff, weak >> 16
+
+        match = None
+        candidates = table.get((b << 16) | a)
+
+        if candidates is not None:
+            strong = hashlib.md5(data[pos:pos+block_size]).hexdigest()
+            for candidate, index in candidates:
+                if candidate == strong:
+                    match = index
+                    break
+
+        if match is not None:
+            _emit_literal(data, literal_start, pos)
+            _emit_copy(match)
+            pos += block_size
+            literal_start = pos
+            a = None
+        else:
+            # roll the window forward one byte
+            if pos + block_size < len(data):
+                old, new = buf[pos], buf[pos+block_size]
+                a = (a - old + new) % _ADLER_MOD
+                b = (b - block_size * old + a - 1) % _ADLER_MOD
+            pos += 1
+
+            if max_literal is not None and literal_bytes[0] + pos - literal_start > max_literal:
+                return None
+
+    _emit_literal(data, literal_start, len(data))
+    _flush_copy()
+
+    if max_literal is not None and literal_bytes[0] > max_literal:
+        return None
+
+    return literal_bytes[0]
+
+
+def apply_delta(base, delta, out):
+    '''
+    Rebuild a file by applying a delta to the (seekable) base file object
+    '''
+    if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise DeltaFormatError('Not an OGRE delta')
+
+    block_size = _HEADER.unpack(delta.read(_HEADER.size))[0]
+
+    while True:
+        op = delta.read(1)
+        if not op:
+            break
+
+        if op == b'C':
+            index, count = _COPY.unpack(op + delta.read(_COPY.size - 1))[1:]
+            base.seek(index * block_size)
+            out.write(base.read(count * block_size))
+
+        elif op == b'L':
+            length = _LITERAL.unpack(op + delta.read(_LITERAL.size - 1))[1]
+            literal = delta.read(length)
+            if len(literal) != length:
+                raise DeltaFormatError('Truncated delta')
+            out.write(literal)
+
+        else:
+            raise DeltaFormatError('Bad delta op: {!r}'.format(op))
+
+
+class DeltaFormatError(Exception):
+    pass
@@ -0,0 +1,273 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import fcntl
+import os
+import platform
+import Queue
+import struct
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+
+# concurrent readers per device; a spinning disk seeks between every reader,
+# while an SSD or network mount is faster with several requests in flight
+HDD_CONCURRENCY = 1
+SSD_CONCURRENCY = 4
+NETWORK_CONCURRENCY = 4
+# devices which cannot be identified, eg. on OSX
+DEFAULT_CONCURRENCY = 2
+
+# order in which the files on each device are read:
+#   discovery: as found by the providers, or as requested by ogreserver
+#   inode: by inode number, which roughly follows creation order on disk
+#   extent: by the physical offset of each file's first block, where the
+#           filesystem supports FIEMAP (Linux), else by inode
+READ_ORDERS = ('discovery', 'inode', 'extent')
+# inode and extent order are opt-in; benchmarks/bench_locality.py found no gain
+# from inode order on an SSD, and spinning disks are not yet measured
+DEFAULT_READ_ORDER = 'discovery'
+
+_FS_IOC_FIEMAP = 0xC020660B
+# struct fiemap, with room for a single struct fiemap_extent
+_FIEMAP = struct.Struct(str('=QQLLLL'))
+_FIEMAP_EXTENT = struct.Struct(str('=QQQQQLLLL'))
+
+_read_order = [DEFAULT_READ_ORDER]
+
+# device -> concurrency, from the device_concurrency option
+_overrides = {}
+_lock = threading.Lock()
+_cache = {}
+# device -> semaphore, for reading()
+_semaphores = {}
+
+
+def configure(spec=None, read_order=None):
+    '''
+    Set the concurrency of the devices holding some paths, from a spec such as
+    "/mnt/nas=8,/media/usb=1", and the order files are read in
+    '''
+    read_order = read_order or DEFAULT_READ_ORDER
+    if read_order not in READ_ORDERS:
+        raise ValueError('Invalid read order: {}'.format(read_order))
+
+    overrides = {}
+
+    for item in (spec or '').split(','):
+        if not item.strip():
+            continue
+
+        path, sep, limit = item.rpartition('=')
+        if not sep or not path.strip() or not limit.strip().isdigit() or int(limit) < 1:
+            raise ValueError('Invalid device concurrency: {}'.format(item))
+
+        try:
+            overrides[os.stat(os.path.expanduser(path.strip())).st_dev] = int(limit)
+        except OSError:
+            # device not currently mounted
+            continue
+
+    with _lock:
+        _overrides.clear()
+        _overrides.update(overrides)
+        _cache.clear()
+        _semaphores.clear()
+        _read_order[0] = read_order
+
+
+def device_of(path):
+    '''
+    Return the st_dev of the device holding path, or None if it does not exist
+    '''
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+def locate(path):
+    '''
+    Return (device, position) of a file, where position sorts files on the same
+    device into the configured read order; (None, None) if it does not exist
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+
+    if _read_order[0] == 'discovery':
+        return st.st_dev, None
+
+    if _read_order[0] == 'extent':
+        offset = physical_offset(path)
+        if offset is not None:
+            return st.st_dev, (0, offset)
+
+    return st.st_dev, (1, st.st_ino)
+
+
+def physical_offset(path):
+    '''
+    Return the offset on disk of the first block of a file, or None if the
+    filesystem does not say
+    '''
+    if platform.system() != 'Linux':
+        return None
+
+    request = _FIEMAP.pack(0, 2 ** 64 - 1, 0, 0, 1, 0) + b'\0' * _FIEMAP_EXTENT.size
+    try:
+        with open(path, 'rb') as f:
+            result = fcntl.ioctl(f.fileno(), _FS_IOC_FIEMAP, request)
+    except IOError:
+        return None
+
+    if _FIEMAP.unpack(result[:_FIEMAP.size])[3] == 0:
+        # empty file, or data not yet allocated
+        return None
+
+    return _FIEMAP_EXTENT.unpack(result[_FIEMAP.size:])[1]
+
+
+def locality_order(items, path=lambda item: item):
+    '''
+    Sort items by device, then into the configured read order on each device
+    '''
+    if _read_order[0] == 'discovery':
+        return list(items)
+
+    keyed = [(locate(path(item)), i, item) for i, item in enumerate(items)]
+    keyed.sort(key=lambda k: (k[0], k[1]))
+    return [item for _, _, item in keyed]
+
+
+def concurrency(dev):
+    '''
+    Return the number of concurrent readers for a device
+    '''
+    with _lock:
+        if dev in _overrides:
+            return _overrides[dev]
+        if dev not in _cache:
+            _cache[dev] = _detect_concurrency(dev)
+        return _cache[dev]
+
+
+@contextlib.contextmanager
+def reading(path):
+    '''
+    Hold one of the concurrent reader slots of the device holding path, for reads
+    made outside of imap_by_device
+    '''
+    dev = device_of(path)
+    limit = concurrency(dev)
+    with _lock:
+        if dev not in _semaphores:
+            _semaphores[dev] = threading.BoundedSemaphore(limit)
+        semaphore = _semaphores[dev]
+
+    with semaphore:
+        yield
+
+
+def _detect_concurrency(dev):
+    if dev is None or platform.system() != 'Linux':
+        return DEFAULT_CONCURRENCY
+
+    # device numbers with major 0 are not block devices: NFS, SMB, FUSE and others
+    if os.major(dev) == 0:
+        return NETWORK_CONCURRENCY
+
+    # a partition has no queue of its own; use its parent disk's
+    sysfs = '/sys/dev/block/{}:{}'.format(os.major(dev), os.minor(dev))
+    for queue in ('queue', '../queue'):
+        try:
+            with open(os.path.join(sysfs, queue, 'rotational')) as f:
+                return HDD_CONCURRENCY if f.read().strip() == '1' else SSD_CONCURRENCY
+        except IOError:
+            continue
+
+    return DEFAULT_CONCURRENCY
+
+
+def imap_by_device(func, items, path=lambda item: item, max_concurrency=None):
+    '''
+    Call func on each item, with a pool of threads for each device sized by its
+    concurrency, yielding (item, result) as they complete. func should return
+    errors rather than raise them. The items on each device are started in the
+    configured read order.
+
+    Wrap the iteration in contextlib.closing, so outstanding calls are abandoned
+    if the caller stops early.
+
+    params:
+        func: callable
+        items: iterable
+        path: callable returning the file path of an item
+        max_concurrency: limit on calls in progress across all devices
+    '''
+    groups = collections.OrderedDict()
+    for i, item in enumerate(items):
+        dev, position = locate(path(item))
+        groups.setdefault(dev, []).append((position, i, item))
+
+    for dev, group in groups.iteritems():
+        if _read_order[0] != 'discovery':
+            group.sort(key=lambda k: (k[0], k[1]))
+        groups[dev] = [item for _, _, item in group]
+
+    sizes = [min(concurrency(dev), max_concurrency or len(group), len(group)) for dev, group in groups.iteritems()]
+
+    if len(groups) == 1 and sizes[0] == 1:
+        # a single reader is quicker without threads, eg. a library on one spinning disk
+        for item in groups.values()[0]:
+            yield item, func(item)
+        return
+
+    results = Queue.Queue()
+    slots = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+    def _call(item):
+        try:
+            if slots is None:
+                results.put((item, func(item), None))
+            else:
+                with slots:
+                    results.put((item, func(item), None))
+        except BaseException:
+            results.put((item, None, sys.exc_info()))
+
+    pools = []
+    try:
+        for group, size in zip(groups.itervalues(), sizes):
+            pool = ThreadPool(size)
+            pools.append(pool)
+            for item in group:
+                pool.apply_async(_call, (item,))
+            pool.close()
+
+        for _ in xrange(sum(len(group) for group in groups.itervalues())):
+            while True:
+                try:
+                    # wait with a timeout, else Ctrl-C is not delivered on py2
+                    item, result, exc_info = results.get(timeout=0.5)
+                    break
+                except Queue.Empty:
+                    continue
+
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield item, result
+
+    except BaseException:
+        # abandon queued calls on error or Ctrl-C
+        for pool in pools:
+            pool.terminate()
+        raise
+    finally:
+        for pool in pools:
+            pool.join()
@@ -1,14 +1,30 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import collections
 import datetime
+import gzip
 import logging
+import os
+import shutil
 import sys
 import threading
+import time
 import traceback
 
 PROGBAR_LEN = 40
 
+# seconds between progress bar redraws on a TTY
+PROGRESS_REFRESH_INTERVAL = 0.1
+# seconds between progress lines when stdout is not a TTY
+PROGRESS_PLAIN_INTERVAL = 10
+
+# bytes of debug log held in memory before spilling to disk
+LOG_MEMORY_BUDGET = 1048576
+# size at which the on-disk debug log is rotated
+LOG_FILE_MAX_SIZE = 20971520
+LOG_FILENAME = 'debug.log'
+
 
 class CliPrinter(object):
     '''
@@ -84,11 +100,11 @@ class CliPrinterImpl:
     TAB_SIZE = 4
 
     log_output = False
-    logs = []
 
     def __init__(self, level=False, app_name=None, use_prefix=False,
                  progressbar_len=PROGBAR_LEN, progressbar_char="#",
-                 notimer=False, nocolour=True, default_colour=None, log_output=False):
+                 notimer=False, nocolour=True, default_colour=None, log_output=False,
+                 log_dir=None):
 
         if use_prefix is True and app_name is None:
             raise IllegalArgumentError('You must supply app_name when use_prefix is True')
@@ -107,14 +123,22 @@ class CliPrinterImpl:
         self.colours.default = default_colour
         self.log_output = log_output
 
+        # bounded store for printed lines, spilling into log_dir
+        self.logs = LogBuffer(log_dir) if log_output else None
+
         # start the timer if it's in use
         if notimer is False:
             self.start = datetime.datetime.now()
 
+        # carriage-return progress bars only make sense on a terminal
+        self.is_tty = hasattr(sys.stdout, 'isatty') and sys.stdout.isatty()
+
         # used internally for tracking state
         self.progress_running = False
         self.line_needs_finishing = False
         self.infinite_progress_state = None
+        self.progress_last_render = 0
+        self._reset_progress()
 
         # create a mutex for thread-safe printing
         self.lock = threading.Lock()
@@ -245,6 +269,16 @@ class CliPrinterImpl:
         if self.level > logging.INFO:
             return
 
+        # infinite progress has no meaning in plain logs
+        if not self.is_tty:
+            return
+
+        # throttle redraws to the refresh rate
+        now = time.time()
+        if self.progress_running and now - self.progress_last_render < PROGRESS_REFRESH_INTERVAL:
+            return
+        self.progress_last_render = now
+
         colour = CliPrinterImpl._get_colour()
         prefix = self._get_prefix(prefix)
 
@@ -257,52 +291,137 @@ class CliPrinterImpl:
         PROG_CHARS = ['|', '/', '-', '\\']
 
         t = self._get_time_elapsed(notime)
-        sys.stdout.write('\r{}{}{}{}[ {} ]{}'.format(
-            prefix, CliPrinterImpl.colours.GREY, t, colour,
-            PROG_CHARS[self.infinite_progress_state] * self.progressbar_len,
-            CliPrinterImpl.colours.END
-        ))
-        sys.stdout.flush()
+        with self.lock:
+            sys.stdout.write('\r{}{}{}{}[ {} ]{}'.format(
+                prefix, CliPrinterImpl.colours.GREY, t, colour,
+                PROG_CHARS[self.infinite_progress_state] * self.progressbar_len,
+                CliPrinterImpl.colours.END
+            ))
+            sys.stdout.flush()
 
         self.infinite_progress_state += 1
 
 
-    def progressf(self, num_blocks=None, block_size=1, total_size=None, extra=None, notime=False, prefix=None):
+    def progressf(self, num_blocks=None, block_size=1, total_size=None, extra=None, notime=False,
+                  prefix=None, nbytes=None, force=False):
+        """
+        Render a progress bar with throughput and ETA
+
+        params:
+            num_blocks/block_size/total_size: progress is (num_blocks * block_size) / total_size
+            nbytes: cumulative bytes processed, to display MB/s
+            force: render regardless of the refresh rate
+
+        Redraws are throttled to PROGRESS_REFRESH_INTERVAL on a TTY. When stdout is
+        not a TTY, a plain line is written every PROGRESS_PLAIN_INTERVAL seconds.
+        """
         if self.level > logging.INFO:
             return
 
         if num_blocks is None or total_size is None:
             raise ProgressfArgumentError
 
-        if extra is None:
-            extra = ''
+        now = time.time()
+        done = num_blocks * block_size
 
-        self.progress_running = True
+        # a different total, or progress going backwards, means a new progress run
+        if self.progress_state is not None:
+            last_done, last_total, _ = self.progress_state
+            if total_size != last_total or done < last_done:
+                self._reset_progress()
+
+        # a new progress run; reset the throughput clock
+        if self.progress_started is None:
+            self.progress_started = now
+            self.progress_last_render = 0
+
+        self.progress_state = (done, total_size, nbytes)
+
+        interval = PROGRESS_REFRESH_INTERVAL if self.is_tty else PROGRESS_PLAIN_INTERVAL
+
+        # skip all formatting unless a redraw is due; always draw completion
+        if not force and done < total_size and now - self.progress_last_render < interval:
+            return
+        self.progress_last_render = now
+
+        self._render_progress(done, total_size, nbytes, now, extra, notime, prefix)
 
+
+    def _render_progress(self, done, total_size, nbytes, now, extra=None, notime=False, prefix=None):
         colour = CliPrinterImpl._get_colour()
         prefix = self._get_prefix(prefix)
 
+        if extra is None:
+            extra = ''
+
         # calculate progress bar size
-        progress = float(num_blocks * block_size) / float(total_size)
+        progress = float(done) / float(total_size) if total_size else 1
         progress = progress if progress < 1 else 1
 
+        # throughput and ETA
+        elapsed = now - self.progress_started
+        stats = ''
+        if elapsed > 0 and done > 0:
+            stats = ' {:.1f}/s'.format(done / elapsed)
+            if nbytes:
+                stats += ' {:.1f}MB/s'.format(nbytes / elapsed / 1048576)
+            if progress < 1:
+                stats += ' ETA {}'.format(self._format_seconds(elapsed / progress - elapsed))
+
         t = self._get_time_elapsed(notime)
-        sys.stdout.write('\r{}{}{}{}[ {}{} ] {}%{}'.format(
-            prefix, CliPrinterImpl.colours.GREY, t, colour,
-            self.progressbar_char * int(progress * self.progressbar_len),
-            ' ' * (self.progressbar_len - int(progress * self.progressbar_len)),
-            round(progress * 100, 1),
-            CliPrinterImpl.colours.GREY, extra,
-            CliPrinterImpl.colours.END
-        ))
-        sys.stdout.flush()
+
+        if self.is_tty:
+            line = '{}{}{}{}[ {}{} ] {}%{}{}{}{}'.format(
+                prefix, CliPrinterImpl.colours.GREY, t, colour,
+                self.progressbar_char * int(progress * self.progressbar_len),
+                ' ' * (self.progressbar_len - int(progress * self.progressbar_len)),
+                round(progress * 100, 1), stats,
+                CliPrinterImpl.colours.GREY, extra,
+                CliPrinterImpl.colours.END
+            )
+            # pad over the tail of a previous longer line
+            padding = ' ' * max(self.progress_line_len - len(line), 0)
+            self.progress_line_len = len(line)
+
+            with self.lock:
+                self.progress_running = True
+                sys.stdout.write('\r{}{}'.format(line, padding))
+                sys.stdout.flush()
+        else:
+            # plain lines for logs; no carriage returns
+            with self.lock:
+                sys.stdout.write('{}{}{}/{} ({}%){}{}\n'.format(
+                    prefix, t, done, total_size, round(progress * 100, 1), stats, extra
+                ))
+                sys.stdout.flush()
+
+            if progress >= 1:
+                self._reset_progress()
+
+
+    @staticmethod
+    def _format_seconds(seconds):
+        seconds = int(seconds)
+        return '{:02}:{:02}:{:02}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+    def _reset_progress(self):
+        self.progress_started = None
+        self.progress_state = None
+        self.progress_line_len = 0
 
 
     def end_progress(self):
         # end progress bar by displaying 100%
-        if self.progress_running is True:
+        if self.progress_running is True and self.progress_state is not None:
+            self.infinite_progress_state = None
+            _, total_size, nbytes = self.progress_state
+            self._render_progress(total_size, total_size, nbytes, time.time())
+        elif self.progress_running is True:
             self.infinite_progress_state = None
-            self.progressf(1, 1, 1)
+            self.progress_started = time.time()
+            self._render_progress(1, 1, None, time.time())
+        self._reset_progress()
 
 
     def _get_time_elapsed(self, notime=False, formatted=True):
@@ -416,10 +535,104 @@ class CliPrinterImpl:
             if self.line_needs_finishing is True or self.progress_running is True:
                 self.progress_running = False
                 self.line_needs_finishing = False
+                self.progress_line_len = 0
                 sys.stdout.write('\n')
                 sys.stdout.flush()
 
 
+class LogBuffer(object):
+    '''
+    Store of printed lines with a fixed memory budget
+
+    Lines are buffered in memory up to LOG_MEMORY_BUDGET bytes, then spilled to
+    a log file in log_dir. The file is rotated once at LOG_FILE_MAX_SIZE; the
+    previous run's log is kept as a single backup. Without a log_dir only the
+    most recent LOG_MEMORY_BUDGET bytes are kept.
+    '''
+    def __init__(self, log_dir=None, memory_budget=LOG_MEMORY_BUDGET, max_file_size=LOG_FILE_MAX_SIZE):
+        self.memory_budget = memory_budget
+        self.max_file_size = max_file_size
+        self.lines = collections.deque()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+
+        self.path = None
+        self.rotated = False
+
+        if log_dir is not None:
+            self.path = os.path.join(log_dir, LOG_FILENAME)
+            # keep the previous run's log as the backup
+            if os.path.exists(self.path):
+                shutil.move(self.path, self._backup_path)
+
+    @property
+    def _backup_path(self):
+        return '{}.1'.format(self.path)
+
+    def append(self, line):
+        line = '{}\n'.format(line).encode('utf-8')
+
+        with self.lock:
+            self.lines.append(line)
+            self.memory_size += len(line)
+
+            if self.memory_size > self.memory_budget:
+                if self.path is not None:
+                    self._spill()
+                else:
+                    # no disk available; drop the oldest lines
+                    while self.memory_size > self.memory_budget and len(self.lines) > 1:
+                        self.memory_size -= len(self.lines.popleft())
+
+    def _spill(self):
+        with open(self.path, 'ab') as f:
+            f.writelines(self.lines)
+            size = f.tell()
+
+        self.lines.clear()
+        self.memory_size = 0
+
+        if size > self.max_file_size:
+            # rotate; this run's older lines become the backup
+            shutil.move(self.path, self._backup_path)
+            self.rotated = True
+
+    def iterchunks(self, chunk_size=65536):
+        '''
+        Yield this run's log as byte chunks, oldest first
+
+        Lines appended while iterating are not included.
+        '''
+        with self.lock:
+            if self.path is not None and self.lines:
+                # flush memory to disk, so all lines are read from file
+                self._spill()
+
+            paths = []
+            if self.rotated:
+                paths.append(self._backup_path)
+            if self.path is not None and os.path.exists(self.path):
+                paths.append(self.path)
+
+            lines = list(self.lines)
+
+        for path in paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    yield chunk
+
+        for line in lines:
+            yield line
+
+    def write_gzip(self, fileobj):
+        '''
+        Stream this run's log into a gzip-compressed file object
+        '''
+        with gzip.GzipFile(fileobj=fileobj, mode='wb') as gz:
+            for chunk in self.iterchunks():
+                gz.write(chunk)
+
+
 class DummyPrinter:
     def debug(self, *args, **kwargs):
         pass
@@ -0,0 +1,227 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import contextlib
+import datetime
+import functools
+import json
+import os
+import platform
+import threading
+import time
+
+from ogreclient import __version__
+
+
+class Profiler(object):
+    '''
+    Records per-phase timings of a sync, totals for external calls, and
+    named counters and errors for the machine-readable run report
+
+    A single module-level instance is shared across ogreclient (similar to
+    CliPrinter); when disabled all recording methods are no-ops.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # phase name -> dict of wall, cpu, items, bytes
+        self.phases = collections.OrderedDict()
+        # call kind (subprocess, http, sqlite) -> dict of wall, calls, bytes
+        self.calls = collections.OrderedDict()
+        # named event counters (cache_hits, uploaded etc)
+        self.counters = collections.Counter()
+        # exception class name -> count
+        self.errors = collections.Counter()
+        self.current_phase = None
+        self.start = time.time()
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    @staticmethod
+    def _cpu_time():
+        # user + system time of this process
+        t = os.times()
+        return t[0] + t[1]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Time a phase of the sync; phases of the same name are summed
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = {'wall': 0.0, 'cpu': 0.0, 'items': 0, 'bytes': 0}
+            parent, self.current_phase = self.current_phase, name
+
+        wall, cpu = time.time(), self._cpu_time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name]['wall'] += time.time() - wall
+                self.phases[name]['cpu'] += self._cpu_time() - cpu
+                self.current_phase = parent
+
+    def count(self, items=0, nbytes=0):
+        '''
+        Attribute processed items and bytes to the current phase
+        '''
+        if not self.enabled or self.current_phase is None:
+            return
+
+        with self.lock:
+            self.phases[self.current_phase]['items'] += items
+            self.phases[self.current_phase]['bytes'] += nbytes or 0
+
+    def incr(self, name, value=1):
+        '''
+        Increment a named counter
+        '''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.counters[name] += value or 0
+
+    def error(self, excp):
+        '''
+        Record an error by exception class
+        '''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.errors[excp.__class__.__name__] += 1
+
+    @contextlib.contextmanager
+    def call(self, kind, nbytes=0):
+        '''
+        Time a single external call (subprocess, http, sqlite)
+        '''
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                if kind not in self.calls:
+                    self.calls[kind] = {'wall': 0.0, 'calls': 0, 'bytes': 0}
+                self.calls[kind]['wall'] += time.time() - start
+                self.calls[kind]['calls'] += 1
+                self.calls[kind]['bytes'] += nbytes or 0
+
+    def timed(self, kind):
+        '''
+        Decorator form of Profiler.call()
+        '''
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapped(*args, **kwargs):
+                with self.call(kind):
+                    return f(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    def as_dict(self):
+        '''
+        All recorded data as a JSON-serializable dict
+        '''
+        with self.lock:
+            data = {
+                'duration': round(time.time() - self.start, 3),
+                'counters': dict(self.counters),
+                'errors': dict(self.errors),
+                'phases': {
+                    name: {
+                        'wall': round(p['wall'], 3),
+                        'cpu': round(p['cpu'], 3),
+                        'items': p['items'],
+                        'bytes': p['bytes'],
+                    }
+                    for name, p in self.phases.iteritems()
+                },
+                'calls': {
+                    kind: {
+                        'wall': round(c['wall'], 3),
+                        'calls': c['calls'],
+                        'bytes': c['bytes'],
+                    }
+                    for kind, c in self.calls.iteritems()
+                },
+            }
+
+        # bytes attributed to the sync phase are the JSON payload posted to ogreserver
+        if 'sync' in data['phases']:
+            data['sync_payload_bytes'] = data['phases']['sync']['bytes']
+
+        # upload throughput is the headline network figure
+        upload = data['phases'].get('upload')
+        if upload is not None and upload['wall'] > 0:
+            data['upload_mb_per_sec'] = round(upload['bytes'] / upload['wall'] / 1048576, 3)
+
+        return data
+
+    def report(self):
+        '''
+        Tabular summary suitable for CliPrinter's tabular output
+        '''
+        output = [('phase', 'wall (s)', 'cpu (s)', 'count', 'MB')]
+
+        for name, p in self.phases.iteritems():
+            output.append((
+                name, '{:.3f}'.format(p['wall']), '{:.3f}'.format(p['cpu']),
+                p['items'], '{:.1f}'.format(p['bytes'] / 1048576.0)
+            ))
+
+        if self.calls:
+            output.append(('-', '-', '-', '-', '-'))
+
+            for kind, c in self.calls.iteritems():
+                output.append((
+                    kind, '{:.3f}'.format(c['wall']), '',
+                    c['calls'], '{:.1f}'.format(c['bytes'] / 1048576.0) if c['bytes'] else ''
+                ))
+
+        return output
+
+
+profiler = Profiler()
+
+
+def write_run_report(path, fmt='json', **extra):
+    '''
+    Write the profiler's data as a run report for monitoring
+
+    params:
+        path: output file
+        fmt: 'json' overwrites path with a single document, 'jsonl' appends one line per run
+        extra: additional top-level fields (mode, result etc)
+    '''
+    data = profiler.as_dict()
+    data.update({
+        'timestamp': datetime.datetime.utcnow().isoformat(),
+        'version': __version__,
+        'hostname': platform.node(),
+    })
+    data.update(extra)
+
+    if fmt == 'jsonl':
+        with open(path, 'a') as f:
+            f.write(json.dumps(data, sort_keys=True))
+            f.write('\n')
+    else:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import datetime
+import re
+import shutil
+import threading
+import time
+
+
+# bytes per read/write when copying files under a rate limit
+COPY_CHUNK_SIZE = 65536
+
+_RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+class TokenBucket(object):
+    '''
+    Token bucket rate limiter, shared between threads
+
+    Tokens are bytes; callers consume() bytes before using them and are put to
+    sleep when over the rate. A rate of None means unlimited.
+    '''
+    def __init__(self, rate=None, burst=None, schedule=None):
+        self.lock = threading.Lock()
+        self.schedule = schedule
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate or None
+            # allow up to one second of traffic in a burst by default
+            self.burst = burst or self.rate
+            self.tokens = self.burst
+            self.last = time.time()
+
+    @property
+    def active(self):
+        if self.rate is None:
+            return False
+        # outside of the scheduled full-speed hours
+        return self.schedule is None or not self.schedule.is_full_speed()
+
+    def consume(self, nbytes):
+        if not self.active:
+            return
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            # go into debt, and sleep until it is paid back
+            self.tokens -= nbytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Schedule(object):
+    '''
+    Daily windows of local time during which rate limits are not applied,
+    such as "23:00-07:00" or "12:00-13:00,23:00-07:00"
+    '''
+    def __init__(self, spec):
+        self.spec = spec
+        self.windows = []
+
+        for window in spec.split(','):
+            m = re.match(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$', window)
+            if m is None:
+                raise ValueError('Invalid schedule window: {}'.format(window))
+
+            start, end = int(m.group(1)) * 60 + int(m.group(2)), int(m.group(3)) * 60 + int(m.group(4))
+            if start >= 1440 or end > 1440:
+                raise ValueError('Invalid schedule window: {}'.format(window))
+
+            self.windows.append((start, end))
+
+    def is_full_speed(self, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+
+        for start, end in self.windows:
+            if start <= end:
+                if start <= minute < end:
+                    return True
+            # window wraps past midnight
+            elif minute >= start or minute < end:
+                return True
+        return False
+
+
+class ThrottledFile(object):
+    '''
+    Wrap a file object so that reads are rate limited by a TokenBucket
+    '''
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bucket.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def parse_rate(value):
+    '''
+    Parse a rate such as "512K" or "2M" into bytes per second; "0" means unlimited
+    '''
+    m = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:i?B)?(?:/s)?\s*$', value, re.IGNORECASE)
+    if m is None:
+        raise ValueError('Invalid rate: {}'.format(value))
+
+    return int(float(m.group(1)) * _RATE_UNITS[m.group(2).upper()]) or None
+
+
+def configure(upload_rate=None, read_rate=None, full_speed_hours=None):
+    '''
+    Set the shared upload and disk read limits
+
+    params:
+        upload_rate: bytes per second, or None for unlimited
+        read_rate: bytes per second, or None for unlimited
+        full_speed_hours: Schedule spec string, during which limits are lifted
+    '''
+    schedule = Schedule(full_speed_hours) if full_speed_hours else None
+
+    upload_limiter.schedule = schedule
+    upload_limiter.set_rate(upload_rate)
+    read_limiter.schedule = schedule
+    read_limiter.set_rate(read_rate)
+
+
+def copy_file(src, dst):
+    '''
+    Copy a file and its permission bits (as shutil.copy), limited by the read rate
+    '''
+    if not read_limiter.active:
+        shutil.copy(src, dst)
+        return
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        shutil.copyfileobj(ThrottledFile(fsrc, read_limiter), fdst, COPY_CHUNK_SIZE)
+    shutil.copymode(src, dst)
+
+
+# shared limiters; unlimited until configured
+upload_limiter = TokenBucket()
+read_limiter = TokenBucket()
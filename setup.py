@@ -26,7 +26,7 @@ setup(
     author='Matt Black',
     author_email='dev@mafro.net',
     url='http://github.com/oii/ogre',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks', 'benchmarks.*']),
     package_data={'': ['LICENSE']},
     install_requires=requires,
     entry_points = {
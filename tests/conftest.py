@@ -26,7 +26,7 @@ def client_config(calibre_ebook_meta_bin):
     EbookObject.calibre_ebook_meta_bin = calibre_ebook_meta_bin
     EbookObject.ebook_home = None
 
-    FormatConfig = collections.namedtuple('FormatConfig', ('is_valid_format', 'is_non_fiction'))
+    FormatConfig = collections.namedtuple('FormatConfig', ('is_valid_format', 'is_non_fiction', 'is_compressible'))
     return {
         'config_dir': None,
         'ebook_cache': mock.Mock(),
@@ -37,10 +37,10 @@ def client_config(calibre_ebook_meta_bin):
         'password': user.username,  # password=username during tests
         'host': urlparse('http://localhost:6543'),
         'definitions': collections.OrderedDict([
-            ('mobi', FormatConfig(True, False)),
-            ('pdf', FormatConfig(False, True)),
-            ('azw3', FormatConfig(True, False)),
-            ('epub', FormatConfig(True, False)),
+            ('mobi', FormatConfig(True, False, True)),
+            ('pdf', FormatConfig(False, True, True)),
+            ('azw3', FormatConfig(True, False, False)),
+            ('epub', FormatConfig(True, False, False)),
         ]),
         'verbose': False,
         'no_drm': True,
@@ -0,0 +1,249 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+import os
+import sqlite3
+
+import mock
+import pytest
+
+from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.core.scan import _read_ebook
+from ogreclient.exceptions import MissingFromCacheError
+from ogreclient.utils import codec
+from ogreclient.utils.cache import Cache, __CACHEVERSION__
+
+
+def test_cache_init_at_current_version(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+
+    # first run creates the cache
+    assert cache.verify_cache() is True
+    # second run finds it valid
+    assert cache.verify_cache() is False
+
+    conn = sqlite3.connect(cache.ebook_cache_path)
+    assert conn.execute('SELECT version FROM meta').fetchone()[0] == __CACHEVERSION__
+    conn.close()
+
+
+def test_cache_migrate_from_v1(tmpdir):
+    path = tmpdir.join('ebook_cache.db').strpath
+
+    # create a version 1 cache, as shipped in ogreclient 0.0.3
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE ebooks (path TEXT PRIMARY KEY, file_hash TEXT NULL, ebook_id TEXT, '
+                 'data TEXT NULL, drmfree INT DEFAULT 0, skip INT DEFAULT 0)')
+    conn.execute('CREATE TABLE meta (version INT PRIMARY KEY)')
+    conn.execute('INSERT INTO meta VALUES (1)')
+    conn.execute('INSERT INTO ebooks VALUES (?, ?, NULL, ?, 0, 0)', (
+        '/books/a.epub', 'abc',
+        json.dumps({'format': 'epub', 'size': 4, 'authortitle': 'a', 'meta': {'title': 'A'}}),
+    ))
+    conn.commit()
+    conn.close()
+
+    cache = Cache({}, path)
+    assert cache.verify_cache() is False
+
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT version FROM meta').fetchone()[0] == __CACHEVERSION__
+    # metadata columns are filled from the JSON
+    assert conn.execute('SELECT format, size, title, meta_version FROM contents').fetchall() == [('epub', 4, 'A', 1)]
+    # and the JSON is re-encoded
+    assert codec.is_binary(conn.execute('SELECT data FROM contents').fetchone()[0])
+    conn.close()
+
+    # cached books are carried over
+    assert cache.get_ebook('/books/a.epub').meta == {'title': 'A'}
+
+    # migrated schema is usable
+    cache.store_errord_uploaded('egg')
+    assert cache.get_errord_uploaded(['egg', 'bacon']) == {'egg'}
+
+
+def test_cache_recreated_when_corrupt(tmpdir):
+    path = tmpdir.join('ebook_cache.db')
+    path.write('not a sqlite database')
+
+    cache = Cache({}, path.strpath)
+    assert cache.verify_cache() is True
+    assert cache.get_errord_uploaded(['egg']) == set()
+
+
+def test_cache_sync_journal(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    # steps not yet reached are None, distinct from an empty step
+    assert cache.get_journal('to_update') is None
+    cache.store_journal('to_upload', [])
+    assert cache.get_journal('to_upload') == []
+
+    cache.store_journal('to_update', [('abc', {'path': '/a.epub'}), ('def', {'path': '/b.epub'})])
+    cache.mark_journal_done('to_update', 'abc')
+
+    assert cache.get_journal('to_update') == [
+        ('abc', {'path': '/a.epub'}, True),
+        ('def', {'path': '/b.epub'}, False),
+    ]
+
+    cache.clear_journal()
+    assert cache.get_journal('to_update') is None
+    assert cache.get_journal('to_upload') is None
+
+
+def test_cache_detects_moved_ebook(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    old_path = tmpdir.mkdir('old').join('book.epub')
+    old_path.write('book')
+    new_path = tmpdir.mkdir('new').join('book.epub').strpath
+
+    cache.store_ebook(EbookObject(
+        old_path.strpath, file_hash='abc', size=4, authortitle='a\u0006b\u0007c', source='TEST'
+    ))
+    os.rename(old_path.strpath, new_path)
+
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook(new_path, st=os.stat(new_path))
+
+    # the same inode, size and mtime is found under its previous path
+    ebook_obj = cache.find_moved_ebook(new_path, os.stat(new_path))
+    assert (ebook_obj.path, ebook_obj.file_hash, ebook_obj.authortitle) == (new_path, 'abc', 'a\u0006b\u0007c')
+
+    # the cache entry moved with the file
+    assert cache.get_ebook(new_path, st=os.stat(new_path)).file_hash == 'abc'
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook(old_path.strpath)
+
+    # a modified file is not a cache hit
+    with open(new_path, 'a') as f:
+        f.write('more')
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook(new_path, st=os.stat(new_path))
+
+
+def test_cache_get_ebook_by_content(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    path = tmpdir.join('book.epub')
+    path.write('book')
+    cache.store_ebook(EbookObject(
+        path.strpath, file_hash='abc', ebook_id='xyz', size=4, authortitle='a\u0006b\u0007c', source='TEST'
+    ))
+
+    # metadata of the same content is found for a copy at another path
+    ebook_obj = cache.get_ebook_by_content('/elsewhere/book.epub', 'abc')
+    assert (ebook_obj.path, ebook_obj.ebook_id, ebook_obj.authortitle) == (
+        '/elsewhere/book.epub', 'xyz', 'a\u0006b\u0007c'
+    )
+
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook_by_content('/elsewhere/other.epub', 'def')
+
+    # a book which failed metadata extraction is cached as a skip, with no metadata
+    path = tmpdir.join('corrupt.epub')
+    path.write('corrupt')
+    cache.store_ebook(EbookObject(path.strpath, file_hash='def', size=7, skip=True, source='TEST'))
+
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook_by_content('/elsewhere/corrupt.epub', 'def')
+
+
+def test_cache_source_per_path(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    # the same book on a Kindle and in the Ebook Home
+    kindle = tmpdir.mkdir('kindle').join('book.azw3')
+    kindle.write('book')
+    home = tmpdir.mkdir('home').join('book.azw3')
+    home.write('book')
+    items = [(kindle.strpath, 'azw3', 'Amazon Kindle'), (home.strpath, 'azw3', 'Ebook Home')]
+    meta = {'title': 'c', 'firstname': 'a', 'lastname': 'b'}
+
+    # the second copy's metadata is found by content
+    for item in items:
+        ebook_obj, _, _ = _read_ebook(cache, item, meta=meta)
+        assert ebook_obj.meta['source'] == item[2]
+        cache.store_ebook(ebook_obj)
+
+    conn = sqlite3.connect(cache.ebook_cache_path)
+    data = conn.execute('SELECT data FROM contents').fetchone()[0]
+    assert 'source' not in codec.decode(data)['meta']
+    conn.close()
+
+    # warm scans keep each path's source, and leave the shared contents row alone
+    for _ in range(2):
+        for item in items:
+            ebook_obj, _, _ = _read_ebook(cache, item)
+            assert ebook_obj.in_cache is True
+            assert ebook_obj.meta['source'] == item[2]
+            cache.store_ebook(ebook_obj)
+
+    conn = sqlite3.connect(cache.ebook_cache_path)
+    assert conn.execute('SELECT data FROM contents').fetchone()[0] == data
+    conn.close()
+
+
+def test_cache_meta_columns(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    path = tmpdir.join('book.epub')
+    path.write('book')
+    ebook_obj = EbookObject(path.strpath, file_hash='abc', size=4, authortitle='a\u0006b\u0007c', source='TEST')
+    ebook_obj.meta.update({'title': 'c', 'firstname': 'a', 'lastname': 'b'})
+    cache.store_ebook(ebook_obj)
+
+    conn = sqlite3.connect(cache.ebook_cache_path)
+    assert conn.execute(
+        'SELECT format, size, title, firstname, lastname FROM contents WHERE authortitle = ?', ('a\u0006b\u0007c',)
+    ).fetchall() == [('epub', 4, 'c', 'a', 'b')]
+    conn.close()
+
+    # deduplication fields are read from their columns, without decoding the JSON
+    ebook_obj = cache.get_ebook(path.strpath)
+    assert (ebook_obj.format, ebook_obj.size, ebook_obj.authortitle) == ('epub', 4, 'a\u0006b\u0007c')
+    assert ebook_obj._cached_data is not None
+    assert ebook_obj.meta['title'] == 'c'
+
+    # metadata from an older ogreclient is scanned again
+    with mock.patch('ogreclient.utils.cache.META_VERSION', 2):
+        with pytest.raises(MissingFromCacheError):
+            cache.get_ebook(path.strpath)
+
+
+def test_cache_get_stats(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    def _store(name, file_hash, fmt='epub', authortitle=None, skip=False, drmfree=False):
+        path = tmpdir.join('{}.{}'.format(name, fmt))
+        path.write(name)
+        ebook_obj = EbookObject(
+            path.strpath, file_hash=file_hash, size=1048576, fmt=fmt, authortitle=authortitle,
+            skip=skip, drmfree=drmfree, source='TEST'
+        )
+        cache.store_ebook(ebook_obj)
+        return path
+
+    _store('a', 'aaa', authortitle='a', drmfree=True)
+    _store('b', 'bbb', authortitle='b')
+    _store('b', 'bbb2', fmt='mobi', authortitle='b')
+    # an exact copy, and a lower ranked copy of the same book and format
+    _store('a-copy', 'aaa', authortitle='a', drmfree=True)
+    _store('b-again', 'bbb3', authortitle='b', skip=True)
+    # a book without metadata
+    _store('corrupt', 'ccc', skip=True)
+    # a book on an unplugged drive
+    unplugged = _store('unplugged', 'ddd', authortitle='d')
+    cache.gc_ebooks([], [unplugged.strpath], [], '2026-01-01T00:00:00')
+
+    stats = cache.get_stats()
+    assert stats['formats'] == [('epub', 2, 2097152, 1), ('mobi', 1, 1048576, 0)]
+    assert (stats['duplicate'], stats['corrupt'], stats['skipped'], stats['drmfree'], stats['missing']) == (2, 1, 2, 1, 1)
@@ -0,0 +1,25 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import sys
+
+import pytest
+
+from ogreclient.cli import entrypoint
+
+
+@pytest.mark.parametrize('argv', [
+    ['ogre', 'stats'],
+    ['ogre', 'scan', '--from-cache'],
+])
+def test_cache_stats_exit_status(argv, tmpdir, monkeypatch, capsys):
+    # an empty cache, in a fresh config dir
+    monkeypatch.setenv(str('XDG_CONFIG_HOME'), str(tmpdir.strpath))
+    monkeypatch.setattr(sys, 'argv', [str(arg) for arg in argv])
+
+    with pytest.raises(SystemExit) as e:
+        entrypoint()
+
+    assert e.value.code == 0
+    # the stats are not printed as an exit message
+    assert 'formats' not in capsys.readouterr().err
@@ -2,14 +2,25 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import collections
+import contextlib
 import os
 import shutil
+import threading
+import time
 
 import mock
+import pytest
 
+from benchmarks.server import FakeOgreServer
+from ogreclient import exceptions
+from ogreclient.core.ebook_obj import EbookObject
 from ogreclient.core.scan import scan_for_ebooks
+from ogreclient.core.upload import upload_ebooks
+from ogreclient.main import resume_sync, sync_ebooks, upload_errord_books
 from ogreclient.prereqs import get_definitions
 from ogreclient.providers import LibProvider
+from ogreclient.utils.cache import Cache
+from ogreclient.utils.connection import OgreConnection
 
 
 @mock.patch('ogreclient.utils.connection.OgreConnection')
@@ -73,3 +84,189 @@ def test_search_ranking(mock_subprocess_popen, client_config, ebook_lib_path, tm
     # verify found mobi file hash; it is ranked higher than epub
     assert len(data) == 1
     assert data[data.keys()[0]].file_hash == 'f2cb3defc99fc9630722677843565721'
+
+
+@mock.patch('ogreclient.core.ebook_obj.subprocess.Popen')
+def test_search_corrupt_copy(mock_subprocess_popen, client_config, tmpdir):
+    # ebook-meta fails on a corrupt book
+    mock_subprocess_popen.return_value.communicate.return_value = (b'', b'\nTraceback (most recent call last):\n')
+
+    libdir = tmpdir.mkdir('lib')
+    client_config['providers']['ebook_home'] = LibProvider(libpath=libdir.strpath)
+    client_config['ebook_cache'] = Cache(client_config, tmpdir.join('ebook_cache.db').strpath)
+    client_config['ebook_cache'].verify_cache()
+    client_config['skip_cache'] = False
+
+    libdir.join('corrupt.epub').write('corrupt')
+    _, _, errord, _ = scan_for_ebooks(client_config)
+    assert isinstance(errord[0], exceptions.CorruptEbookError)
+
+    # a copy of the corrupt book fails again, rather than being found by content
+    libdir.join('copy.epub').write('corrupt')
+    data, _, errord, skipped = scan_for_ebooks(client_config)
+
+    assert data == {}
+    assert [os.path.basename(e.ebook_obj.path) for e in errord] == ['copy.epub']
+    assert isinstance(errord[0], exceptions.CorruptEbookError)
+    assert skipped == 2
+
+
+@mock.patch('ogreclient.main.ThreadPool')
+def test_upload_errord_books_dedupe(mock_thread_pool, client_config, tmpdir):
+    # run uploads in the calling thread
+    mock_thread_pool.return_value.imap_unordered.side_effect = lambda f, items: (f(i) for i in items)
+
+    connection = mock.Mock()
+    client_config['ebook_cache'] = Cache(client_config, tmpdir.join('ebook_cache.db').strpath)
+    client_config['ebook_cache'].verify_cache()
+
+    ebook_objs = []
+    for name in ('egg', 'bacon', 'sausage'):
+        tmpdir.join('{}.epub'.format(name)).write(name)
+        ebook_obj = EbookObject(filepath=tmpdir.join('{}.epub'.format(name)).strpath)
+        ebook_obj.compute_md5()
+        ebook_objs.append(ebook_obj)
+
+    # sausage was uploaded during a previous debug run
+    client_config['ebook_cache'].store_errord_uploaded(ebook_objs[2].file_hash)
+
+    # egg failed twice
+    errord_list = [
+        exceptions.CorruptEbookError(ebook_objs[0]),
+        exceptions.DecryptionFailed(ebook_objs[0]),
+        exceptions.CorruptEbookError(ebook_objs[1]),
+        exceptions.CorruptEbookError(ebook_objs[2]),
+    ]
+
+    upload_errord_books(client_config, connection, errord_list)
+
+    # only egg and bacon uploaded, once each
+    assert connection.upload.call_count == 2
+    assert client_config['ebook_cache'].get_errord_uploaded(
+        [e.file_hash for e in ebook_objs]
+    ) == {e.file_hash for e in ebook_objs}
+
+    # nothing more uploaded on the next debug run
+    upload_errord_books(client_config, connection, errord_list)
+    assert connection.upload.call_count == 2
+
+
+def test_connection_imap_unordered(client_config):
+    client_config['max_connections'] = 3
+    connection = OgreConnection(client_config)
+
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def _call(n):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return n * 2
+
+    assert sorted(connection.imap_unordered(_call, range(9))) == [n * 2 for n in range(9)]
+    # calls overlapped, up to the connection limit
+    assert peak[0] == 3
+
+    # stopping early abandons the queued calls
+    calls = []
+    results = connection.imap_unordered(lambda n: calls.append(n) or time.sleep(0.05), range(100))
+    with contextlib.closing(results):
+        next(results)
+    assert len(calls) < 100
+
+
+def test_upload_compressed_to_fake_server(client_config, tmpdir):
+    # mobi is flagged compressible in the definitions
+    tmpdir.join('book.mobi').write_binary(b'compressible ebook text ' * 10000)
+    tmpdir.join('random.mobi').write_binary(os.urandom(50000))
+
+    ebooks_by_filehash = {}
+    for name in ('book.mobi', 'random.mobi'):
+        ebook_obj = EbookObject(filepath=tmpdir.join(name).strpath, fmt='mobi')
+        ebook_obj.compute_md5()
+        ebooks_by_filehash[ebook_obj.file_hash] = ebook_obj
+
+    with FakeOgreServer() as server:
+        client_config['host'] = server.parsed_url
+        connection = OgreConnection(client_config)
+        connection.login('test', 'test')
+
+        assert upload_ebooks(client_config, connection, ebooks_by_filehash, list(ebooks_by_filehash)) == 2
+
+        for file_hash, ebook_obj in ebooks_by_filehash.iteritems():
+            assert server.uploaded[file_hash] == tmpdir.join(os.path.basename(ebook_obj.path)).read_binary()
+
+        # random data fails the sampling check and is sent uncompressed
+        assert server.stats['gzip_requests'] == 1
+        assert server.stats['bytes_received'] < 60000
+
+
+def test_sync_resume(client_config, tmpdir):
+    libdir = tmpdir.mkdir('lib')
+    EbookObject.ebook_home = libdir.strpath
+    client_config['ebook_cache'] = Cache(client_config, tmpdir.join('ebook_cache.db').strpath)
+    client_config['ebook_cache'].verify_cache()
+
+    ebooks_by_authortitle, ebooks_by_filehash = {}, {}
+    for name in ('egg', 'bacon', 'sausage'):
+        libdir.join('{}.epub'.format(name)).write(name)
+        ebook_obj = EbookObject(
+            filepath=libdir.join('{}.epub'.format(name)).strpath,
+            authortitle='Monty\u0006Python\u0007{}'.format(name),
+            drmfree=True,
+            source='TEST',
+        )
+        ebook_obj.compute_md5()
+        client_config['ebook_cache'].store_ebook(ebook_obj)
+        ebooks_by_authortitle[ebook_obj.authortitle] = ebook_obj
+        ebooks_by_filehash[ebook_obj.file_hash] = ebook_obj
+
+    written, resumed = [], [False]
+
+    def _write_metadata_identifier(ebook_obj, temp_file_path):
+        # stand-in for calibre; sausage fails during the first sync
+        if ebook_obj.path.endswith('sausage.epub') and not resumed[0]:
+            raise exceptions.FailedWritingMetaDataError(ebook_obj)
+        written.append(os.path.basename(ebook_obj.path))
+        with open(temp_file_path, 'ab') as f:
+            f.write(b'ogre_id:{}'.format(ebook_obj.ebook_id))
+
+    with FakeOgreServer() as server, \
+            mock.patch.object(EbookObject, '_write_metadata_identifier', autospec=True, side_effect=_write_metadata_identifier):
+        client_config['host'] = server.parsed_url
+        connection = OgreConnection(client_config)
+        connection.login('test', 'test')
+
+        # interrupt the sync after the update step
+        with mock.patch('ogreclient.main.query_for_uploads', side_effect=KeyboardInterrupt):
+            with pytest.raises(KeyboardInterrupt):
+                sync_ebooks(client_config, connection, ebooks_by_authortitle, ebooks_by_filehash, [], 0)
+
+        assert sorted(written) == ['bacon.epub', 'egg.epub']
+        assert server.stats['confirm'] == 2
+        assert server.uploaded == {}
+
+        # the sync is left in the journal
+        assert [done for _, _, done in client_config['ebook_cache'].get_journal('to_update')].count(False) == 1
+        assert client_config['ebook_cache'].get_journal('to_upload') is None
+
+        resumed[0] = True
+        with mock.patch('ogreclient.main.OgreConnection', return_value=connection):
+            assert resume_sync(client_config) == 3
+
+        # only the remaining book was updated, without syncing again
+        assert sorted(written) == ['bacon.epub', 'egg.epub', 'sausage.epub']
+        assert server.stats['confirm'] == 3
+        assert server.stats['post'] == 1
+
+        # every book was uploaded with its OGRE_ID
+        assert sorted(server.uploaded.values()) == sorted(
+            libdir.join('{}.epub'.format(name)).read_binary() for name in ('egg', 'bacon', 'sausage')
+        )
+        assert server.pending == set()
+
+    assert client_config['ebook_cache'].get_journal('to_update') is None
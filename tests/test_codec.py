@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+
+import pytest
+
+from ogreclient.utils import codec
+
+
+DATA = {
+    'format': 'epub',
+    'size': 1234,
+    'dedrm': False,
+    'authortitle': 'H. C.\u0006Andersen\u0007Andersen\u2019s Fairy Tales',
+    'meta': {'title': 'Andersen\u2019s Fairy Tales', 'source': 'TEST', 'uri': None},
+}
+
+
+def test_codec_roundtrip():
+    data = codec.encode(DATA)
+    assert codec.is_binary(data)
+    assert codec.decode(data) == DATA
+
+    # as returned from a sqlite BLOB
+    assert codec.decode(buffer(data)) == DATA
+
+
+def test_codec_decodes_json():
+    # rows written before binary payloads
+    assert codec.decode(json.dumps(DATA)) == DATA
+    assert codec.decode(json.dumps(DATA).decode('utf8')) == DATA
+
+
+def test_codec_json():
+    # payloads can still be written as JSON
+    data = codec.encode(DATA, codec=codec.JsonCodec())
+    assert codec.is_binary(data) is False
+    assert codec.decode(data) == DATA
+
+
+def test_codec_unknown_tag():
+    with pytest.raises(codec.CodecError):
+        codec.decode(b'\x00z' + b'payload')
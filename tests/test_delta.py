@@ -0,0 +1,141 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import hashlib
+import io
+import random
+
+import mock
+
+from benchmarks.server import FakeOgreServer
+from ogreclient import exceptions
+from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.core.upload import upload_ebooks
+from ogreclient.utils.connection import OgreConnection
+from ogreclient.utils.delta import apply_delta, compute_delta, signature
+
+
+def _roundtrip(base, new, block_size=64):
+    sigs = signature(io.BytesIO(base), block_size)
+
+    delta = io.BytesIO()
+    literal_bytes = compute_delta(io.BytesIO(new), sigs, block_size, delta)
+
+    out = io.BytesIO()
+    delta.seek(0)
+    apply_delta(io.BytesIO(base), delta, out)
+    assert out.getvalue() == new
+
+    return literal_bytes
+
+
+def test_delta_roundtrip():
+    rand = random.Random(1)
+    base = bytes(bytearray(rand.getrandbits(8) for _ in range(10000)))
+
+    # identical file is all copies
+    assert _roundtrip(base, base) == 10000 % 64
+
+    # an insertion shifts the remaining blocks; the rolling checksum re-syncs
+    new = base[:3000] + b'OGRE_ID:abcdef' + base[3000:]
+    assert _roundtrip(base, new) < 200
+
+    # an in-place change only costs the changed block
+    new = base[:5000] + b'X' * 10 + base[5010:]
+    assert _roundtrip(base, new) < 200
+
+    # unrelated data is all literal
+    assert _roundtrip(base, b'nothing in common' * 100) == 1700
+
+    # the file is read in chunks; matches span chunk boundaries
+    with mock.patch('ogreclient.utils.delta.DELTA_READ_SIZE', 100):
+        assert _roundtrip(base, base) == 10000 % 64
+        assert _roundtrip(base, base[:3000] + b'OGRE_ID:abcdef' + base[3000:]) < 200
+        assert _roundtrip(base, b'nothing in common' * 100) == 1700
+
+
+def test_delta_max_literal():
+    rand = random.Random(1)
+    base = bytes(bytearray(rand.getrandbits(8) for _ in range(10000)))
+    sigs = signature(io.BytesIO(base), 64)
+
+    new = mock.Mock(wraps=io.BytesIO(b'nothing in common' * 10000))
+
+    with mock.patch('ogreclient.utils.delta.DELTA_READ_SIZE', 1000):
+        assert compute_delta(new, sigs, 64, io.BytesIO(), max_literal=5000) is None
+
+    # gave up without reading the whole file
+    assert new.read.call_count < 10
+
+    # a small change is within the limit
+    new = base[:3000] + b'OGRE_ID:abcdef' + base[3000:]
+    assert compute_delta(io.BytesIO(new), sigs, 64, io.BytesIO(), max_literal=5000) < 200
+
+
+def test_upload_delta_to_fake_server(client_config, tmpdir):
+    rand = random.Random(2)
+    old = bytes(bytearray(rand.getrandbits(8) for _ in range(100000)))
+    new = old[:50000] + b'<ogre_id>1234</ogre_id>' + old[50000:]
+
+    old_hash = hashlib.md5(old).hexdigest()
+    new_hash = hashlib.md5(new).hexdigest()
+
+    tmpdir.join('book.epub').write_binary(new)
+    ebook_obj = EbookObject(filepath=tmpdir.join('book.epub').strpath, fmt='epub')
+    ebook_obj.compute_md5()
+    ebook_obj.ebook_id = 'abc'
+
+    with FakeOgreServer() as server:
+        # ogreserver has the previous version of this book
+        server.uploaded[old_hash] = old
+        server.bases[new_hash] = old_hash
+        server.pending.add(new_hash)
+
+        client_config['host'] = server.parsed_url
+        connection = OgreConnection(client_config)
+        connection.login('test', 'test')
+
+        assert upload_ebooks(client_config, connection, {new_hash: ebook_obj}, [new_hash]) == 1
+
+        assert server.uploaded[new_hash] == new
+        assert server.stats['upload-delta'] == 1
+        assert server.stats['upload'] == 0
+        # far less than the whole book was sent
+        assert server.stats['bytes_received'] < 20000
+
+
+def test_upload_delta_too_large(client_config, tmpdir):
+    tmpdir.join('book.epub').write_binary(b'content')
+    ebook_obj = EbookObject(filepath=tmpdir.join('book.epub').strpath, fmt='epub')
+    ebook_obj.compute_md5()
+
+    with FakeOgreServer() as server:
+        client_config['host'] = server.parsed_url
+        connection = OgreConnection(client_config)
+        connection.login('test', 'test')
+
+        with mock.patch('ogreclient.core.upload.DELTA_MAX_SIZE', 4):
+            upload_ebooks(client_config, connection, {ebook_obj.file_hash: ebook_obj}, [ebook_obj.file_hash])
+
+        # uploaded whole, without asking for signatures
+        assert server.stats['signatures'] == 0
+        assert server.uploaded[ebook_obj.file_hash] == b'content'
+
+
+def test_upload_delta_unsupported_server(client_config, tmpdir):
+    tmpdir.join('book.epub').write_binary(b'content')
+    ebook_obj = EbookObject(filepath=tmpdir.join('book.epub').strpath, fmt='epub')
+    ebook_obj.compute_md5()
+
+    with FakeOgreServer() as server:
+        client_config['host'] = server.parsed_url
+        connection = OgreConnection(client_config)
+        connection.login('test', 'test')
+
+        # simulate an ogreserver without the signatures endpoint
+        with mock.patch.object(connection, 'request', side_effect=exceptions.RequestError(404)):
+            upload_ebooks(client_config, connection, {ebook_obj.file_hash: ebook_obj}, [ebook_obj.file_hash])
+
+        assert connection.delta_supported is False
+        assert server.uploaded[ebook_obj.file_hash] == b'content'
+
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import contextlib
+import os
+import threading
+import time
+
+import mock
+import pytest
+
+from ogreclient.utils import devices
+
+
+@pytest.fixture(scope='function')
+def two_devices(tmpdir):
+    # files under "hdd" are reported on a different device to those under "ssd"
+    hdd, ssd = tmpdir.mkdir('hdd'), tmpdir.mkdir('ssd')
+    paths = []
+    for d in (hdd, ssd):
+        for n in range(6):
+            d.join('{}.epub'.format(n)).write('book')
+            paths.append(d.join('{}.epub'.format(n)).strpath)
+
+    def _device_of(path):
+        return 'hdd' if path.startswith(hdd.strpath) else 'ssd'
+
+    with mock.patch('ogreclient.utils.devices.device_of', side_effect=_device_of), \
+            mock.patch('ogreclient.utils.devices.locate', side_effect=lambda path: (_device_of(path), None)):
+        with mock.patch.dict('ogreclient.utils.devices._cache', {'hdd': 1, 'ssd': 3}):
+            yield paths, _device_of
+
+
+def _run(paths, device_of, **kwargs):
+    lock = threading.Lock()
+    active, peak = {'hdd': 0, 'ssd': 0, 'all': 0}, {'hdd': 0, 'ssd': 0, 'all': 0}
+
+    def _read(path):
+        with lock:
+            for key in (device_of(path), 'all'):
+                active[key] += 1
+                peak[key] = max(peak[key], active[key])
+        time.sleep(0.02)
+        with lock:
+            for key in (device_of(path), 'all'):
+                active[key] -= 1
+        return path.upper()
+
+    with contextlib.closing(devices.imap_by_device(_read, paths, **kwargs)) as results:
+        assert sorted(results) == sorted((path, path.upper()) for path in paths)
+
+    return peak
+
+
+def test_imap_by_device_limits_each_device(two_devices):
+    peak = _run(*two_devices)
+    assert (peak['hdd'], peak['ssd']) == (1, 3)
+
+
+def test_imap_by_device_max_concurrency(two_devices):
+    peak = _run(*two_devices, max_concurrency=2)
+    assert peak['all'] <= 2
+
+
+def test_imap_by_device_raises(tmpdir):
+    def _read(path):
+        raise IOError(path)
+
+    with pytest.raises(IOError):
+        list(devices.imap_by_device(_read, [tmpdir.strpath]))
+
+
+def test_configure_overrides(tmpdir):
+    dev = os.stat(tmpdir.strpath).st_dev
+    try:
+        devices.configure('{}=7,/not/mounted=2'.format(tmpdir.strpath))
+        assert devices.concurrency(dev) == 7
+
+        with pytest.raises(ValueError):
+            devices.configure('{}=none'.format(tmpdir.strpath))
+    finally:
+        devices.configure()
+
+    assert devices.concurrency(dev) != 7
+
+
+def test_reading_limits_each_device(two_devices):
+    paths, device_of = two_devices
+    lock = threading.Lock()
+    active, peak = {'hdd': 0, 'ssd': 0}, {'hdd': 0, 'ssd': 0}
+
+    def _read(path):
+        with devices.reading(path):
+            with lock:
+                active[device_of(path)] += 1
+                peak[device_of(path)] = max(peak[device_of(path)], active[device_of(path)])
+            time.sleep(0.02)
+            with lock:
+                active[device_of(path)] -= 1
+
+    with mock.patch.dict('ogreclient.utils.devices._semaphores', clear=True):
+        threads = [threading.Thread(target=_read, args=(path,)) for path in paths]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert (peak['hdd'], peak['ssd']) == (1, 3)
+
+
+def test_locality_order(tmpdir):
+    # create files in one order, and list them in another
+    paths = [tmpdir.join('{}.epub'.format(name)).strpath for name in ('c', 'a', 'b')]
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write('book')
+    found = sorted(paths)
+    by_inode = sorted(paths, key=lambda path: os.stat(path).st_ino)
+
+    try:
+        # as found by default
+        assert devices.locality_order(found) == found
+
+        devices.configure(read_order='inode')
+        assert devices.locality_order(found) == by_inode
+
+        # falls back to inode order where FIEMAP is not supported
+        devices.configure(read_order='extent')
+        assert sorted(devices.locality_order(found)) == found
+
+        with pytest.raises(ValueError):
+            devices.configure(read_order='random')
+    finally:
+        devices.configure()
+
+
+def test_imap_by_device_read_order(tmpdir):
+    paths = [tmpdir.join('{}.epub'.format(name)).strpath for name in ('c', 'a', 'b')]
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write('book')
+
+    try:
+        # a single reader starts books in inode order
+        devices.configure(read_order='inode')
+        with mock.patch.dict('ogreclient.utils.devices._cache', {os.stat(tmpdir.strpath).st_dev: 1}):
+            results = [item for item, _ in devices.imap_by_device(lambda path: None, sorted(paths))]
+    finally:
+        devices.configure()
+
+    assert results == sorted(paths, key=lambda path: os.stat(path).st_ino)
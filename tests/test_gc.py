@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import datetime
+import os
+import sqlite3
+
+import pytest
+
+from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.core.gc import collect_garbage, maybe_collect_garbage, GC_TOMBSTONE_DAYS
+from ogreclient.exceptions import MissingFromCacheError
+from ogreclient.utils.cache import Cache
+
+
+@pytest.fixture(scope='function')
+def gc_config(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+    return {'ebook_cache': cache}
+
+
+def _store(cache, path, file_hash):
+    path.write('book')
+    cache.store_ebook(EbookObject(path.strpath, file_hash=file_hash, size=4, authortitle='a', source='TEST'))
+
+
+def _set_dev(cache, path, dev):
+    conn = sqlite3.connect(cache.ebook_cache_path)
+    conn.execute('UPDATE ebooks SET dev = ? WHERE path = ?', (dev, path))
+    conn.commit()
+    conn.close()
+
+
+def _missing_since(cache, path):
+    conn = sqlite3.connect(cache.ebook_cache_path)
+    row = conn.execute('SELECT missing_since FROM ebooks WHERE path = ?', (path,)).fetchone()
+    conn.close()
+    return row
+
+
+def test_gc_removes_deleted_ebook(gc_config, tmpdir):
+    cache = gc_config['ebook_cache']
+
+    kept, deleted = tmpdir.join('kept.epub'), tmpdir.join('deleted.epub')
+    _store(cache, kept, 'abc')
+    _store(cache, deleted, 'def')
+    deleted.remove()
+
+    before, after = collect_garbage(gc_config)
+    assert (before['ebooks'], before['contents']) == (2, 2)
+    assert (after['ebooks'], after['contents']) == (1, 1)
+
+    # the deleted book and its orphaned metadata are gone
+    assert cache.get_ebook(kept.strpath).file_hash == 'abc'
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook(deleted.strpath)
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook_by_content(deleted.strpath, 'def')
+
+    assert cache.get_last_gc() is not None
+
+
+def test_gc_tombstones_unmounted_ebook(gc_config, tmpdir):
+    cache = gc_config['ebook_cache']
+
+    path = tmpdir.mkdir('drive').join('book.epub')
+    _store(cache, path, 'abc')
+
+    # the book was on a different device to its nearest existing parent
+    _set_dev(cache, path.strpath, os.stat(tmpdir.strpath).st_dev + 1)
+    path.dirpath().remove()
+
+    collect_garbage(gc_config, vacuum=False)
+    assert _missing_since(cache, path.strpath)[0] is not None
+
+    # the drive is plugged back in
+    path.dirpath().ensure(dir=True)
+    path.write('book')
+
+    collect_garbage(gc_config, vacuum=False)
+    assert _missing_since(cache, path.strpath) == (None,)
+
+
+def test_gc_tombstones_ebook_without_device(gc_config, tmpdir):
+    cache = gc_config['ebook_cache']
+
+    path = tmpdir.mkdir('drive').join('book.epub')
+    _store(cache, path, 'abc')
+
+    # cached by an older ogreclient, which did not record the device
+    _set_dev(cache, path.strpath, None)
+    path.dirpath().remove()
+
+    collect_garbage(gc_config, vacuum=False)
+    assert _missing_since(cache, path.strpath)[0] is not None
+
+
+def test_gc_removes_expired_tombstone(gc_config, tmpdir):
+    cache = gc_config['ebook_cache']
+
+    path = tmpdir.mkdir('drive').join('book.epub')
+    _store(cache, path, 'abc')
+    _set_dev(cache, path.strpath, os.stat(tmpdir.strpath).st_dev + 1)
+    path.dirpath().remove()
+
+    expired = datetime.datetime.utcnow() - datetime.timedelta(days=GC_TOMBSTONE_DAYS + 1)
+    cache.gc_ebooks([], [path.strpath], [], expired.isoformat())
+
+    collect_garbage(gc_config, vacuum=False)
+    assert _missing_since(cache, path.strpath) is None
+
+
+def test_gc_runs_periodically(gc_config, tmpdir):
+    cache = gc_config['ebook_cache']
+
+    path = tmpdir.join('book.epub')
+    _store(cache, path, 'abc')
+    path.remove()
+
+    # the first run only starts the interval
+    maybe_collect_garbage(gc_config)
+    assert _missing_since(cache, path.strpath) == (None,)
+
+    cache.set_last_gc((datetime.datetime.utcnow() - datetime.timedelta(days=30)).isoformat())
+    maybe_collect_garbage(gc_config)
+    assert _missing_since(cache, path.strpath) is None
@@ -2,12 +2,15 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import json
 import os
 import shutil
 
 import mock
 import pytest
 
+from ogreclient.core.ebook_obj import EbookObject
+
 
 @pytest.mark.requires_calibre
 def test_metadata_epub(helper_get_ebook):
@@ -215,3 +218,35 @@ def test_metadata_ogreid_azw3(mock_connection, helper_get_ebook, ebook_lib_path,
     assert metadata.get('ebook_id') == 'ëgg'
     assert metadata.get('tags') == 'Fantasy'
     assert 'ogre_id' not in metadata.get('tags')
+
+
+def test_deserialize_lazy_meta():
+    cached_obj = (
+        'b' * 32,
+        'egg',
+        json.dumps({
+            'authortitle': 'Lewis\u0006Carroll\u0007Alice',
+            'format': 'epub',
+            'size': 1234,
+            'meta': {'source': 'TEST', 'title': 'Alice'},
+        }),
+        1,
+        0,
+    )
+    ebook_obj = EbookObject.deserialize('/tmp/pg11.epub', cached_obj)
+
+    # data blob is not decoded for the cheap fields
+    assert ebook_obj.skip is False
+    assert ebook_obj.drmfree is True
+    assert ebook_obj.file_hash == 'b' * 32
+    assert ebook_obj._cached_data is not None
+
+    # first access of a cached field decodes the blob
+    assert ebook_obj.meta['title'] == 'Alice'
+    assert ebook_obj._cached_data is None
+    assert ebook_obj.format == 'epub'
+    assert ebook_obj.size == 1234
+    assert ebook_obj.serialize(for_cache=True)['authortitle'] == 'Lewis\u0006Carroll\u0007Alice'
+
+    # no per-instance __dict__
+    assert not hasattr(ebook_obj, '__dict__')
@@ -0,0 +1,72 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import gzip
+import io
+
+import mock
+
+from ogreclient.utils import capture
+from ogreclient.utils.printer import CliPrinterImpl, LogBuffer
+
+
+def test_progressf_throttled_on_tty():
+    prntr = CliPrinterImpl()
+    prntr.is_tty = True
+
+    with capture() as out:
+        for i in range(1, 1001):
+            prntr.progressf(num_blocks=i, total_size=1000)
+
+    # first and final states are drawn; everything in between is throttled
+    assert out[0].count('\r') < 10
+    assert '100.0%' in out[0]
+
+
+@mock.patch('ogreclient.utils.printer.PROGRESS_PLAIN_INTERVAL', 0)
+def test_progressf_plain_lines_when_not_tty():
+    prntr = CliPrinterImpl()
+    prntr.is_tty = False
+
+    with capture() as out:
+        for i in range(1, 4):
+            prntr.progressf(num_blocks=i, total_size=3, nbytes=i * 1048576)
+
+    # one plain line per render, no carriage returns
+    assert '\r' not in out[0]
+    lines = out[0].splitlines()
+    assert len(lines) == 3
+    assert '3/3 (100.0%)' in lines[-1]
+
+
+def test_log_buffer_spills_to_disk(tmpdir):
+    logs = LogBuffer(tmpdir.strpath, memory_budget=100, max_file_size=1000)
+
+    for i in range(50):
+        logs.append('line {:02}'.format(i))
+
+    # memory stays within budget, overflow written to the log file
+    assert logs.memory_size <= 100
+    assert tmpdir.join('debug.log').check()
+
+    # all lines are returned, in order
+    data = b''.join(logs.iterchunks()).decode('utf-8').splitlines()
+    assert data == ['line {:02}'.format(i) for i in range(50)]
+
+    # gzip output streams the same content
+    buf = io.BytesIO()
+    logs.write_gzip(buf)
+    assert gzip.GzipFile(fileobj=io.BytesIO(buf.getvalue())).read().splitlines()[-1] == b'line 49'
+
+
+def test_log_buffer_without_dir_is_bounded():
+    logs = LogBuffer(memory_budget=100)
+
+    for i in range(50):
+        logs.append('line {:02}'.format(i))
+
+    # oldest lines are dropped
+    data = b''.join(logs.iterchunks()).decode('utf-8').splitlines()
+    assert logs.memory_size <= 100
+    assert data[-1] == 'line 49'
+    assert 'line 00' not in data
@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import json
+
+import mock
+
+from ogreclient import exceptions
+from ogreclient.utils.printer import CliPrinterImpl
+from ogreclient.utils.profiler import Profiler, write_run_report
+
+
+def test_profiler_disabled():
+    profiler = Profiler()
+
+    with profiler.phase('scan'):
+        profiler.count(items=10, nbytes=100)
+        with profiler.call('sqlite'):
+            pass
+
+    # nothing recorded unless enabled
+    assert not profiler.phases
+    assert not profiler.calls
+
+
+def test_profiler_phases_and_calls():
+    profiler = Profiler()
+    profiler.enable()
+
+    @profiler.timed('sqlite')
+    def cache_read():
+        return 'egg'
+
+    with profiler.phase('scan'):
+        profiler.count(items=2, nbytes=2048)
+        assert cache_read() == 'egg'
+        with profiler.call('subprocess'):
+            pass
+
+    # phases of the same name are summed
+    with profiler.phase('scan'):
+        profiler.count(items=1)
+
+    # counts outside a phase are ignored
+    profiler.count(items=99)
+
+    assert profiler.phases['scan']['items'] == 3
+    assert profiler.phases['scan']['bytes'] == 2048
+    assert profiler.calls['sqlite']['calls'] == 1
+    assert profiler.calls['subprocess']['calls'] == 1
+
+    # report renders through the printer's table formatter
+    report = profiler.report()
+    assert report[0][0] == 'phase'
+    assert report[1][0] == 'scan'
+    table = CliPrinterImpl()._format_tabular(report)
+    assert 'subprocess' in table
+
+
+@mock.patch('ogreclient.utils.profiler.profiler', new_callable=Profiler)
+def test_write_run_report_jsonl(mock_profiler, tmpdir):
+    mock_profiler.enable()
+
+    with mock_profiler.phase('upload'):
+        mock_profiler.count(items=1, nbytes=1048576)
+        mock_profiler.incr('uploaded')
+    mock_profiler.error(exceptions.UploadError(None))
+
+    report_path = tmpdir.join('report.jsonl').strpath
+
+    # each run appends a single line
+    write_run_report(report_path, fmt='jsonl', mode='sync', result=1)
+    write_run_report(report_path, fmt='jsonl', mode='sync', result=1)
+
+    with open(report_path) as f:
+        lines = f.readlines()
+
+    assert len(lines) == 2
+    report = json.loads(lines[0])
+    assert report['mode'] == 'sync'
+    assert report['counters']['uploaded'] == 1
+    assert report['errors'] == {'UploadError': 1}
+    assert report['phases']['upload']['bytes'] == 1048576
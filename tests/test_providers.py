@@ -0,0 +1,327 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import json
+import os
+import sqlite3
+
+import mock
+
+from ogreclient import providers
+from ogreclient.config import read_config, write_config
+from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.core.scan import _find_ebooks, _preload_metadata, _process_ebooks
+from ogreclient.providers import (CalibreProvider, LibProvider, PathsProvider, find_ebook_providers,
+                                  parse_ade_manifest, scan_ade_manifests)
+from ogreclient.utils.cache import Cache
+
+
+MANIFEST = '''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://ns.adobe.com/digitaleditions/package" xmlns:dp="http://ns.adobe.com/digitaleditions/package/dp">
+  <dp:metadata><dc:title xmlns:dc="http://purl.org/dc/elements/1.1/">Title</dc:title></dp:metadata>
+  <dp:content href="file://{}"/>
+  <dp:content href="file:///other.epub"/>
+'''
+
+
+def _write_manifest(directory, name, book_path, tail='</package>'):
+    manifest = directory.join(name)
+    manifest.write(MANIFEST.format(book_path) + tail)
+    return manifest.strpath
+
+
+def test_parse_ade_manifest_first_content(tmpdir):
+    book = tmpdir.join('My Book.epub')
+    book.write('')
+    manifest = _write_manifest(tmpdir, 'book.xml', book.strpath.replace(' ', '%20'))
+
+    assert parse_ade_manifest(manifest) == book.strpath
+
+
+def test_parse_ade_manifest_stops_at_content(tmpdir):
+    # everything after the first dp:content element is never read
+    manifest = _write_manifest(tmpdir, 'book.xml', '/books/book.epub', tail='<broken></package')
+
+    assert parse_ade_manifest(manifest) == '/books/book.epub'
+
+
+def test_parse_ade_manifest_invalid(tmpdir):
+    manifest = tmpdir.join('bad.xml')
+    manifest.write('<package><nothing')
+
+    assert parse_ade_manifest(manifest.strpath) is None
+
+
+def test_scan_ade_manifests_uses_cache(tmpdir):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    manifests = tmpdir.mkdir('manifests')
+    book = tmpdir.join('book.epub')
+    book.write('')
+    manifest = _write_manifest(manifests, 'book.xml', book.strpath)
+
+    assert scan_ade_manifests(manifests.strpath, cache) == [(book.strpath, 'epub')]
+
+    # unchanged manifests are not parsed again
+    with mock.patch.object(providers, 'parse_ade_manifest') as parse:
+        assert scan_ade_manifests(manifests.strpath, cache) == [(book.strpath, 'epub')]
+        assert parse.call_count == 0
+
+    # a changed manifest is parsed again
+    st = os.stat(manifest)
+    os.utime(manifest, (st.st_atime, st.st_mtime + 10))
+    with mock.patch.object(providers, 'parse_ade_manifest', return_value=None) as parse:
+        assert scan_ade_manifests(manifests.strpath, cache) == []
+        assert parse.call_count == 1
+
+    # removed manifests are forgotten
+    os.remove(manifest)
+    assert scan_ade_manifests(manifests.strpath, cache) == []
+    assert cache.get_ade_manifests() == {}
+
+
+def test_paths_provider_iter_ebooks(client_config):
+    definitions = client_config['definitions']
+    provider = PathsProvider(friendly='ADE')
+    provider.paths = [('/books/one.epub', 'epub'), ('/books/.hidden.epub', 'epub'), ('/books/two.txt', 'txt')]
+
+    assert list(provider.iter_ebooks(definitions)) == [('/books/one.epub', 'epub', 'ADE')]
+
+
+def test_find_ebooks_skips_unchanged_providers(tmpdir, client_config):
+    definitions = client_config['definitions']
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    library = tmpdir.mkdir('library')
+    library.mkdir('sub').join('book.epub').write('')
+    home = LibProvider(friendly='Ebook Home', libpath=library.strpath)
+    calibre_library = tmpdir.mkdir('Calibre Library')
+    _make_calibre_library(calibre_library)
+    calibre = CalibreProvider(friendly='Calibre Library', libpath=calibre_library.strpath)
+    ade = PathsProvider(friendly='ADE')
+    ade.paths = [('/books/one.epub', 'epub')]
+    providers = {'home': home, 'calibre': calibre, 'ade': ade}
+
+    assert len(_find_ebooks(providers, definitions, ebook_cache=cache)) == 4
+
+    # an unchanged calibre library is not enumerated again; plain paths always are
+    with mock.patch.object(CalibreProvider, 'iter_ebooks') as iter_ebooks:
+        assert len(_find_ebooks(providers, definitions, ebook_cache=cache)) == 4
+        assert iter_ebooks.call_count == 0
+
+    library.join('sub', 'new.epub').write('')
+    ade.paths.append(('/books/two.epub', 'epub'))
+    assert len(_find_ebooks(providers, definitions, ebook_cache=cache)) == 6
+
+
+def test_find_ebooks_new_format_rescans_provider(tmpdir, client_config):
+    cache = Cache({}, tmpdir.join('ebook_cache.db').strpath)
+    cache.verify_cache()
+
+    library = tmpdir.mkdir('Calibre Library')
+    _make_calibre_library(library)
+    providers = {'calibre': CalibreProvider(friendly='Calibre Library', libpath=library.strpath)}
+
+    definitions = collections.OrderedDict(client_config['definitions'])
+    mobi = definitions.pop('mobi')
+    assert [fmt for _, fmt, _ in _find_ebooks(providers, definitions, ebook_cache=cache)] == ['epub']
+
+    # ogreserver starts supporting a format which the stored listing filtered out
+    definitions['mobi'] = mobi
+    assert sorted(fmt for _, fmt, _ in _find_ebooks(providers, definitions, ebook_cache=cache)) == [
+        'epub', 'mobi',
+    ]
+
+
+def _make_calibre_library(library):
+    # the subset of calibre's schema read by CalibreProvider
+    conn = sqlite3.connect(library.join('metadata.db').strpath)
+    conn.executescript('''
+        CREATE TABLE books (id INTEGER PRIMARY KEY, title TEXT, author_sort TEXT, path TEXT, pubdate TEXT);
+        CREATE TABLE authors (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE books_authors_link (id INTEGER PRIMARY KEY, book INTEGER, author INTEGER);
+        CREATE TABLE tags (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE books_tags_link (id INTEGER PRIMARY KEY, book INTEGER, tag INTEGER);
+        CREATE TABLE publishers (id INTEGER PRIMARY KEY, name TEXT);
+        CREATE TABLE books_publishers_link (id INTEGER PRIMARY KEY, book INTEGER, publisher INTEGER);
+        CREATE TABLE identifiers (id INTEGER PRIMARY KEY, book INTEGER, type TEXT, val TEXT);
+        CREATE TABLE data (id INTEGER PRIMARY KEY, book INTEGER, format TEXT, name TEXT);
+
+        INSERT INTO books VALUES (1, 'Emma', 'Austen, Jane', 'Jane Austen/Emma (1)', '1815-12-23 00:00:00+00:00');
+        INSERT INTO books VALUES (2, 'Dracula', '', 'Bram Stoker/Dracula (2)', '0101-01-01 00:00:00+00:00');
+        INSERT INTO authors VALUES (1, 'Jane Austen');
+        INSERT INTO authors VALUES (2, 'Bram Stoker');
+        INSERT INTO books_authors_link VALUES (1, 1, 1);
+        INSERT INTO books_authors_link VALUES (2, 2, 2);
+        INSERT INTO tags VALUES (1, 'Fiction');
+        INSERT INTO tags VALUES (2, 'ogre_id=abc123');
+        INSERT INTO tags VALUES (3, 'OGRE-DeDRM');
+        INSERT INTO books_tags_link VALUES (1, 1, 1);
+        INSERT INTO books_tags_link VALUES (2, 2, 2);
+        INSERT INTO books_tags_link VALUES (3, 2, 3);
+        INSERT INTO publishers VALUES (1, 'Penguin');
+        INSERT INTO books_publishers_link VALUES (1, 1, 1);
+        INSERT INTO identifiers VALUES (1, 1, 'isbn', '9780141439587');
+        INSERT INTO identifiers VALUES (2, 1, 'mobi-asin', 'B000JQU1VS');
+        INSERT INTO data VALUES (1, 1, 'EPUB', 'Emma - Jane Austen');
+        INSERT INTO data VALUES (2, 1, 'ORIGINAL_EPUB', 'Emma - Jane Austen');
+        INSERT INTO data VALUES (3, 2, 'MOBI', 'Dracula - Bram Stoker');
+    ''')
+    conn.commit()
+    conn.close()
+
+    library.mkdir('Jane Austen').mkdir('Emma (1)').join('Emma - Jane Austen.epub').write('emma')
+    library.mkdir('Bram Stoker').mkdir('Dracula (2)').join('Dracula - Bram Stoker.mobi').write('dracula')
+
+
+def test_calibre_provider(tmpdir, client_config):
+    definitions = client_config['definitions']
+    library = tmpdir.mkdir('Calibre Library')
+    _make_calibre_library(library)
+    emma = library.join('Jane Austen', 'Emma (1)', 'Emma - Jane Austen.epub').strpath
+    dracula = library.join('Bram Stoker', 'Dracula (2)', 'Dracula - Bram Stoker.mobi').strpath
+
+    provider = CalibreProvider(friendly='Calibre Library', libpath=library.strpath)
+
+    assert sorted(provider.iter_ebooks(definitions)) == [
+        (dracula, 'mobi', 'Calibre Library'),
+        (emma, 'epub', 'Calibre Library'),
+    ]
+
+    metadata = provider.bulk_metadata(definitions)
+    assert metadata[emma] == {
+        'title': 'Emma',
+        'firstname': 'Jane',
+        'lastname': 'Austen',
+        'publisher': 'Penguin',
+        'publish_date': '1815-12-23T00:00:00+00:00',
+        'tags': 'Fiction',
+        'isbn': '9780141439587',
+        'asin': 'B000JQU1VS',
+    }
+    assert metadata[dracula] == {
+        'title': 'Dracula',
+        'firstname': 'Bram',
+        'lastname': 'Stoker',
+        'ebook_id': 'abc123',
+        'drmfree': True,
+    }
+
+
+def test_calibre_metadata_skips_ebook_meta(tmpdir, client_config):
+    definitions = client_config['definitions']
+    library = tmpdir.mkdir('Calibre Library')
+    _make_calibre_library(library)
+
+    provider = CalibreProvider(friendly='Calibre Library', libpath=library.strpath)
+    providers = {'calibre': provider}
+
+    with mock.patch.object(EbookObject, '_metadata_extract') as extract:
+        ebooks_by_authortitle, ebooks_by_filehash, errord, _ = _process_ebooks(
+            _find_ebooks(providers, definitions),
+            mock.Mock(),
+            definitions,
+            skip_cache=True,
+            metadata=_preload_metadata(providers, definitions),
+        )
+        assert extract.call_count == 0
+
+    assert errord == []
+    dracula = ebooks_by_authortitle['Bram\u0006Stoker\u0007Dracula']
+    assert dracula.ebook_id == 'abc123'
+    assert dracula.drmfree is True
+
+
+def test_calibre_provider_reads_library_once(tmpdir, client_config):
+    definitions = client_config['definitions']
+    library = tmpdir.mkdir('Calibre Library')
+    _make_calibre_library(library)
+
+    provider = CalibreProvider(friendly='Calibre Library', libpath=library.strpath)
+
+    with mock.patch.object(provider, '_query_library', wraps=provider._query_library) as query:
+        # enumerating and preloading metadata share a single read
+        _find_ebooks({'calibre': provider}, definitions)
+        _preload_metadata({'calibre': provider}, definitions)
+        assert query.call_count == 1
+
+        # until calibre changes its database
+        st = os.stat(library.join('metadata.db').strpath)
+        os.utime(library.join('metadata.db').strpath, (st.st_atime, st.st_mtime + 10))
+        _preload_metadata({'calibre': provider}, definitions)
+        assert query.call_count == 2
+
+
+def test_calibre_provider_missing_database(tmpdir, client_config):
+    definitions = client_config['definitions']
+    library = tmpdir.mkdir('Calibre Library')
+    _make_calibre_library(library)
+    library.join('metadata.db').remove()
+
+    provider = CalibreProvider(friendly='Calibre Library', libpath=library.strpath)
+
+    # always rescanned, as a plain directory
+    assert provider.change_token() is None
+    assert len(_find_ebooks({'calibre': provider}, definitions)) == 2
+    assert provider.bulk_metadata(definitions) == {}
+    assert not library.join('metadata.db').exists()
+
+
+def test_find_ebook_providers_reuses_discovery(tmpdir, monkeypatch):
+    library = tmpdir.mkdir('Calibre Library')
+    _make_calibre_library(library)
+
+    calibre_config = tmpdir.mkdir('config').mkdir('calibre').join('global.py.json')
+    calibre_config.write(json.dumps({'library_path': library.strpath}))
+
+    monkeypatch.setenv(str('XDG_CONFIG_HOME'), str(tmpdir.join('config').strpath))
+    monkeypatch.setattr(providers.platform, 'system', lambda: 'Linux')
+
+    ignore = ['home', 'kindle', 'ade']
+    conf = {}
+    find_ebook_providers(conf, ignore=ignore)
+    assert conf['providers']['calibre'].libpath == library.strpath
+
+    def _discover(rediscover=False):
+        # as on a later run, with the results loaded from app.config
+        conf.update({'providers': {}})
+        with mock.patch.object(providers, '_handle_calibre_Linux') as handler:
+            find_ebook_providers(conf, ignore=ignore, rediscover=rediscover)
+            return handler.call_count
+
+    assert _discover() == 0
+    assert conf['providers']['calibre'].libpath == library.strpath
+
+    assert _discover(rediscover=True) == 1
+
+    # calibre's prefs changed
+    calibre_config.write(json.dumps({'library_path': tmpdir.strpath}))
+    assert _discover() == 1
+
+
+def test_read_config_providers_not_installed(tmpdir, monkeypatch, client_config):
+    monkeypatch.setenv(str('XDG_CONFIG_HOME'), str(tmpdir.strpath))
+    tmpdir.mkdir('ogre')
+
+    write_config({
+        'config_dir': tmpdir.join('ogre').strpath,
+        'calibre_ebook_meta_bin': '/usr/bin/ebook-meta',
+        'host': client_config['host'],
+        'username': 'test',
+        'password': 'test',
+        'definitions': client_config['definitions'],
+        'providers': {'home': None, 'ade': None},
+        'discovered': {
+            'kindle': {'fingerprint': 'abc', 'libpath': tmpdir.strpath, 'version': ''},
+            'calibre': {'fingerprint': 'def', 'libpath': '', 'version': ''},
+        },
+    })
+    conf = read_config()
+
+    # calibre was not installed, so has no --ignore-calibre option
+    assert 'has_kindle' in conf
+    assert 'has_calibre' not in conf
+    assert conf['discovered']['calibre']['libpath'] == ''
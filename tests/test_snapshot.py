@@ -0,0 +1,83 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import gzip
+import os
+import shutil
+
+import pytest
+
+from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.core.snapshot import export_cache, import_cache, rebase_path, SnapshotError
+from ogreclient.exceptions import MissingFromCacheError
+from ogreclient.utils.cache import Cache
+
+
+def _cache(path):
+    cache = Cache({}, path.strpath)
+    cache.verify_cache()
+    return {'ebook_cache': cache}
+
+
+def test_rebase_path():
+    rebase = [('/old/books/', '/new/library'), ('/old', '/other')]
+    assert rebase_path('/old/books/a/b.epub', rebase) == '/new/library/a/b.epub'
+    assert rebase_path('/old/books', rebase) == '/new/library'
+    assert rebase_path('/old/booksellers/b.epub', rebase) == '/other/booksellers/b.epub'
+    assert rebase_path('/elsewhere/b.epub', rebase) == '/elsewhere/b.epub'
+
+
+def test_cache_export_import(tmpdir):
+    old_home, new_home = tmpdir.mkdir('old'), tmpdir.mkdir('new')
+    old_config = _cache(tmpdir.join('old.db'))
+
+    for name, file_hash in (('kept', 'abc'), ('copied', 'def'), ('deleted', 'ghi')):
+        path = old_home.join('{}.epub'.format(name))
+        path.write('book')
+        ebook_obj = EbookObject(path.strpath, file_hash=file_hash, ebook_id=name, size=4, authortitle='a', source='TEST')
+        ebook_obj.meta.update({'title': name})
+        old_config['ebook_cache'].store_ebook(ebook_obj)
+
+    snapshot = tmpdir.join('cache.ogre.gz').strpath
+    assert export_cache(old_config, snapshot) == 3
+
+    # the library moves; one file keeps its mtime, one is copied, one is lost
+    shutil.copy2(old_home.join('kept.epub').strpath, new_home.strpath)
+    shutil.copy(old_home.join('copied.epub').strpath, new_home.strpath)
+    os.utime(new_home.join('copied.epub').strpath, (0, 0))
+
+    new_config = _cache(tmpdir.join('new.db'))
+    cache = new_config['ebook_cache']
+    assert import_cache(new_config, snapshot, rebase=[(old_home.strpath, new_home.strpath)]) == 2
+
+    # a cache hit without hashing
+    path = new_home.join('kept.epub').strpath
+    ebook_obj = cache.get_ebook(path, st=os.stat(path))
+    assert (ebook_obj.file_hash, ebook_obj.ebook_id, ebook_obj.meta['title']) == ('abc', 'kept', 'kept')
+
+    # hashed again, then found by content
+    path = new_home.join('copied.epub').strpath
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook(path, st=os.stat(path))
+    ebook_obj = cache.get_ebook_by_content(path, 'def')
+    assert (ebook_obj.ebook_id, ebook_obj.meta['title']) == ('copied', 'copied')
+
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook(new_home.join('deleted.epub').strpath)
+    with pytest.raises(MissingFromCacheError):
+        cache.get_ebook_by_content(new_home.join('deleted.epub').strpath, 'ghi')
+
+
+def test_cache_import_rejects_bad_file(tmpdir):
+    config = _cache(tmpdir.join('ebook_cache.db'))
+
+    path = tmpdir.join('bad.gz').strpath
+    f = gzip.open(path, 'wb')
+    f.write(b'{"something": "else"}\n')
+    f.close()
+
+    with pytest.raises(SnapshotError):
+        import_cache(config, path)
+
+    with pytest.raises(SnapshotError):
+        import_cache(config, tmpdir.join('missing.gz').strpath)
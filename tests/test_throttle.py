@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import cgi
+import datetime
+import io
+
+import mock
+import pytest
+
+from ogreclient.core.ebook_obj import EbookObject
+from ogreclient.core.upload import is_worth_compressing
+from ogreclient.utils.connection import MultipartBody
+from ogreclient.utils.throttle import Schedule, TokenBucket, parse_rate
+
+
+def test_parse_rate():
+    assert parse_rate('512') == 512
+    assert parse_rate('512K') == 524288
+    assert parse_rate('1.5M') == 1572864
+    assert parse_rate('2mb/s') == 2097152
+    # zero means unlimited
+    assert parse_rate('0') is None
+
+    with pytest.raises(ValueError):
+        parse_rate('fast')
+
+
+def test_schedule_wraps_midnight():
+    schedule = Schedule('23:00-07:00')
+
+    assert schedule.is_full_speed(datetime.datetime(2016, 1, 1, 23, 30)) is True
+    assert schedule.is_full_speed(datetime.datetime(2016, 1, 1, 6, 59)) is True
+    assert schedule.is_full_speed(datetime.datetime(2016, 1, 1, 7, 0)) is False
+    assert schedule.is_full_speed(datetime.datetime(2016, 1, 1, 12, 0)) is False
+
+    with pytest.raises(ValueError):
+        Schedule('lunchtime')
+
+
+@mock.patch('ogreclient.utils.throttle.time')
+def test_token_bucket_sleeps_when_over_rate(mock_time):
+    mock_time.time.return_value = 1000.0
+
+    bucket = TokenBucket(rate=1000)
+
+    # the first second's worth is a free burst
+    bucket.consume(1000)
+    assert mock_time.sleep.called is False
+
+    # debt of 500 bytes at 1000/sec
+    bucket.consume(500)
+    mock_time.sleep.assert_called_once_with(0.5)
+
+
+@mock.patch('ogreclient.utils.throttle.time')
+def test_token_bucket_unlimited_during_schedule(mock_time):
+    mock_time.time.return_value = 1000.0
+
+    schedule = mock.Mock()
+    schedule.is_full_speed.return_value = True
+
+    bucket = TokenBucket(rate=1000, schedule=schedule)
+    bucket.consume(100000)
+    assert mock_time.sleep.called is False
+
+
+def test_multipart_body(tmpdir):
+    tmpdir.join('book.epub').write_binary(b'ebook content')
+
+    with open(tmpdir.join('book.epub').strpath, 'rb') as f:
+        body = MultipartBody({'file_hash': 'abc', 'ebook_id': None}, 'ebook', 'abc.epub', f)
+        data = b''
+        while True:
+            chunk = body.read(7)
+            if not chunk:
+                break
+            data += chunk
+
+    assert len(data) == body.len
+
+    _, params = cgi.parse_header(body.content_type)
+    form = cgi.parse_multipart(io.BytesIO(data), {'boundary': params['boundary'].encode('utf-8')})
+    assert form['file_hash'] == [b'abc']
+    assert form['ebook'] == [b'ebook content']
+    assert 'ebook_id' not in form
+
+
+def test_compression_sample_is_read_limited(client_config, tmpdir):
+    # mobi is flagged compressible in the definitions
+    tmpdir.join('book.mobi').write_binary(b'compressible ebook text ' * 100)
+    ebook_obj = EbookObject(filepath=tmpdir.join('book.mobi').strpath, fmt='mobi')
+
+    with mock.patch('ogreclient.core.upload.read_limiter') as read_limiter:
+        assert is_worth_compressing(client_config, ebook_obj) is True
+
+    read_limiter.consume.assert_called_once_with(2400)
@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import platform
+import shutil
+
+import mock
+import pytest
+
+from ogreclient import exceptions
+from ogreclient.core.scan import _find_changed_ebooks
+from ogreclient.core.watch import InotifyWatcher, PollingWatcher
+from ogreclient.main import watch
+from ogreclient.providers import LibProvider
+from ogreclient.utils.cache import Cache
+
+
+def test_polling_watcher_detects_changes(tmpdir):
+    tmpdir.join('existing.epub').write('one')
+
+    watcher = PollingWatcher([tmpdir.strpath], interval=0.01)
+
+    # nothing has changed yet
+    assert watcher.poll(0) == (set(), False)
+
+    tmpdir.mkdir('sub').join('new.epub').write('two')
+    changed, rescan = watcher.poll(1)
+    assert changed == {tmpdir.join('sub', 'new.epub').strpath}
+    assert rescan is False
+
+
+@pytest.mark.skipif(platform.system() != 'Linux', reason='inotify is Linux only')
+def test_inotify_watcher_debounces_changes(tmpdir):
+    watcher = InotifyWatcher([tmpdir.strpath])
+
+    try:
+        tmpdir.join('one.epub').write('one')
+        # files in new directories are reported, even if created before the directory is watched
+        tmpdir.mkdir('sub').join('two.mobi').write('two')
+
+        changed, rescan = watcher.wait(debounce=0.2, timeout=1)
+        assert tmpdir.join('one.epub').strpath in changed
+        assert tmpdir.join('sub', 'two.mobi').strpath in changed
+        assert rescan is False
+
+        # no further events
+        assert watcher.wait(debounce=0.2, timeout=0.1) == (set(), False)
+    finally:
+        watcher.close()
+
+
+def test_find_changed_ebooks(tmpdir, client_config):
+    libdir = tmpdir.mkdir('lib')
+    libdir.join('book.epub').write('one')
+    libdir.join('.hidden.epub').write('two')
+    libdir.join('notes.txt').write('three')
+    tmpdir.join('outside.epub').write('four')
+
+    providers = {'home': LibProvider(friendly='Home', libpath=libdir.strpath)}
+
+    paths = [
+        libdir.join(name).strpath for name in ('book.epub', '.hidden.epub', 'notes.txt', 'deleted.epub')
+    ] + [tmpdir.join('outside.epub').strpath]
+
+    assert _find_changed_ebooks(paths, providers, client_config['definitions']) == [
+        (libdir.join('book.epub').strpath, 'epub', 'Home')
+    ]
+
+
+@mock.patch('ogreclient.main.sync_ebooks')
+@mock.patch('ogreclient.main.scan_for_ebooks')
+@mock.patch('ogreclient.main.OgreConnection')
+@mock.patch('ogreclient.core.ebook_obj.subprocess.Popen')
+def test_watch_syncs_new_ebooks(mock_subprocess_popen, mock_connection, mock_scan_for_ebooks, mock_sync_ebooks, client_config, ebook_lib_path, tmpdir):
+    # mock return from Popen().communicate()
+    mock_subprocess_popen.return_value.communicate.return_value = (b"Title               : Alice's Adventures in Wonderland\nAuthor(s)           : Lewis Carroll [Carroll, Lewis]\n", b'')
+
+    libdir = tmpdir.mkdir('lib')
+    client_config['providers'] = {'home': LibProvider(friendly='Home', libpath=libdir.strpath)}
+    client_config['ebook_cache'] = Cache(client_config, tmpdir.join('ebook_cache.db').strpath)
+    client_config['ebook_cache'].verify_cache()
+    client_config['watch_debounce'] = 0.05
+
+    def _scan(config):
+        # the library is empty at startup, and a book arrives during the initial scan
+        shutil.copy(os.path.join(ebook_lib_path, 'pg11.epub'), libdir.strpath)
+        raise exceptions.NoEbooksError
+
+    mock_scan_for_ebooks.side_effect = _scan
+
+    watcher = PollingWatcher([libdir.strpath], interval=0.01)
+
+    assert watch(client_config, watcher=watcher, max_batches=1) == 1
+
+    # only the new book was synced
+    assert mock_sync_ebooks.call_count == 1
+    ebooks_by_authortitle = mock_sync_ebooks.call_args[0][2]
+    assert [e.path for e in ebooks_by_authortitle.itervalues()] == [libdir.join('pg11.epub').strpath]
+
+
+@mock.patch('ogreclient.main.sync_ebooks')
+@mock.patch('ogreclient.main.scan_for_ebooks', side_effect=exceptions.NoEbooksError)
+@mock.patch('ogreclient.main.OgreConnection')
+def test_watch_rescan_empty_library(mock_connection, mock_scan_for_ebooks, mock_sync_ebooks, client_config, tmpdir):
+    watcher = PollingWatcher([tmpdir.strpath], interval=0.01)
+
+    # events are lost, eg. on inotify queue overflow, while the library is empty
+    with mock.patch.object(watcher, 'wait', return_value=(set(), True)):
+        assert watch(client_config, watcher=watcher, max_batches=2) == 2
+
+    # initial scan, and a rescan per batch
+    assert mock_scan_for_ebooks.call_count == 3
+    assert mock_sync_ebooks.call_count == 0
+
+
+@mock.patch('ogreclient.main._update_and_upload', return_value=0)
+@mock.patch('ogreclient.main.sync_with_server', return_value={'to_update': {}})
+@mock.patch('ogreclient.main.clean_all_drm', side_effect=[exceptions.AbortSyncDueToBadKey, []])
+@mock.patch('ogreclient.main.scan_for_ebooks', return_value=({}, {}, [], 0))
+@mock.patch('ogreclient.main.OgreConnection')
+def test_watch_removes_bad_kindle_key(mock_connection, mock_scan_for_ebooks, mock_clean_all_drm, mock_sync_with_server, mock_update_and_upload, client_config, tmpdir):
+    client_config['config_dir'] = tmpdir.strpath
+    tmpdir.join('kindlekey.k4i').write('stale')
+
+    watcher = PollingWatcher([tmpdir.mkdir('lib').strpath], interval=0.01)
+
+    # the initial sync only
+    assert watch(client_config, watcher=watcher, max_batches=0) == 0
+
+    # the stale key was removed and the sync retried
+    assert not tmpdir.join('kindlekey.k4i').exists()
+    assert client_config['has_restarted_once'] is True
+    assert mock_clean_all_drm.call_count == 2
+    assert mock_sync_with_server.call_count == 1